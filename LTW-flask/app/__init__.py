@@ -4,57 +4,93 @@ from flask import Flask, render_template
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_bcrypt import Bcrypt
-from flask_migrate import Migrate
 from flask_wtf.csrf import CSRFProtect
-import cloudinary
 from config import config
+from app.utils.db_routing import RoutingSession, configure_replicas
 import os
 
 # Initialize extensions
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 login_manager = LoginManager()
 bcrypt = Bcrypt()
-migrate = Migrate()
 csrf = CSRFProtect()
 
 
-def create_app(config_name='default'):
-    """Application factory pattern."""
+def create_cli_context(config_name='default'):
+    """
+    Minimal app for maintenance scripts: configuration, database and bcrypt.
+
+    No blueprints, sessions, storage or metrics are set up (nor imported),
+    so scripts only pay for Flask and SQLAlchemy. Use it as
+    ``with create_cli_context(name).app_context():``. The invalidation bus
+    is set up, so changes made by scripts reach the caches of the web app.
+    """
+    from app.utils.invalidation import bus
+
     app = Flask(__name__)
     app.config.from_object(config[config_name])
+    configure_replicas(app)
+    db.init_app(app)
+    bcrypt.init_app(app)
+    bus.init_app(app)
+    return app
+
+
+def create_app(config_name='default'):
+    """Application factory pattern."""
+    from app.utils.metrics import metrics
+    from app.utils.payments import init_payments
+    from app.utils.profiler import profiler
+    from app.utils.storage import init_storage
+    from app.utils.session_store import init_sessions
+    from app.utils.uploads import UploadRequest
+    from app.utils.warmup import configure_template_cache
+
+    app = create_cli_context(config_name)
+    # Uploaded files are hashed for the asset registry while they are received
+    app.request_class = UploadRequest
 
     # Initialize extensions with app
-    db.init_app(app)
     login_manager.init_app(app)
-    bcrypt.init_app(app)
-    migrate.init_app(app, db)
     csrf.init_app(app)
+    init_sessions(app)
+    metrics.init_app(app)
+    profiler.init_app(app)
+    configure_template_cache(app)
+
+    # Flask-Migrate pulls in alembic (~150 ms) and is only needed by the
+    # `flask db` commands, so it is set up under the flask CLI only
+    if os.environ.get('FLASK_RUN_FROM_CLI'):
+        from flask_migrate import Migrate
+        Migrate(app, db)
 
     # Configure login
     login_manager.login_view = 'auth.login'
     login_manager.login_message_category = 'info'
     login_manager.login_message = 'Vui lòng đăng nhập để truy cập trang này.'
 
-    # Configure Cloudinary
-    cloudinary.config(
-        cloud_name=app.config['CLOUDINARY_CLOUD_NAME'],
-        api_key=app.config['CLOUDINARY_API_KEY'],
-        api_secret=app.config['CLOUDINARY_API_SECRET']
-    )
-
-    # Ensure upload folder exists
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    # Cloudinary is configured by the storage backend on first use, and the
+    # local backend creates its folders when it writes
+    init_storage(app)
+    # A missing gateway, or the mock one outside DEBUG/TESTING, stops the startup
+    init_payments(app)
 
     # Register blueprints
     from app.routes.auth_routes import auth_bp
     from app.routes.admin_routes import admin_bp
     from app.routes.book_routes import book_bp
     from app.routes.user_routes import user_bp
+    from app.routes.ops_routes import ops_bp
+    from app.routes.storage_routes import storage_bp
+    from app.routes.payment_routes import payments_bp
 
     app.register_blueprint(auth_bp)
     app.register_blueprint(admin_bp)
     app.register_blueprint(book_bp)
     app.register_blueprint(user_bp)
+    app.register_blueprint(ops_bp)
+    app.register_blueprint(storage_bp, url_prefix=app.config.get('STORAGE_LOCAL_URL', '/files/').rstrip('/'))
+    app.register_blueprint(payments_bp)
 
     # Import models to ensure they are registered with SQLAlchemy
     from app.models import User, Role, Book, Category, Order, OrderDetail, Review, PaymentTransaction
@@ -93,6 +129,10 @@ def create_app(config_name='default'):
             'now': datetime.now(timezone.utc)
         }
 
+    from app.utils.image_utils import cover_image, cover_srcset
+    app.add_template_global(cover_image)
+    app.add_template_global(cover_srcset)
+
     @app.template_global('now')
     def get_now():
         """Hàm now() để sử dụng trong templates."""
@@ -1,13 +1,19 @@
+import secrets
 from datetime import datetime
 from flask_login import UserMixin
+from sqlalchemy.orm import deferred
 from app import db, login_manager
-from slugify import slugify
 from decimal import Decimal
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # The ID is "UserID:SessionToken" (see User.get_id), a rotated token logs every device out
+    user_id, _, token = user_id.partition(':')
+    user = User.query.get(int(user_id))
+    if user is None or not user.Status or user.SessionToken != (token or None):
+        return None
+    return user
 
 
 class Role(db.Model):
@@ -28,7 +34,8 @@ class User(db.Model, UserMixin):
 
     UserID = db.Column(db.Integer, primary_key=True)
     Username = db.Column(db.String(50), unique=True, nullable=False)
-    Password = db.Column(db.String(255), nullable=False)
+    # Chỉ tải khi cần kiểm tra mật khẩu
+    Password = deferred(db.Column(db.String(255), nullable=False))
     Email = db.Column(db.String(100), unique=True, nullable=False)
     FullName = db.Column(db.String(100))
     PhoneNumber = db.Column(db.String(20))
@@ -37,15 +44,23 @@ class User(db.Model, UserMixin):
     RegisterDate = db.Column(db.DateTime, default=datetime.utcnow)
     LastLogin = db.Column(db.DateTime)
     Status = db.Column(db.Boolean, default=True)
+    SessionToken = db.Column(db.String(32))  # Đổi khi thu hồi phiên, vô hiệu cả cookie ghi nhớ
 
     orders = db.relationship('Order', backref='user', lazy=True)
     reviews = db.relationship('Review', backref='user', lazy=True)
 
     def get_id(self):
-        return str(self.UserID)
+        # Stored in the session and the remember cookie, both stop working when the token changes
+        return f'{self.UserID}:{self.SessionToken}' if self.SessionToken else str(self.UserID)
+
+    def rotate_session_token(self):
+        """Invalidate every session and remember cookie of the user (saved with the next commit)."""
+        self.SessionToken = secrets.token_hex(16)
 
     def is_admin(self):
-        return self.role.RoleName == 'Admin'
+        # Role names come from the process cache, not one query per request
+        from app.utils.catalog_cache import catalog
+        return catalog.role_names().get(self.RoleID) == 'Admin'
 
     def __repr__(self):
         return f'<User {self.Username}>'
@@ -78,22 +93,34 @@ class Book(db.Model):
     Publisher = db.Column(db.String(200))
     PublishYear = db.Column(db.Integer)
     CategoryID = db.Column(db.Integer, db.ForeignKey('Categories.CategoryID'))
-    Description = db.Column(db.Text)
+    # TEXT không giới hạn, chỉ tải khi cần (trang chi tiết, form sửa)
+    Description = deferred(db.Column(db.Text))
     # Sử dụng Float thay vì Numeric để tránh lỗi precision với SQL Server
     Price = db.Column(db.Float, nullable=False)
     CoverImage = db.Column(db.String(255))  # Cloudinary URL
+    CoverVariants = db.Column(db.Text)  # JSON: các phiên bản ảnh bìa đã thu nhỏ (WebP/JPEG)
+    CoverPlaceholder = db.Column(db.String(2000))  # Ảnh mờ rất nhỏ dạng data URI
     FilePath = db.Column(db.String(255), nullable=False)  # Cloudinary URL
     PageCount = db.Column(db.Integer)
     AddedDate = db.Column(db.DateTime, default=datetime.utcnow)
     UpdatedDate = db.Column(db.DateTime)
     Status = db.Column(db.Boolean, default=True)
 
+    # Index cho bộ lọc và facet (thể loại, năm xuất bản, khoảng giá)
+    __table_args__ = (
+        db.Index('IX_Books_Status_Category', 'Status', 'CategoryID', mssql_include=['PublishYear', 'Price']),
+        db.Index('IX_Books_Price', 'Price', mssql_include=['Status', 'CategoryID', 'PublishYear']),
+        db.Index('IX_Books_PublishYear', 'PublishYear', mssql_include=['Status', 'CategoryID', 'Price']),
+        db.Index('IX_Books_AddedDate', 'AddedDate'),
+    )
 
     order_details = db.relationship('OrderDetail', backref='book', lazy=True)
     reviews = db.relationship('Review', backref='book', lazy=True)
 
     @property
     def slug(self):
+        # Imported on first use, python-slugify is slow to import
+        from slugify import slugify
         return slugify(self.Title)
 
     def __repr__(self):
@@ -161,5 +188,109 @@ class PaymentTransaction(db.Model):
     TransactionCode = db.Column(db.String(100))
     Status = db.Column(db.String(50))
 
+    # Index cho tra cứu theo mã giao dịch (webhook, đối soát) và theo khoảng thời gian
+    __table_args__ = (
+        db.Index('IX_PaymentTransactions_TransactionCode', 'TransactionCode'),
+        db.Index('IX_PaymentTransactions_TransactionDate', 'TransactionDate',
+                 mssql_include=['TransactionCode', 'Amount', 'Status']),
+    )
+
+    def __repr__(self):
+        return f'<PaymentTransaction {self.TransactionID}>'
+
+
+class ReplicaHeartbeat(db.Model):
+    __tablename__ = 'ReplicaHeartbeats'
+
+    HeartbeatID = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # Cập nhật trên primary, dùng để đo độ trễ của replica
+    BeatDate = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<ReplicaHeartbeat {self.BeatDate}>'
+
+
+class Asset(db.Model):
+    __tablename__ = 'Assets'
+
+    AssetID = db.Column(db.Integer, primary_key=True)
+    # SHA-256 của nội dung file, dùng để nhận ra file đã tải lên trước đó
+    ContentHash = db.Column(db.String(64), nullable=False)
+    ResourceType = db.Column(db.String(20), nullable=False)  # image hoặc raw (PDF)
+    URL = db.Column(db.String(255), nullable=False, index=True)  # Cloudinary URL
+    PublicID = db.Column(db.String(255), nullable=False)
+    Size = db.Column(db.BigInteger)
+    Meta = db.Column(db.Text)  # JSON: các phiên bản ảnh bìa và ảnh mờ
+    # Số sách đang dùng file này, xóa khỏi Cloudinary khi về 0
+    RefCount = db.Column(db.Integer, nullable=False, default=0)
+    CreatedDate = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint('ContentHash', 'ResourceType', name='UQ_Assets_ContentHash'),
+    )
+
+    def __repr__(self):
+        return f'<Asset {self.ContentHash[:12]}>'
+
+
+class BookRecommendation(db.Model):
+    __tablename__ = 'BookRecommendations'
+
+    BookID = db.Column(db.Integer, db.ForeignKey('Books.BookID', ondelete='CASCADE'), primary_key=True)
+    # Danh sách BookID hay được mua cùng, theo thứ tự giảm dần độ liên quan (VD: "12,5,9")
+    RelatedBookIDs = db.Column(db.String(500), nullable=False)
+    # OrderDetailID lớn nhất đã được tính đến, dùng để cập nhật tăng dần
+    SourceOrderDetailID = db.Column(db.Integer, nullable=False, default=0)
+    # Tổng OrderDetailID các dòng đã thanh toán đến mốc trên: đổi khi một dòng cũ vừa được thanh toán
+    SourceChecksum = db.Column(db.BigInteger, default=0)
+    UpdatedDate = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @property
+    def related_ids(self):
+        return [int(book_id) for book_id in self.RelatedBookIDs.split(',') if book_id]
+
+    def __repr__(self):
+        return f'<BookRecommendation {self.BookID}>'
+
+
+class RankingScore(db.Model):
+    __tablename__ = 'RankingScores'
+
+    # Bảng xếp hạng: bestsellers (giảm chậm) hoặc trending (giảm nhanh)
+    Ranking = db.Column(db.String(20), primary_key=True)
+    EntityType = db.Column(db.String(20), primary_key=True)  # book hoặc category
+    EntityID = db.Column(db.Integer, primary_key=True)
+    # Điểm giảm dần theo hàm mũ, tính theo mốc thời gian Epoch của bảng xếp hạng
+    PurchaseScore = db.Column(db.Float, nullable=False, default=0)
+    DownloadScore = db.Column(db.Float, nullable=False, default=0)
+    Score = db.Column(db.Float, nullable=False, default=0)  # PurchaseScore + trọng số * DownloadScore
+
+    __table_args__ = (
+        db.Index('IX_RankingScores_Score', 'Ranking', 'EntityType', 'Score'),
+    )
+
+    def __repr__(self):
+        return f'<RankingScore {self.Ranking} {self.EntityType} {self.EntityID}>'
+
+
+class RankingEpoch(db.Model):
+    __tablename__ = 'RankingEpochs'
+
+    Ranking = db.Column(db.String(20), primary_key=True)
+    # Mốc thời gian của điểm đã lưu, được dời lên mỗi lần nén (compaction)
+    Epoch = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<RankingEpoch {self.Ranking} {self.Epoch}>'
+
+
+class InvalidationEvent(db.Model):
+    __tablename__ = 'InvalidationEvents'
+
+    # Số phiên bản tăng dần; mỗi worker đọc các sự kiện mới hơn sự kiện cuối đã xử lý
+    EventID = db.Column(db.Integer, primary_key=True)
+    Tags = db.Column(db.Text, nullable=False)  # VD: "book:12,category:*"
+    CreatedDate = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
     def __repr__(self):
-        return f'<PaymentTransaction {self.TransactionID}>'
\ No newline at end of file
+        return f'<InvalidationEvent {self.EventID} {self.Tags}>'
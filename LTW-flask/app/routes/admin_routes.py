@@ -1,15 +1,30 @@
-from flask import Blueprint, render_template, url_for, flash, redirect, request, abort, current_app
+from flask import (Blueprint, render_template, url_for, flash, redirect, request, abort, current_app, Response, jsonify,
+                   send_from_directory, stream_with_context)
 from flask_login import current_user, login_required
 from flask_wtf import FlaskForm
 from flask_wtf.file import FileField, FileAllowed, FileRequired
 from sqlalchemy.sql.sqltypes import Integer
 from wtforms import StringField, TextAreaField, DecimalField, IntegerField, SelectField, SubmitField, BooleanField
-from wtforms.validators import DataRequired, NumberRange, Optional, Length
+from wtforms.validators import DataRequired, NumberRange, Optional, Length, ValidationError
 from app import db
 from app.models import Book, Category, User, Order, OrderDetail, Review, Role, PaymentTransaction
 from app.utils.auth_utils import admin_required
-from app.utils.cloudinary_utils import upload_image, upload_file, delete_asset
+from app.utils.db_routing import read_only
+from app.utils.asset_registry import store_cover, store_book_file, store_preview_cover
+from app.utils.bulk_operations import BookSelection, update_status, delete_books
+from app.utils.jobs import submit_job, get_job
+from app.utils.exports import (EXPORTS, FORMATS, XLSX_MAX_ROWS, count_rows, export_chunks, export_filename,
+                               write_export)
+from app.utils.projections import book_list_query, book_items, OrderListItem, ReviewListItem, UserListItem
+from app.utils.report_queries import filter_orders, filter_reviews, filter_users, book_filter_conditions
+from app.utils.facets import facet_counts
+from app.utils.streaming import stream_rows, stream_page
+from app.utils.profiler import list_profiles, load_profile, collapsed_stacks, flamegraph_rows
+from app.utils.session_store import revoke_user_sessions
+from app.utils.pdf_ingest import inspect_pdf, PdfError
+from app.utils.metrics import metrics
 from sqlalchemy import desc, func, cast
+from sqlalchemy.orm import undefer
 from datetime import datetime, timezone
 from decimal import Decimal
 import os
@@ -36,6 +51,33 @@ class BookForm(FlaskForm):
     status = BooleanField('Hiển thị', default=True)
     submit = SubmitField('Lưu')
 
+    # What read_book_file() found in the uploaded PDF
+    pdf_info = None
+
+    def validate_page_count(self, field):
+        page_count = self.pdf_info.page_count if self.pdf_info else None
+        if page_count and field.data is not None and field.data != page_count:
+            raise ValidationError(f'File PDF có {page_count} trang.')
+
+
+def read_book_file(form):
+    """Read the uploaded PDF and fill the blank title, author and page count from it."""
+    try:
+        with metrics.timer('pdf_ingest_duration_seconds', step='metadata'):
+            form.pdf_info = inspect_pdf(form.book_file.data)
+    except PdfError as e:
+        current_app.logger.warning(f"Could not read uploaded PDF: {str(e)}")
+        flash('Không đọc được thông tin từ file PDF, vui lòng tự nhập số trang.', 'warning')
+        return
+
+    info = form.pdf_info
+    if not form.title.data and info.title:
+        form.title.data = info.title[:200]
+    if not form.author.data and info.author:
+        form.author.data = info.author[:200]
+    if form.page_count.data is None and info.page_count:
+        form.page_count.data = info.page_count
+
 
 # Category form
 class CategoryForm(FlaskForm):
@@ -61,6 +103,7 @@ class UserForm(FlaskForm):
 @admin_bp.route('/')
 @login_required
 @admin_required
+@read_only
 def dashboard():
     """Admin dashboard."""
     # Count statistics
@@ -121,10 +164,13 @@ def dashboard():
 @admin_bp.route('/books')
 @login_required
 @admin_required
+@read_only
 def books():
-    """List all books."""
-    books = Book.query.order_by(desc(Book.AddedDate)).all()
-    return render_template('admin/books.html', title='Quản lý sách', books=books)
+    """List books matching the filters, with facet counts for the filter modal."""
+    conditions = book_filter_conditions(request.args)
+    books = book_items(book_list_query().filter(*conditions).order_by(desc(Book.AddedDate)))
+    facets = facet_counts(book_filter_conditions(request.args, include_facets=False), request.args)
+    return render_template('admin/books.html', title='Quản lý sách', books=books, facets=facets)
 
 
 @admin_bp.route('/books/add', methods=['GET', 'POST'])
@@ -137,27 +183,32 @@ def add_book():
     # Populate category choices
     form.category.choices = [(cat.CategoryID, cat.CategoryName) for cat in Category.query.all()]
 
+    # Blank fields are filled from the PDF before they are validated
+    if form.is_submitted() and form.book_file.data:
+        read_book_file(form)
+
     if form.validate_on_submit():
         try:
-            # Upload cover image to Cloudinary if provided
-            cover_image_url = None
-            if form.cover_image.data:
-                result = upload_image(form.cover_image.data)
-                if result:
-                    cover_image_url = result['secure_url']
-
             # Upload book file to Cloudinary (required)
             if not form.book_file.data:
                 flash('File sách là bắt buộc!', 'danger')
                 return render_template('admin/book_form.html', title='Thêm sách mới', form=form, book=None)
 
-            result = upload_file(form.book_file.data)
-            if not result:
+            # Upload cover image and its resized variants to Cloudinary if provided
+            # (content already in the asset registry is reused without uploading),
+            # otherwise fall back to the first page of the book
+            cover = {}
+            if form.cover_image.data:
+                cover = store_cover(form.cover_image.data) or {}
+            else:
+                cover = store_preview_cover(form.book_file.data) or {}
+
+            pdf_meta = form.pdf_info.as_dict() if form.pdf_info else None
+            file_url = store_book_file(form.book_file.data, meta=pdf_meta)
+            if not file_url:
                 flash('Không thể tải file sách lên. Vui lòng thử lại.', 'danger')
                 return render_template('admin/book_form.html', title='Thêm sách mới', form=form, book=None)
 
-            file_url = result['secure_url']
-
             # Convert Decimal to float for SQL Server compatibility
             price_value = float(form.price.data) if form.price.data else 0.0
 
@@ -170,7 +221,9 @@ def add_book():
                 CategoryID=form.category.data,
                 Description=form.description.data,
                 Price=price_value,
-                CoverImage=cover_image_url,
+                CoverImage=cover.get('CoverImage'),
+                CoverVariants=cover.get('CoverVariants'),
+                CoverPlaceholder=cover.get('CoverPlaceholder'),
                 FilePath=file_url,
                 PageCount=form.page_count.data,
                 AddedDate=datetime.now(timezone.utc),
@@ -195,24 +248,24 @@ def add_book():
 @login_required
 @admin_required
 def bulk_update_books():
-    """Update status of multiple books at once."""
+    """Update status of multiple books (or all books matching the filters) at once."""
     try:
-        book_ids = request.form.get('book_ids', '').split(',')
+        selection = BookSelection.from_form(request.form)
         status = request.form.get('status') == '1'
 
-        # Loại bỏ chuỗi rỗng
-        book_ids = [book_id for book_id in book_ids if book_id.strip()]
-
-        if not book_ids:
+        total = selection.count()
+        if not total:
             flash('Không có sách nào được chọn để cập nhật!', 'warning')
             return redirect(url_for('admin.books'))
 
-        # Cập nhật trạng thái các sách
-        Book.query.filter(Book.BookID.in_(book_ids)).update({Book.Status: status}, synchronize_session=False)
-        db.session.commit()
+        # Large selections run in the background, the admin follows the progress
+        if total > current_app.config['BULK_SYNC_LIMIT']:
+            job_id = submit_job('bulk_update_books', update_status, selection, status,
+                                owner=current_user.UserID, total=total)
+            return redirect(url_for('admin.job_status', job_id=job_id))
 
-        status_text = 'kích hoạt' if status else 'ẩn'
-        flash(f'Đã {status_text} {len(book_ids)} sách!', 'success')
+        result = update_status(selection, status)
+        flash(result['message'], 'success')
 
     except Exception as e:
         db.session.rollback()
@@ -226,30 +279,23 @@ def bulk_update_books():
 @login_required
 @admin_required
 def bulk_delete_books():
-    """Delete multiple books at once."""
+    """Delete multiple books (or all books matching the filters) at once."""
     try:
-        book_ids = request.form.get('book_ids', '').split(',')
-
-        # Loại bỏ chuỗi rỗng
-        book_ids = [book_id for book_id in book_ids if book_id.strip()]
+        selection = BookSelection.from_form(request.form)
 
-        if not book_ids:
+        total = selection.count()
+        if not total:
             flash('Không có sách nào được chọn để xóa!', 'warning')
             return redirect(url_for('admin.books'))
 
-        # Kiểm tra xem sách có liên kết đến đơn hàng không
-        ordered_books = OrderDetail.query.filter(OrderDetail.BookID.in_(book_ids)).first()
-        if ordered_books:
-            flash('Không thể xóa một số sách vì đã có người mua!', 'danger')
-            return redirect(url_for('admin.books'))
-
-        # Xóa các sách đã chọn
-        books = Book.query.filter(Book.BookID.in_(book_ids)).all()
-        for book in books:
-            db.session.delete(book)
+        # Large selections run in the background, the admin follows the progress
+        if total > current_app.config['BULK_SYNC_LIMIT']:
+            job_id = submit_job('bulk_delete_books', delete_books, selection,
+                                owner=current_user.UserID, total=total)
+            return redirect(url_for('admin.job_status', job_id=job_id))
 
-        db.session.commit()
-        flash(f'Đã xóa {len(books)} sách!', 'success')
+        result = delete_books(selection)
+        flash(result['message'], 'success' if not result['skipped'] else 'warning')
 
     except Exception as e:
         db.session.rollback()
@@ -259,17 +305,52 @@ def bulk_delete_books():
     return redirect(url_for('admin.books'))
 
 
+@admin_bp.route('/jobs/<job_id>')
+@login_required
+@admin_required
+def job_status(job_id):
+    """Show the progress of a background job (JSON with ?format=json)."""
+    job = get_job(job_id)
+    if job is None:
+        abort(404)
+
+    if request.args.get('format') == 'json':
+        return jsonify(job)
+
+    # Export jobs go back to the report they were started from
+    kind = job['kind'].partition('export_')[2]
+    back = url_for(f'admin.{kind}') if kind in EXPORTS else url_for('admin.books')
+    return render_template('admin/job_status.html', title='Tiến trình xử lý', job=job, back=back)
+
+
+@admin_bp.route('/jobs/<job_id>/download')
+@login_required
+@admin_required
+def download_export(job_id):
+    """Download the file written by an export job."""
+    job = get_job(job_id)
+    result = (job or {}).get('result') or {}
+    if job is None or job['status'] != 'done' or not result.get('export'):
+        abort(404)
+    return send_from_directory(current_app.config['JOBS_DIR'], result['export'],
+                               as_attachment=True, download_name=result['filename'])
+
+
 @admin_bp.route('/books/edit/<int:book_id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
 def edit_book(book_id):
     """Edit a book."""
-    book = Book.query.get_or_404(book_id)
+    book = Book.query.options(undefer(Book.Description)).get_or_404(book_id)
     form = BookForm()
 
     # Populate category choices
     form.category.choices = [(cat.CategoryID, cat.CategoryName) for cat in Category.query.all()]
 
+    # Blank fields are filled from a new PDF before they are validated
+    if form.is_submitted() and form.book_file.data:
+        read_book_file(form)
+
     if form.validate_on_submit():
         try:
             # Convert Decimal to float for SQL Server compatibility
@@ -287,17 +368,29 @@ def edit_book(book_id):
             book.Status = form.status.data
             book.UpdatedDate = datetime.now(timezone.utc)
 
-            # Upload new cover image if provided
+            # Upload new cover image and its variants if provided
+            # (the previous cover is released once no book uses it anymore)
             if form.cover_image.data:
-                result = upload_image(form.cover_image.data)
-                if result:
-                    book.CoverImage = result['secure_url']
+                cover = store_cover(form.cover_image.data)
+                if cover:
+                    book.CoverImage = cover['CoverImage']
+                    book.CoverVariants = cover['CoverVariants']
+                    book.CoverPlaceholder = cover['CoverPlaceholder']
 
             # Upload new book file if provided
             if form.book_file.data:
-                result = upload_file(form.book_file.data)
-                if result:
-                    book.FilePath = result['secure_url']
+                pdf_meta = form.pdf_info.as_dict() if form.pdf_info else None
+                file_url = store_book_file(form.book_file.data, meta=pdf_meta)
+                if file_url:
+                    book.FilePath = file_url
+
+                # A book without cover gets the first page of its new file
+                if not book.CoverImage:
+                    cover = store_preview_cover(form.book_file.data)
+                    if cover:
+                        book.CoverImage = cover['CoverImage']
+                        book.CoverVariants = cover['CoverVariants']
+                        book.CoverPlaceholder = cover['CoverPlaceholder']
 
             db.session.commit()
 
@@ -490,10 +583,11 @@ def delete_category(category_id):
 @admin_bp.route('/users')
 @login_required
 @admin_required
+@read_only
 def users():
     """List all users."""
-    users = User.query.all()
-    return render_template('admin/users.html', title='Quản lý người dùng', users=users)
+    users = stream_rows(filter_users(request.args), UserListItem)
+    return stream_page('admin/users.html', title='Quản lý người dùng', users=users, roles=Role.query.all())
 
 
 @admin_bp.route('/users/edit/<int:user_id>', methods=['GET', 'POST'])
@@ -576,8 +670,14 @@ def ban_user(user_id):
 
         # Toggle status
         user.Status = not user.Status
+        # Log a banned user out of every device, remember cookies included
+        if not user.Status:
+            user.rotate_session_token()
         db.session.commit()
 
+        if not user.Status:
+            revoke_user_sessions(user.UserID)
+
         status_text = 'kích hoạt' if user.Status else 'khóa'
         flash(f'Tài khoản {user.Username} đã được {status_text}!', 'success')
 
@@ -593,10 +693,15 @@ def ban_user(user_id):
 @admin_bp.route('/orders')
 @login_required
 @admin_required
+@read_only
 def orders():
     """List all orders."""
-    orders = Order.query.order_by(desc(Order.OrderDate)).all()
-    return render_template('admin/orders.html', title='Quản lý đơn hàng', orders=orders)
+    orders = stream_rows(filter_orders(request.args), OrderListItem)
+
+    # Filters kept when switching tabs
+    filters = {key: value for key, value in request.args.items() if key != 'tab' and value}
+    return stream_page('admin/orders.html', title='Quản lý đơn hàng', orders=orders,
+                       tab=request.args.get('tab', 'all'), filters=filters)
 
 
 @admin_bp.route('/orders/<int:order_id>')
@@ -645,10 +750,15 @@ def update_order(order_id):
 @admin_bp.route('/reviews')
 @login_required
 @admin_required
+@read_only
 def reviews():
     """List all reviews."""
-    reviews = Review.query.order_by(desc(Review.ReviewDate)).all()
-    return render_template('admin/reviews.html', title='Quản lý đánh giá', reviews=reviews)
+    reviews = stream_rows(filter_reviews(request.args), ReviewListItem)
+
+    # Filters kept when switching tabs
+    filters = {key: value for key, value in request.args.items() if key != 'status' and value}
+    return stream_page('admin/reviews.html', title='Quản lý đánh giá', reviews=reviews,
+                       status=request.args.get('status', ''), filters=filters)
 
 
 @admin_bp.route('/reviews/toggle/<int:review_id>', methods=['POST'])
@@ -671,4 +781,84 @@ def toggle_review(review_id):
         current_app.logger.error(f"Error toggling review: {str(e)}")
         flash('Có lỗi xảy ra khi thay đổi trạng thái đánh giá.', 'danger')
 
-    return redirect(url_for('admin.reviews'))
\ No newline at end of file
+    return redirect(url_for('admin.reviews'))
+
+
+# Exports
+@admin_bp.route('/export/<name>.<fmt>')
+@login_required
+@admin_required
+@read_only
+def export(name, fmt):
+    """Download a report (orders, users, books, reviews) as CSV or Excel, with the filters of its page."""
+    if name not in EXPORTS or fmt not in FORMATS:
+        abort(404)
+    args = request.args.to_dict()
+
+    try:
+        total = count_rows(name, args)
+        if fmt == 'xlsx' and total >= XLSX_MAX_ROWS:
+            flash(f'Excel chỉ chứa được {XLSX_MAX_ROWS - 1} dòng. Vui lòng lọc bớt hoặc xuất CSV.', 'warning')
+            return redirect(url_for(f'admin.{name}', **args))
+
+        # Large exports are written by a background job, the admin downloads the file when it is done
+        if total > current_app.config['EXPORT_SYNC_LIMIT']:
+            job_id = submit_job(f'export_{name}', write_export, name, fmt, args,
+                                owner=current_user.UserID, total=total)
+            metrics.inc('exports_total', export=name, format=fmt, mode='job')
+            return redirect(url_for('admin.job_status', job_id=job_id))
+
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error exporting {name}: {str(e)}")
+        flash('Có lỗi xảy ra khi xuất dữ liệu.', 'danger')
+        return redirect(url_for(f'admin.{name}', **args))
+
+    # Sent with chunked transfer encoding as the rows are read
+    metrics.inc('exports_total', export=name, format=fmt, mode='stream')
+    return Response(stream_with_context(export_chunks(name, fmt, args)), mimetype=FORMATS[fmt][1],
+                    headers={'Content-Disposition': f'attachment; filename="{export_filename(name, fmt)}"'})
+
+
+# Profiling
+@admin_bp.route('/profiles')
+@login_required
+@admin_required
+def profiles():
+    """List stored request profiles."""
+    return render_template('admin/profiles.html', title='Profiling',
+                           profiles=list_profiles(),
+                           enabled=current_app.config.get('PROFILER_ENABLED'))
+
+
+@admin_bp.route('/profiles/<name>')
+@login_required
+@admin_required
+def profile_detail(name):
+    """Show the flamegraph of a stored profile."""
+    profile = load_profile(name)
+    if not profile:
+        abort(404)
+
+    samples = profile['samples'] or 1
+    categories = sorted(((category, count * 100.0 / samples) for category, count in profile['categories'].items()),
+                        key=lambda item: item[1], reverse=True)
+
+    return render_template('admin/profile_detail.html',
+                           title=f'Profile {profile["endpoint"]}',
+                           profile=profile,
+                           categories=categories,
+                           rows=flamegraph_rows(profile))
+
+
+@admin_bp.route('/profiles/<name>.folded')
+@login_required
+@admin_required
+def profile_folded(name):
+    """Download a profile in collapsed-stack format."""
+    profile = load_profile(name)
+    if not profile:
+        abort(404)
+
+    return Response(collapsed_stacks(profile), mimetype='text/plain',
+                    headers={'Content-Disposition': f'attachment; filename={name}.folded'})
@@ -1,11 +1,17 @@
-from flask import Blueprint, render_template, url_for, flash, redirect, request
+from flask import Blueprint, render_template, url_for, flash, redirect, request, current_app
 from flask_login import login_user, current_user, logout_user, login_required
 from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField, BooleanField
 from wtforms.validators import DataRequired, Length, Email, EqualTo, ValidationError
-from app import db, bcrypt
+from app import db
 from app.models import User, Role
+from app.utils.metrics import metrics
+from app.utils.password_hashing import passwords, HashingBusy
+from app.utils.session_store import start_user_session
+from app.utils.throttle import throttle
+from sqlalchemy.orm import undefer
 from datetime import datetime
+import math
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -35,6 +41,13 @@ class LoginForm(FlaskForm):
     submit = SubmitField('Đăng nhập')
 
 
+def too_many_requests(template, retry_after, message, **context):
+    """Render a form again with status 429 and a Retry-After header."""
+    retry_after = max(1, math.ceil(retry_after))
+    flash(message.format(seconds=retry_after), 'warning')
+    return render_template(template, **context), 429, {'Retry-After': str(retry_after)}
+
+
 @auth_bp.route('/register', methods=['GET', 'POST'])
 def register():
     if current_user.is_authenticated:
@@ -42,7 +55,16 @@ def register():
 
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        retry_after = throttle.check((f'register_ip:{request.remote_addr}', current_app.config['REGISTER_THROTTLE_IP']))
+        if retry_after:
+            return too_many_requests('auth/register.html', retry_after,
+                                     'Bạn đã đăng ký quá nhiều lần. Vui lòng thử lại sau {seconds} giây.',
+                                     title='Đăng Ký', form=form)
+        try:
+            hashed_password = passwords.hash(form.password.data)
+        except HashingBusy:
+            return too_many_requests('auth/register.html', 1, 'Hệ thống đang bận. Vui lòng thử lại sau giây lát.',
+                                     title='Đăng Ký', form=form)
 
         # Get user role ID (2 for regular users)
         user_role = Role.query.filter_by(RoleName='User').first()
@@ -74,16 +96,43 @@ def login():
 
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(Username=form.username.data).first()
-
-        if user and bcrypt.check_password_hash(user.Password, form.password.data):
+        # Stop password guessing before any hashing happens
+        username_key = f'username:{form.username.data.strip().lower()}'
+        retry_after = throttle.check((f'ip:{request.remote_addr}', current_app.config['LOGIN_THROTTLE_IP']),
+                                     (username_key, current_app.config['LOGIN_THROTTLE_USERNAME']))
+        if retry_after:
+            metrics.inc('logins_total', result='throttled')
+            return too_many_requests('auth/login.html', retry_after,
+                                     'Bạn đã thử đăng nhập quá nhiều lần. Vui lòng thử lại sau {seconds} giây.',
+                                     title='Đăng Nhập', form=form)
+
+        user = User.query.options(undefer(User.Password)).filter_by(Username=form.username.data).first()
+
+        try:
+            valid = user is not None and passwords.verify(user.Password, form.password.data)
+        except HashingBusy:
+            metrics.inc('logins_total', result='busy')
+            return too_many_requests('auth/login.html', 1, 'Hệ thống đang bận. Vui lòng thử lại sau giây lát.',
+                                     title='Đăng Nhập', form=form)
+
+        if valid:
+            # Hashes made with another cost are replaced while the password is at hand
+            if passwords.needs_rehash(user.Password):
+                try:
+                    user.Password = passwords.hash(form.password.data)
+                except HashingBusy:
+                    current_app.logger.info(f"Rehash of user {user.UserID} postponed, hashing is busy")
+            throttle.reset(username_key)
             login_user(user, remember=form.remember.data)
+            start_user_session(user.UserID)
             user.LastLogin = datetime.utcnow()
             db.session.commit()
+            metrics.inc('logins_total', result='success')
 
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('book.new_books'))
         else:
+            metrics.inc('logins_total', result='failure')
             flash('Đăng nhập không thành công. Vui lòng kiểm tra tên tài khoản và mật khẩu.', 'danger')
 
     return render_template('auth/login.html', title='Đăng Nhập', form=form)
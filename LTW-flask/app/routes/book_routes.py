@@ -1,29 +1,110 @@
-from flask import Blueprint, render_template, url_for, flash, redirect, request, abort
+from flask import Blueprint, render_template, url_for, flash, redirect, request, abort, jsonify, current_app
 from flask_login import current_user, login_required
 from flask_wtf import FlaskForm
 from wtforms import StringField, TextAreaField, DecimalField, IntegerField, SelectField, SubmitField
 from wtforms.validators import DataRequired, NumberRange, Optional
 from app import db
-from app.models import Book, Category, Review
-from sqlalchemy import desc, func, or_, text
+from app.models import Book, BookRecommendation, Category, Review
+from app.utils.db_routing import read_only
+from app.utils import entity_cache
+from app.utils.metrics import metrics
+from app.utils.projections import book_list_query, book_items
+from app.utils.facets import facet_counts, facet_args
+from app.utils.autocomplete import autocomplete
+from app.utils.rankings import leaderboard, ENTITY_TYPES
+from app.utils.report_queries import book_filter_conditions
+from sqlalchemy import desc, func, or_, text, case
 from datetime import datetime
 
 
 book_bp = Blueprint('book', __name__)
 
+# Number of related books shown on the detail page
+RELATED_BOOKS = 3
+# Books and categories shown on the ranking pages
+RANKING_PAGE_BOOKS = 24
+RANKING_PAGE_CATEGORIES = 5
+
 @book_bp.route('/')
 def index():
     """Redirect to new books page."""
     return redirect(url_for('book.new_books'))
 
 @book_bp.route('/new')
+@read_only
 def new_books():
     """Display new books."""
     # Get the latest 9 books, ordered by added date
-    books = Book.query.filter_by(Status=True).order_by(desc(Book.AddedDate)).limit(9).all()
+    books = book_items(book_list_query().filter(Book.Status == True).order_by(desc(Book.AddedDate)).limit(9))
     return render_template('books/new.html', title='Sách mới', books=books)
 
+def _ranked_books(ranking, limit):
+    """Active books of a ranking in rank order, read from the precomputed list."""
+    ranked_ids = [book_id for book_id, _ in leaderboard.top(ranking, 'book')]
+    if not ranked_ids:
+        return []
+    rows = {item.BookID: item for item in book_items(book_list_query().filter(
+        Book.BookID.in_(ranked_ids),
+        Book.Status == True
+    ))}
+    return [rows[book_id] for book_id in ranked_ids if book_id in rows][:limit]
+
+def _ranked_categories(ranking, limit):
+    ranked_ids = [category_id for category_id, _ in leaderboard.top(ranking, 'category')]
+    if not ranked_ids:
+        return []
+    rows = {category.CategoryID: category for category in
+            Category.query.filter(Category.CategoryID.in_(ranked_ids), Category.Status == True)}
+    return [rows[category_id] for category_id in ranked_ids if category_id in rows][:limit]
+
+def _ranking_page(ranking, title):
+    return render_template('books/ranking.html',
+                           title=title,
+                           ranking=ranking,
+                           books=_ranked_books(ranking, RANKING_PAGE_BOOKS),
+                           top_categories=_ranked_categories(ranking, RANKING_PAGE_CATEGORIES))
+
+@book_bp.route('/bestsellers')
+@read_only
+def bestsellers():
+    """Display the best selling books of the last months."""
+    return _ranking_page('bestsellers', 'Sách bán chạy')
+
+@book_bp.route('/trending')
+@read_only
+def trending():
+    """Display the books selling best right now."""
+    return _ranking_page('trending', 'Sách thịnh hành')
+
+@book_bp.route('/api/rankings/<ranking>')
+@read_only
+def ranking_api(ranking):
+    """Return a ranking as JSON (``type`` is book or category, ``limit`` at most RANKING_SIZE)."""
+    entity_type = request.args.get('type', 'book')
+    if ranking not in current_app.config['RANKING_HALF_LIVES'] or entity_type not in ENTITY_TYPES:
+        abort(404)
+    limit = min(request.args.get('limit', 10, type=int), current_app.config['RANKING_SIZE'])
+
+    scores = dict(leaderboard.top(ranking, entity_type))
+    items = []
+    if entity_type == 'book':
+        for book in _ranked_books(ranking, limit):
+            items.append({'id': book.BookID, 'title': book.Title, 'author': book.Author,
+                          'score': round(scores[book.BookID], 4),
+                          'url': url_for('book.book_detail', book_id=book.BookID)})
+    else:
+        for category in _ranked_categories(ranking, limit):
+            items.append({'id': category.CategoryID, 'name': category.CategoryName,
+                          'score': round(scores[category.CategoryID], 4),
+                          'url': url_for('book.category_books', category_id=category.CategoryID)})
+
+    response = jsonify({'ranking': ranking, 'type': entity_type, 'items': items})
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['RANKING_CACHE_SECONDS']
+    return response
+
 @book_bp.route('/category')
+@read_only
 def categories():
     """Display all categories."""
     # Get all root categories (those without a parent)
@@ -31,42 +112,53 @@ def categories():
     return render_template('books/categories.html', title='Thể loại', categories=root_categories)
 
 @book_bp.route('/category/<int:category_id>')
+@read_only
 def category_books(category_id):
     """Display books in a specific category."""
-    category = Category.query.get_or_404(category_id)
-    
-    # Get books directly in this category
-    direct_books = Book.query.filter_by(CategoryID=category_id, Status=True).all()
+    category = entity_cache.categories.get_or_404(category_id)
     
-    # Get books from subcategories
+    # Get subcategories
     subcategories = Category.query.filter_by(ParentCategoryID=category_id, Status=True).all()
-    subcategory_books = []
-    for subcat in subcategories:
-        subcategory_books.extend(Book.query.filter_by(CategoryID=subcat.CategoryID, Status=True).all())
-    
-    # Combine the books
-    books = direct_books + subcategory_books
+
+    # Get books directly in this category and in its subcategories in one query
+    category_ids = [category_id] + [subcat.CategoryID for subcat in subcategories]
+    books = book_items(book_list_query().filter(Book.CategoryID.in_(category_ids), Book.Status == True)
+                       .order_by(case((Book.CategoryID == category_id, 0), else_=1), Book.BookID))
     
     return render_template('books/category_books.html', 
                            title=f'Thể loại: {category.CategoryName}', 
                            category=category, 
+                           subcategories=subcategories,
                            books=books)
 
 @book_bp.route('/book/<int:book_id>')
+@read_only
 def book_detail(book_id):
     """Display book details."""
-    book = Book.query.get_or_404(book_id)
+    book = entity_cache.books.get_or_404(book_id)
     
     # If book is not active and user is not admin, return 404
     if not book.Status and (not current_user.is_authenticated or not current_user.is_admin()):
         abort(404)
     
-    # Get related books (books in the same category)
-    related_books = Book.query.filter(
-        Book.CategoryID == book.CategoryID, 
-        Book.BookID != book.BookID,
-        Book.Status == True
-    ).limit(3).all()
+    # Get related books: precomputed co-purchases (one primary key lookup),
+    # topped up with the newest books of the same category for cold-start books
+    related_books = []
+    recommendation = db.session.get(BookRecommendation, book_id)
+    if recommendation and recommendation.related_ids:
+        related_ids = recommendation.related_ids
+        rows = {item.BookID: item for item in book_items(book_list_query().filter(
+            Book.BookID.in_(related_ids),
+            Book.Status == True
+        ))}
+        related_books = [rows[related_id] for related_id in related_ids if related_id in rows][:RELATED_BOOKS]
+
+    if len(related_books) < RELATED_BOOKS:
+        related_books += book_items(book_list_query().filter(
+            Book.CategoryID == book.CategoryID,
+            Book.BookID.notin_([book.BookID] + [item.BookID for item in related_books]),
+            Book.Status == True
+        ).order_by(desc(Book.AddedDate)).limit(RELATED_BOOKS - len(related_books)))
     
     # Get book reviews
     reviews = Review.query.filter_by(BookID=book_id, Status=True).order_by(desc(Review.ReviewDate)).all()
@@ -78,29 +170,53 @@ def book_detail(book_id):
                            reviews=reviews)
 
 @book_bp.route('/search')
+@read_only
 def search():
     query = request.args.get('q', '')
     if not query:
         return redirect(url_for('book.new_books'))
 
+    metrics.inc('searches_total')
+
     # Tạo mẫu tìm kiếm
     search_term = f'%{query}%'
 
     # Search in title, author, and description
-    books = Book.query.filter(
-        Book.Status == True
-    ).filter(
-        or_(
-            text("Title COLLATE Latin1_General_CI_AI LIKE :search"),
-            text("Author COLLATE Latin1_General_CI_AI LIKE :search"),
-            text("Description COLLATE Latin1_General_CI_AI LIKE :search")
-        )
-    ).params(search=search_term).all()
+    conditions = [
+        Book.Status == True,
+        text("(Books.Title COLLATE Latin1_General_CI_AI LIKE :search"
+             " OR Books.Author COLLATE Latin1_General_CI_AI LIKE :search"
+             " OR Books.Description COLLATE Latin1_General_CI_AI LIKE :search)").bindparams(search=search_term)
+    ]
+
+    # Narrow down by the selected facets (category, publish year, price band)
+    books = book_items(book_list_query().filter(*conditions, *book_filter_conditions(facet_args(request.args))))
+    facets = facet_counts(conditions, request.args)
 
     return render_template('books/search_results.html',
                            title='Kết quả tìm kiếm',
                            query=query,
-                           books=books)
+                           books=books,
+                           facets=facets)
+
+@book_bp.route('/search/suggest')
+def suggest():
+    """Return search-box suggestions as JSON, served from the in-memory index."""
+    query = request.args.get('q', '')[:100]
+    suggestions = []
+    for kind, target, label in autocomplete.suggest(query):
+        if kind == 'book':
+            url = url_for('book.book_detail', book_id=target)
+        elif kind == 'category':
+            url = url_for('book.category_books', category_id=target)
+        else:
+            url = url_for('book.search', q=target)
+        suggestions.append({'type': kind, 'label': label, 'url': url})
+
+    response = jsonify({'query': query, 'suggestions': suggestions})
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
 
 # Review form
 class ReviewForm(FlaskForm):
@@ -112,7 +228,7 @@ class ReviewForm(FlaskForm):
 @login_required
 def add_review(book_id):
     """Add a review for a book."""
-    book = Book.query.get_or_404(book_id)
+    book = entity_cache.books.get_or_404(book_id)
     
     # Check if user has already reviewed this book
     existing_review = Review.query.filter_by(
@@ -0,0 +1,59 @@
+import hmac
+
+from flask import Blueprint, Response, abort, current_app, jsonify, request
+from flask_login import current_user
+from sqlalchemy import text
+from app import db
+from app.utils import entity_cache
+from app.utils.metrics import metrics
+
+ops_bp = Blueprint('ops', __name__)
+
+
+def _authorized():
+    """Allow scrapers with the metrics token, or a logged-in admin."""
+    token = current_app.config.get('METRICS_TOKEN')
+    auth_header = request.headers.get('Authorization', '')
+    if token and auth_header.startswith('Bearer '):
+        return hmac.compare_digest(auth_header[len('Bearer '):], token)
+    return current_user.is_authenticated and current_user.is_admin()
+
+
+@ops_bp.route('/metrics')
+def prometheus_metrics():
+    """Expose application metrics in Prometheus text format."""
+    if not _authorized():
+        abort(403)
+
+    metrics.flush()
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@ops_bp.route('/cache/stats')
+def cache_stats():
+    """Report the entity cache counters of the worker serving the request."""
+    if not _authorized():
+        abort(403)
+
+    return jsonify(books=entity_cache.books.stats(), categories=entity_cache.categories.stats())
+
+
+@ops_bp.route('/healthz/live')
+def liveness():
+    """Report that the process answers requests."""
+    return jsonify(status='ok')
+
+
+@ops_bp.route('/healthz/ready')
+def readiness():
+    """Report whether this worker should get traffic: caches warmed and database reachable."""
+    # The production launcher clears the flag until its warm-up has finished
+    warmup = current_app.extensions.get('warmup')
+    if not current_app.extensions.get('ready', True):
+        return jsonify(status='warming up', warmup=warmup), 503
+    try:
+        db.session.execute(text('SELECT 1'))
+    except Exception as e:
+        current_app.logger.warning(f"Readiness check failed: {str(e)}")
+        return jsonify(status='database unavailable', warmup=warmup), 503
+    return jsonify(status='ready', warmup=warmup)
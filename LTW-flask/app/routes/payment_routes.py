@@ -0,0 +1,61 @@
+from flask import Blueprint, render_template, url_for, flash, redirect, request, abort, current_app, jsonify
+from flask_login import current_user, login_required
+from app import db, csrf
+from app.models import Order, PaymentTransaction
+from app.utils import payments
+
+payments_bp = Blueprint('payments', __name__, url_prefix='/payments')
+
+
+@payments_bp.route('/webhook', methods=['POST'])
+@csrf.exempt
+def webhook():
+    """Receive payment results from the gateway (signed, applied at most once)."""
+    try:
+        status, result = payments.process_webhook(request.get_data(),
+                                                  request.headers.get(payments.SIGNATURE_HEADER, ''))
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error processing payment webhook: {str(e)}")
+        # The gateway delivers it again later
+        return jsonify(result='error'), 500
+    return jsonify(result=result), status
+
+
+@payments_bp.route('/mock/<code>', methods=['GET', 'POST'])
+@login_required
+def mock_checkout(code):
+    """Checkout page of the local mock gateway."""
+    # Anyone could pay for free here: never served in production
+    if not (current_app.debug or current_app.testing):
+        abort(404)
+    gateway = payments.get_gateway()
+    if not isinstance(gateway, payments.MockGateway):
+        abort(404)
+
+    transaction = PaymentTransaction.query.filter_by(TransactionCode=code).first_or_404()
+    order = Order.query.get_or_404(transaction.OrderID)
+    if order.UserID != current_user.UserID:
+        abort(403)
+
+    if request.method == 'POST':
+        outcome = payments.SUCCEEDED if request.form.get('action') == 'pay' else payments.FAILED
+        # Delivered like a provider would, through the signature check of the webhook
+        body, signature = gateway.webhook(transaction, outcome)
+        try:
+            status, result = payments.process_webhook(body, signature)
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error processing mock payment: {str(e)}")
+            status, result = 500, 'error'
+
+        if status == 200 and result in ('applied', 'duplicate') and outcome == payments.SUCCEEDED:
+            flash('Thanh toán thành công! Bạn có thể tải sách ngay bây giờ.', 'success')
+        elif outcome == payments.FAILED:
+            flash('Thanh toán đã bị hủy. Bạn có thể thanh toán lại từ trang đơn hàng.', 'warning')
+        else:
+            flash('Không thể xác nhận thanh toán. Vui lòng thử lại.', 'danger')
+        return redirect(url_for('user.order_detail', order_id=order.OrderID))
+
+    return render_template('payments/mock_checkout.html', title='Cổng thanh toán thử nghiệm',
+                           transaction=transaction, order=order)
@@ -0,0 +1,38 @@
+from flask import Blueprint, Response, abort, request
+from app.utils.storage import get_storage, LocalStorage
+
+storage_bp = Blueprint('storage', __name__, url_prefix='/files')
+
+
+@storage_bp.route('/<path:public_id>')
+def serve_file(public_id):
+    """Serve a locally stored asset, honouring HTTP Range requests."""
+    storage = get_storage()
+    if not isinstance(storage, LocalStorage):
+        abort(404)
+
+    info = storage.stat(public_id)
+    if info is None:
+        abort(404)
+
+    size = info['size']
+    start, end, status = 0, size, 200
+    if request.range is not None:
+        bounds = request.range.range_for_length(size)
+        if bounds is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+        start, end = bounds
+        status = 206
+
+    # WSGI servers only take bytes: the one copy of each chunk, straight from the page cache
+    chunks = (bytes(chunk) for chunk in storage.stream_range(public_id, start, end))
+    response = Response(chunks, status=status,
+                        mimetype=info['content_type'], direct_passthrough=True)
+    response.content_length = end - start
+    response.accept_ranges = 'bytes'
+    if status == 206:
+        response.headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    response.last_modified = info['modified']
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response
@@ -4,11 +4,13 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, TextAreaField, SubmitField
 from wtforms.validators import DataRequired, Email, Length, Optional
 from app import db
-from app.models import User, Order, OrderDetail, Book, PaymentTransaction
+from app.models import User, Order, OrderDetail, PaymentTransaction
+from app.utils import entity_cache
+from app.utils.metrics import metrics
+from app.utils import rankings
+from app.utils import payments
 from sqlalchemy import desc
 from datetime import datetime, timezone
-import secrets
-import string
 
 user_bp = Blueprint('user', __name__)
 
@@ -113,12 +115,18 @@ def download_book(order_detail_id):
             abort(403)
 
         # Update download status
+        first_download = not order_detail.DownloadStatus
         order_detail.DownloadStatus = True
         order_detail.DownloadDate = datetime.now(timezone.utc)
         db.session.commit()
+        metrics.inc('downloads_total')
 
         # Get book
-        book = Book.query.get(order_detail.BookID)
+        book = entity_cache.books.get(order_detail.BookID)
+
+        # Only the first download of a purchase counts towards the rankings
+        if first_download:
+            rankings.record_event(book, rankings.DOWNLOAD)
 
         # Redirect to the book file
         return redirect(book.FilePath)
@@ -133,7 +141,7 @@ def download_book(order_detail_id):
 @login_required
 def buy_book(book_id):
     """Purchase a book."""
-    book = Book.query.get_or_404(book_id)
+    book = entity_cache.books.get_or_404(book_id)
 
     # Check if user has already purchased this book
     existing_purchase = OrderDetail.query.join(Order).filter(
@@ -150,61 +158,81 @@ def buy_book(book_id):
         try:
             payment_method = request.form.get('payment_method')
 
-            # Convert book price to float for SQL Server compatibility
-            book_price = float(book.Price)
-
-            # Create new order
-            order = Order(
-                UserID=current_user.UserID,
-                OrderDate=datetime.now(timezone.utc),
-                TotalAmount=book_price,
-                PaymentMethod=payment_method,
-                PaymentStatus=False,
-                OrderStatus='Chờ thanh toán'
-            )
-
-            db.session.add(order)
-            db.session.commit()
-
-            # Create order detail
-            order_detail = OrderDetail(
-                OrderID=order.OrderID,
-                BookID=book_id,
-                Price=book_price,
-                DownloadStatus=False
-            )
-
-            db.session.add(order_detail)
-
-            # Generate transaction code
-            transaction_code = ''.join(secrets.choice(string.ascii_uppercase + string.digits) for _ in range(12))
-
-            # Create payment transaction
-            transaction = PaymentTransaction(
-                OrderID=order.OrderID,
-                Amount=book_price,
-                PaymentMethod=payment_method,
-                TransactionDate=datetime.now(timezone.utc),
-                TransactionCode=transaction_code,
-                Status='Đang xử lý'
-            )
-
-            db.session.add(transaction)
-            db.session.commit()
+            # Resume a checkout of this book still waiting for its payment
+            transaction = PaymentTransaction.query.join(
+                Order, PaymentTransaction.OrderID == Order.OrderID
+            ).join(OrderDetail, OrderDetail.OrderID == Order.OrderID).filter(
+                Order.UserID == current_user.UserID,
+                Order.OrderStatus == payments.ORDER_AWAITING_PAYMENT,
+                OrderDetail.BookID == book_id,
+                PaymentTransaction.Status == payments.TRANSACTION_PENDING
+            ).first()
 
-            # For demonstration purposes, automatically approve the payment
-            # In a real application, you would integrate with payment gateways
-            order.PaymentStatus = True
-            order.OrderStatus = 'Hoàn thành'
-            transaction.Status = 'Thành công'
-            db.session.commit()
+            if transaction is None:
+                # Convert book price to float for SQL Server compatibility
+                book_price = float(book.Price)
+
+                # Create new order, completed once the gateway reports the payment
+                order = Order(
+                    UserID=current_user.UserID,
+                    OrderDate=datetime.now(timezone.utc),
+                    TotalAmount=book_price,
+                    PaymentMethod=payment_method,
+                    PaymentStatus=False,
+                    OrderStatus=payments.ORDER_AWAITING_PAYMENT
+                )
+
+                db.session.add(order)
+                db.session.flush()
+
+                # Create order detail
+                order_detail = OrderDetail(
+                    OrderID=order.OrderID,
+                    BookID=book_id,
+                    Price=book_price,
+                    DownloadStatus=False
+                )
+
+                db.session.add(order_detail)
+                transaction = payments.new_transaction(order, payment_method)
+                db.session.commit()
 
-            flash('Thanh toán thành công! Bạn có thể tải sách ngay bây giờ.', 'success')
-            return redirect(url_for('user.order_detail', order_id=order.OrderID))
+            return redirect(payments.get_gateway().checkout_url(transaction))
 
         except Exception as e:
             db.session.rollback()
             current_app.logger.error(f"Error buying book: {str(e)}")
             flash('Có lỗi xảy ra khi mua sách. Vui lòng thử lại.', 'danger')
 
-    return render_template('user/buy_book.html', title=f'Mua sách: {book.Title}', book=book)
\ No newline at end of file
+    return render_template('user/buy_book.html', title=f'Mua sách: {book.Title}', book=book)
+
+@user_bp.route('/order/<int:order_id>/pay', methods=['POST'])
+@login_required
+def pay_order(order_id):
+    """Pay an order still awaiting its payment."""
+    order = Order.query.get_or_404(order_id)
+
+    if order.UserID != current_user.UserID:
+        abort(403)
+
+    if order.OrderStatus != payments.ORDER_AWAITING_PAYMENT:
+        flash('Đơn hàng này không thể thanh toán.', 'warning')
+        return redirect(url_for('user.order_detail', order_id=order_id))
+
+    try:
+        transaction = PaymentTransaction.query.filter_by(
+            OrderID=order_id, Status=payments.TRANSACTION_PENDING
+        ).first()
+
+        # A failed payment can be tried again with a new transaction
+        if transaction is None:
+            transaction = payments.new_transaction(order, order.PaymentMethod)
+            db.session.commit()
+
+        return redirect(payments.get_gateway().checkout_url(transaction))
+
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error paying order: {str(e)}")
+        flash('Có lỗi xảy ra khi thanh toán. Vui lòng thử lại.', 'danger')
+        return redirect(url_for('user.order_detail', order_id=order_id))
@@ -0,0 +1,413 @@
+"""
+Content-addressed registry of uploaded assets.
+
+Uploads are hashed (SHA-256) while the request body is received (see
+:mod:`app.utils.uploads`), before anything is sent to Cloudinary. When the
+hash is already registered in the ``Assets`` table the existing URL is
+reused and no network I/O happens at all.
+
+Every asset keeps a reference count of the books pointing at it. The counts
+are maintained from the ORM flush (new, edited and deleted books), and an
+asset is only deleted from Cloudinary once its count drops to zero and the
+transaction that released it has been committed.
+
+Storing a file takes a reference right away, with a conditional increment
+that fails on a count of zero (an asset being released), so an asset being
+reused cannot be deleted meanwhile. The reference is taken, or the new
+upload registered, in a short transaction of its own committed at once:
+no registry row stays locked while files are uploaded, and the request's
+own session is not touched (nor flushed) by ``store_*``. The book pointing
+at the asset claims that reference when it is flushed; references left
+unclaimed when the request's transaction commits are released, and all of
+them when it is rolled back. A worker dying in between keeps its
+references, and the asset is kept. Rows left at zero (registered before
+references were taken on upload) are removed by :func:`sweep_unreferenced`
+once ``ASSET_ORPHAN_GRACE`` has passed.
+"""
+import hashlib
+import json
+import os
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event, inspect, insert, update, delete, select, exists, or_
+from sqlalchemy.exc import IntegrityError
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
+
+from app import db
+from app.models import Asset, Book
+from app.utils.cloudinary_utils import upload_file, delete_assets
+from app.utils.db_routing import RoutingSession
+from app.utils.image_utils import process_cover_upload, COVER_VARIANTS, VARIANT_FORMATS
+from app.utils.metrics import metrics
+from app.utils.pdf_ingest import render_preview
+from app.utils.storage import get_storage
+from app.utils.uploads import HashingStream
+
+HASH_CHUNK_SIZE = 64 * 1024
+PENDING_DELETIONS_KEY = 'asset_deletions'
+# References taken by store_* and not claimed by a book yet (URL -> count)
+RESERVED_KEY = 'asset_references'
+# References claimed by the books flushed in the transaction (URL -> count)
+CLAIMED_KEY = 'asset_claimed_references'
+# Stay well below SQL Server's limit of 2100 parameters per statement
+URL_CHUNK_SIZE = 500
+
+
+def hash_upload(file):
+    """
+    Return the SHA-256 of an uploaded file without reading it into memory.
+
+    Files received by :class:`app.utils.uploads.UploadRequest` were hashed as
+    they arrived; other files are read chunk by chunk.
+
+    Returns:
+        tuple: (hex digest, size in bytes); the stream is rewound afterwards
+    """
+    stream = getattr(file, 'stream', file)
+    if isinstance(stream, HashingStream):
+        hashed = stream.hashed()
+        if hashed:
+            return hashed
+    stream.seek(0)
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    stream.seek(0)
+    return digest.hexdigest(), size
+
+
+def _reserve(url):
+    # The session's transaction is begun (without connecting) so that its end,
+    # even a rollback before anything was flushed, gives the reference back
+    session = db.session()
+    if not session.in_transaction():
+        session.begin()
+    session.info.setdefault(RESERVED_KEY, Counter())[url] += 1
+
+
+def _take_reference(content_hash, resource_type):
+    """
+    Take a reference to a registered asset, unless it is being released.
+
+    The increment only applies to a count above zero: an asset whose count
+    dropped to zero is deleted by the transaction that released it, and a
+    new upload is needed. It is committed at once, see the module docstring.
+
+    Returns:
+        Row: ``URL`` and ``Meta`` of the asset, or None if it is not
+        registered (or being released)
+    """
+    match = (Asset.ContentHash == content_hash, Asset.ResourceType == resource_type)
+    with db.engine.begin() as connection:
+        taken = connection.execute(
+            update(Asset).where(*match, Asset.RefCount > 0).values(RefCount=Asset.RefCount + 1)
+        ).rowcount
+        if not taken:
+            return None
+        asset = connection.execute(select(Asset.URL, Asset.Meta).where(*match)).one()
+    _reserve(asset.URL)
+    return asset
+
+
+def _register(content_hash, resource_type, size, url, public_id, meta=None):
+    """
+    Insert a registry row holding one reference to a new upload, committed at once.
+
+    When a concurrent upload of the same content registered it first, a
+    reference to that asset is taken instead and our copy is deleted right
+    away: nothing points at it yet, and an unregistered copy would never be
+    deleted.
+
+    Returns:
+        Row: ``URL`` and ``Meta`` of the registered asset (ours or the
+        concurrent one), or None when the concurrent one is being released
+        (the upload failed)
+    """
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(insert(Asset).values(
+                ContentHash=content_hash, ResourceType=resource_type, Size=size, URL=url, PublicID=public_id,
+                Meta=json.dumps(meta) if meta else None, RefCount=1))
+            asset = connection.execute(select(Asset.URL, Asset.Meta).where(
+                Asset.ContentHash == content_hash, Asset.ResourceType == resource_type)).one()
+    except IntegrityError:
+        existing = _take_reference(content_hash, resource_type)
+        _discard(_asset_files(public_id, resource_type, meta))
+        return existing
+    _reserve(url)
+    return asset
+
+
+def _asset_files(public_id, resource_type, meta):
+    """Return ``(public_id, resource_type)`` of an asset and of its cover variants if any."""
+    files = [(public_id, resource_type)]
+    if resource_type == 'image' and meta and meta.get('CoverVariants'):
+        files.extend((f'{public_id}_{name}_{image_format}', 'image')
+                     for name in COVER_VARIANTS for image_format in VARIANT_FORMATS)
+    return files
+
+
+def _discard(files):
+    """Delete ``(public_id, resource_type)`` files that no book and no registry row points at anymore."""
+    by_type = defaultdict(list)
+    for public_id, resource_type in files:
+        by_type[resource_type].append(public_id)
+    for resource_type, public_ids in by_type.items():
+        if not delete_assets(public_ids, resource_type=resource_type):
+            current_app.logger.warning(f"{len(public_ids)} unused {resource_type} assets could not be deleted")
+
+
+def _cover_values(asset):
+    meta = json.loads(asset.Meta) if asset.Meta else {}
+    return {
+        'CoverImage': asset.URL,
+        'CoverVariants': meta.get('CoverVariants'),
+        'CoverPlaceholder': meta.get('CoverPlaceholder'),
+    }
+
+
+def store_cover(file):
+    """
+    Store a cover image, reusing an identical one that was uploaded before.
+
+    Returns:
+        dict: ``CoverImage``, ``CoverVariants`` and ``CoverPlaceholder`` values
+        for the book, or None if the upload failed
+    """
+    content_hash, size = hash_upload(file)
+    asset = _take_reference(content_hash, 'image')
+    if asset:
+        return _cover_values(asset)
+
+    cover = process_cover_upload(file)
+    if not cover:
+        return None
+    asset = _register(content_hash, 'image', size, cover['CoverImage'], cover['PublicID'],
+                      meta={'CoverVariants': cover['CoverVariants'], 'CoverPlaceholder': cover['CoverPlaceholder']})
+    return _cover_values(asset) if asset else None
+
+
+def store_preview_cover(book_file):
+    """
+    Store the first page of a book file (PDF) as its cover.
+
+    Returns:
+        dict: Same as :func:`store_cover`, or None if the page could not be
+        rendered or uploaded
+    """
+    with metrics.timer('pdf_ingest_duration_seconds', step='preview'):
+        preview = render_preview(book_file)
+    if preview is None:
+        return None
+    stem = os.path.splitext(secure_filename(getattr(book_file, 'filename', None) or '') or 'book')[0]
+    return store_cover(FileStorage(preview, filename=f'{stem}_cover.jpg', content_type='image/jpeg'))
+
+
+def store_book_file(file, meta=None):
+    """
+    Store a book file (PDF), reusing an identical one that was uploaded before.
+
+    Args:
+        file: The uploaded file
+        meta: What was read from the PDF (page count, title...), kept in the registry
+
+    Returns:
+        str: The file URL, or None if the upload failed
+    """
+    content_hash, size = hash_upload(file)
+    asset = _take_reference(content_hash, 'raw')
+    if asset:
+        return asset.URL
+
+    result = upload_file(file)
+    if not result:
+        return None
+    asset = _register(content_hash, 'raw', size, result['secure_url'], result['public_id'], meta=meta)
+    return asset.URL if asset else None
+
+
+def _change_refcount(db_session, url, delta):
+    if not url:
+        return
+    db_session.execute(update(Asset).where(Asset.URL == url).values(RefCount=Asset.RefCount + delta))
+    if delta > 0:
+        return
+
+    _queue_deletions(db_session, _drop_released(db_session, [url]))
+
+
+def _drop_released(connection, urls):
+    """
+    Remove registry rows of the given URLs whose count reached zero.
+
+    Returns:
+        list: ``(public_id, resource_type)`` of the files to delete once the
+        transaction is committed
+    """
+    rows = connection.execute(
+        select(Asset.AssetID, Asset.PublicID, Asset.ResourceType, Asset.Meta)
+        .where(Asset.URL.in_(urls), Asset.RefCount <= 0)
+    ).all()
+    if not rows:
+        return []
+
+    connection.execute(delete(Asset).where(Asset.AssetID.in_([row.AssetID for row in rows])))
+    files = []
+    for row in rows:
+        files.extend(_asset_files(row.PublicID, row.ResourceType, json.loads(row.Meta) if row.Meta else None))
+    return files
+
+
+def _queue_deletions(db_session, files):
+    """Delete ``files`` after the transaction of ``db_session`` commits."""
+    if files:
+        db_session.info.setdefault(PENDING_DELETIONS_KEY, []).extend(files)
+
+
+def _release_references(counts):
+    """Give back references taken by ``store_*`` (URL -> count) in a short transaction of their own."""
+    counts = {url: count for url, count in counts.items() if count > 0}
+    if not counts:
+        return
+    with db.engine.begin() as connection:
+        for url, count in counts.items():
+            connection.execute(update(Asset).where(Asset.URL == url).values(RefCount=Asset.RefCount - count))
+        files = _drop_released(connection, list(counts))
+    _discard(files)
+
+
+def release_urls(db_session, urls):
+    """
+    Release one reference per URL, for books removed with set-based statements.
+
+    Must run after the books are deleted. Registered assets reaching zero
+    references are queued for deletion; unregistered (older) uploads are
+    queued when no remaining book points at them anymore.
+
+    Args:
+        db_session: The session whose transaction deleted the books
+        urls: Cover and file URLs of the deleted books, repeated once per book
+    """
+    counts = Counter(url for url in urls if url)
+    urls_by_count = defaultdict(list)
+    for url, count in counts.items():
+        urls_by_count[count].append(url)
+
+    registered = set()
+    for count, group in urls_by_count.items():
+        for start in range(0, len(group), URL_CHUNK_SIZE):
+            chunk = group[start:start + URL_CHUNK_SIZE]
+            db_session.execute(update(Asset).where(Asset.URL.in_(chunk)).values(RefCount=Asset.RefCount - count))
+            registered.update(db_session.execute(select(Asset.URL).where(Asset.URL.in_(chunk))).scalars())
+            _queue_deletions(db_session, _drop_released(db_session, chunk))
+
+    unregistered = [url for url in counts if url not in registered]
+    storage = get_storage()
+    for start in range(0, len(unregistered), URL_CHUNK_SIZE):
+        chunk = unregistered[start:start + URL_CHUNK_SIZE]
+        still_used = set(db_session.execute(select(Book.CoverImage).where(Book.CoverImage.in_(chunk))).scalars())
+        still_used.update(db_session.execute(select(Book.FilePath).where(Book.FilePath.in_(chunk))).scalars())
+        locations = (storage.locate(url) for url in chunk if url not in still_used)
+        _queue_deletions(db_session, [location for location in locations if location])
+
+
+def _add_reference(db_session, url):
+    """Count a book pointing at ``url``, claiming the reference taken when it was stored if any."""
+    reserved = db_session.info.get(RESERVED_KEY)
+    if reserved and reserved[url] > 0:
+        reserved[url] -= 1
+        db_session.info.setdefault(CLAIMED_KEY, Counter())[url] += 1
+        return
+    _change_refcount(db_session, url, 1)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def _track_book_assets(db_session, flush_context, instances):
+    """Keep asset reference counts in step with the books pointing at them."""
+    for book in db_session.new:
+        if isinstance(book, Book):
+            _add_reference(db_session, book.CoverImage)
+            _add_reference(db_session, book.FilePath)
+
+    for book in db_session.dirty:
+        if not isinstance(book, Book):
+            continue
+        state = inspect(book)
+        for attribute in ('CoverImage', 'FilePath'):
+            history = state.attrs[attribute].history
+            if not history.has_changes():
+                continue
+            for url in history.added:
+                _add_reference(db_session, url)
+            for url in history.deleted:
+                _change_refcount(db_session, url, -1)
+
+    for book in db_session.deleted:
+        if isinstance(book, Book):
+            _change_refcount(db_session, book.CoverImage, -1)
+            _change_refcount(db_session, book.FilePath, -1)
+
+
+@event.listens_for(RoutingSession, 'before_commit')
+def _release_unclaimed_references(db_session):
+    """Give back the references of stored files that no book ended up using."""
+    if not db_session.info.get(RESERVED_KEY):
+        db_session.info.pop(CLAIMED_KEY, None)
+        return
+    # Books still waiting for the flush claim their references first
+    db_session.flush()
+    db_session.info.pop(CLAIMED_KEY, None)
+    for url, count in db_session.info.pop(RESERVED_KEY, Counter()).items():
+        if count > 0:
+            _change_refcount(db_session, url, -count)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _delete_released_assets(db_session):
+    _discard(db_session.info.pop(PENDING_DELETIONS_KEY, []))
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _release_uncommitted(db_session, transaction):
+    """Forget what a transaction that did not commit released, and give back what it reserved."""
+    # Savepoints rolled back keep the outer transaction's state
+    if transaction.parent is not None:
+        return
+    db_session.info.pop(PENDING_DELETIONS_KEY, None)
+    # Left only when the transaction was not committed: the references were
+    # committed on their own when the files were stored
+    references = db_session.info.pop(RESERVED_KEY, Counter())
+    references.update(db_session.info.pop(CLAIMED_KEY, Counter()))
+    _release_references(references)
+
+
+def sweep_unreferenced(grace=None, now=None):
+    """
+    Remove registry rows that no book references, and queue their deletion.
+
+    Rows at zero are normally removed by the transaction releasing them; the
+    ones left behind (an upload whose book was never saved, rows registered
+    before references were taken on upload) are removed once they are older
+    than ``grace`` seconds (``ASSET_ORPHAN_GRACE``). Rows a book still points
+    at are kept.
+
+    Returns:
+        int: Number of rows removed; the assets are deleted after the commit
+    """
+    if grace is None:
+        grace = current_app.config.get('ASSET_ORPHAN_GRACE', 86400)
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=grace)
+    in_use = exists().where(or_(Book.CoverImage == Asset.URL, Book.FilePath == Asset.URL))
+    urls = db.session.execute(
+        select(Asset.URL).where(Asset.RefCount <= 0, ~in_use,
+                               or_(Asset.CreatedDate < cutoff, Asset.CreatedDate.is_(None)))
+    ).scalars().all()
+    for start in range(0, len(urls), URL_CHUNK_SIZE):
+        _queue_deletions(db.session, _drop_released(db.session, urls[start:start + URL_CHUNK_SIZE]))
+    db.session.commit()
+    return len(urls)
@@ -0,0 +1,208 @@
+"""
+In-memory prefix index for search-box suggestions.
+
+Titles, authors and category names are folded (lowercase, Vietnamese
+diacritics removed) and every word-starting suffix is stored in one sorted
+array, so "nha gia kim" and "gia kim" both match "Nhà giả kim". A lookup is
+a binary search plus a short scan; the best suggestions of every prefix of
+up to ``PRECOMPUTED_PREFIX_LENGTH`` characters are computed at build time
+because those ranges are too wide to scan per keystroke.
+
+Suggestions are ranked by popularity (number of purchases). The index is
+immutable and rebuilt in a background thread when the invalidation bus
+announces changed books or categories (from any worker), or once it is
+older than ``AUTOCOMPLETE_MAX_AGE`` (new purchases); lookups never touch
+the database. Only the first lookup of a worker waits for the index to be
+built; when that build fails, lookups return no suggestions until a
+background rebuild succeeds.
+"""
+import heapq
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+
+from flask import current_app
+from sqlalchemy import func
+
+from app import db
+from app.models import Book, Category, OrderDetail
+from app.utils.invalidation import bus
+
+SOURCE_TAGS = ('book:*', 'category:*')
+PRECOMPUTED_PREFIX_LENGTH = 3
+MAX_SCAN = 2000
+DEFAULT_LIMIT = 10
+
+
+def fold(text):
+    """Lowercase ``text`` and strip its diacritics ("Đắc Nhân Tâm" -> "dac nhan tam")."""
+    text = unicodedata.normalize('NFD', (text or '').lower().replace('đ', 'd'))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.split())
+
+
+class PrefixIndex:
+    """Immutable sorted-array index of suggestion keys."""
+
+    def __init__(self, entries, limit=DEFAULT_LIMIT):
+        """
+        Args:
+            entries: ``(kind, target, label, weight)`` tuples; ``kind`` is
+                book, author or category and ``target`` identifies what a
+                suggestion links to
+            limit: Number of suggestions precomputed for short prefixes
+        """
+        self.entries = list(entries)
+        self.limit = limit
+        self.built = time.monotonic()
+
+        keys = []
+        for entry_id, (_, _, label, _) in enumerate(self.entries):
+            words = fold(label).split(' ')
+            for start in range(len(words)):
+                keys.append((' '.join(words[start:]), entry_id))
+        keys.sort()
+        self.keys = [key for key, _ in keys]
+        self.entry_ids = [entry_id for _, entry_id in keys]
+
+        # Best entries of every short prefix, best first
+        top = {}
+        for key, entry_id in keys:
+            weight = self.entries[entry_id][3]
+            for length in range(1, min(len(key), PRECOMPUTED_PREFIX_LENGTH) + 1):
+                heap = top.setdefault(key[:length], [])
+                if entry_id in (item[1] for item in heap):
+                    continue
+                if len(heap) < limit:
+                    heapq.heappush(heap, (weight, entry_id))
+                elif weight > heap[0][0]:
+                    heapq.heapreplace(heap, (weight, entry_id))
+        self.top = {prefix: [entry_id for _, entry_id in sorted(heap, reverse=True)] for prefix, heap in top.items()}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def suggest(self, query, limit=DEFAULT_LIMIT):
+        """Return the ``(kind, target, label)`` of the most popular entries matching ``query``."""
+        prefix = fold(query)
+        if not prefix:
+            return []
+
+        if len(prefix) <= PRECOMPUTED_PREFIX_LENGTH and limit <= self.limit:
+            entry_ids = self.top.get(prefix, [])[:limit]
+        else:
+            candidates = set()
+            position = bisect_left(self.keys, prefix)
+            end = min(position + MAX_SCAN, len(self.keys))
+            while position < end and self.keys[position].startswith(prefix):
+                candidates.add(self.entry_ids[position])
+                position += 1
+            entry_ids = heapq.nlargest(limit, candidates, key=lambda entry_id: self.entries[entry_id][3])
+
+        return [self.entries[entry_id][:3] for entry_id in entry_ids]
+
+
+def build_entries():
+    """Load the suggestion entries of active books, authors and categories."""
+    purchases = func.count(OrderDetail.OrderDetailID)
+    rows = db.session.query(Book.BookID, Book.Title, Book.Author, Book.CategoryID, purchases) \
+        .outerjoin(OrderDetail, OrderDetail.BookID == Book.BookID) \
+        .filter(Book.Status == True) \
+        .group_by(Book.BookID, Book.Title, Book.Author, Book.CategoryID) \
+        .all()
+
+    entries = []
+    author_weights, category_weights = {}, {}
+    for book_id, title, author, category_id, count in rows:
+        # Unsold books still get a small weight so they can be suggested
+        weight = count + 1
+        entries.append(('book', book_id, title, weight))
+        if author:
+            author_weights[author] = author_weights.get(author, 0) + weight
+        if category_id is not None:
+            category_weights[category_id] = category_weights.get(category_id, 0) + weight
+
+    entries.extend(('author', author, author, weight) for author, weight in author_weights.items())
+    for category_id, name in db.session.query(Category.CategoryID, Category.CategoryName).filter(Category.Status == True):
+        entries.append(('category', category_id, name, category_weights.get(category_id, 0)))
+    return entries
+
+
+class Autocomplete:
+    """Holds the current index and rebuilds it in the background."""
+
+    def __init__(self):
+        self._index = None
+        self._lock = threading.Lock()
+        self._building = False
+        self._stale = False
+        # Failed rebuilds in a row, and when the next one may start (time.monotonic)
+        self._failures = 0
+        self._retry_at = 0.0
+
+    def suggest(self, query, limit=DEFAULT_LIMIT):
+        index = self._index
+        if index is None and not self._failures:
+            # Only the very first lookup of a worker waits for the build
+            with self._lock:
+                if self._index is None and not self._failures:
+                    try:
+                        self._build()
+                    except Exception as e:
+                        # Left to the background rebuild, as when a later rebuild fails
+                        db.session.rollback()
+                        self._failed(current_app, e)
+                index = self._index
+        if (index is None or self._stale
+                or time.monotonic() - index.built > current_app.config.get('AUTOCOMPLETE_MAX_AGE', 300)) \
+                and time.monotonic() >= self._retry_at:
+            self._rebuild_async()
+        # No suggestions until an index could be built
+        return index.suggest(query, limit) if index is not None else []
+
+    def invalidate(self, tags=None):
+        """Mark the index outdated, it is rebuilt on the next lookup."""
+        self._stale = True
+
+    def _rebuild_async(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+            self._stale = False
+        app = current_app._get_current_object()
+        threading.Thread(target=self._rebuild, args=(app,), name='autocomplete-rebuild', daemon=True).start()
+
+    def _build(self):
+        since = bus.sequence()
+        self._index = PrefixIndex(build_entries())
+        # Built from data that may predate a change announced meanwhile: build again
+        if bus.changed_since(SOURCE_TAGS, since):
+            self._stale = True
+        self._failures = 0
+        self._retry_at = 0.0
+
+    def _failed(self, app, error):
+        # Kept stale, but retried after a delay doubling with every failure (up to AUTOCOMPLETE_MAX_AGE)
+        # rather than by every lookup
+        self._stale = True
+        self._failures += 1
+        delay = min(app.config.get('AUTOCOMPLETE_RETRY_DELAY', 5) * 2 ** (self._failures - 1),
+                    app.config.get('AUTOCOMPLETE_MAX_AGE', 300))
+        self._retry_at = time.monotonic() + delay
+        app.logger.error(f"Error building autocomplete index (retried in {delay:.0f} s): {str(error)}")
+
+    def _rebuild(self, app):
+        try:
+            with app.app_context():
+                self._build()
+        except Exception as e:
+            self._failed(app, e)
+        finally:
+            self._building = False
+
+
+autocomplete = Autocomplete()
+bus.subscribe('book', autocomplete.invalidate)
+bus.subscribe('category', autocomplete.invalidate)
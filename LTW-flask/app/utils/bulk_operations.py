@@ -0,0 +1,148 @@
+"""
+Set-based bulk operations on books.
+
+A selection is either an explicit list of book IDs or the admin book
+filters ("select all matching"). It is walked in chunks of
+``BULK_CHUNK_SIZE`` IDs in BookID order; every chunk is handled by a few
+set-based statements and committed on its own, so locks stay short and no
+statement comes near SQL Server's limit of 2100 parameters.
+"""
+from datetime import datetime, timezone
+
+from flask import current_app
+from sqlalchemy import delete, exists, func, select, update
+
+from app import db
+from app.models import Book, OrderDetail, Review
+from app.utils.asset_registry import release_urls
+from app.utils.invalidation import invalidate_on_commit, tag
+from app.utils.report_queries import book_filter_conditions
+
+FILTER_FIELDS = ('category', 'year', 'price', 'status', 'price_min', 'price_max', 'search')
+
+
+class BookSelection:
+    """The books a bulk operation applies to."""
+
+    def __init__(self, ids=None, filters=None):
+        self.ids = sorted(set(ids)) if ids is not None else None
+        self.filters = filters or {}
+
+    @classmethod
+    def from_form(cls, form):
+        """
+        Build a selection from a bulk action form.
+
+        ``select_all=1`` selects every book matching the ``filter_<name>``
+        fields sent with the form, otherwise ``book_ids`` holds comma
+        separated IDs.
+        """
+        if form.get('select_all') == '1':
+            return cls(filters={name: form.get(f'filter_{name}') for name in FILTER_FIELDS
+                                if form.get(f'filter_{name}')})
+        ids = [int(book_id) for book_id in form.get('book_ids', '').split(',') if book_id.strip().isdigit()]
+        return cls(ids=ids)
+
+    def count(self):
+        if self.ids is not None:
+            return len(self.ids)
+        return db.session.execute(
+            select(func.count(Book.BookID)).where(*book_filter_conditions(self.filters))
+        ).scalar()
+
+    def chunks(self, size):
+        """Yield the selected book IDs in ascending chunks of at most ``size``."""
+        if self.ids is not None:
+            for start in range(0, len(self.ids), size):
+                yield self.ids[start:start + size]
+            return
+
+        # Keyset pagination, rows changed by earlier chunks do not shift later ones
+        conditions = book_filter_conditions(self.filters)
+        last_id = 0
+        while True:
+            ids = db.session.execute(
+                select(Book.BookID).where(*conditions, Book.BookID > last_id).order_by(Book.BookID).limit(size)
+            ).scalars().all()
+            if not ids:
+                return
+            yield ids
+            last_id = ids[-1]
+
+
+def _report(job, done, total, message):
+    if job is not None:
+        job.progress(done, total, message)
+
+
+def update_status(selection, status, job=None):
+    """
+    Show or hide the selected books.
+
+    Args:
+        selection: The :class:`BookSelection` to update
+        status: The new ``Book.Status``
+        job: The background job to report progress to, if any
+
+    Returns:
+        dict: ``updated`` count and a ``message`` for the admin
+    """
+    total = selection.count()
+    processed = updated = 0
+    for chunk in selection.chunks(current_app.config.get('BULK_CHUNK_SIZE', 1000)):
+        result = db.session.execute(
+            update(Book).where(Book.BookID.in_(chunk))
+            .values(Status=status, UpdatedDate=datetime.now(timezone.utc))
+            .execution_options(synchronize_session=False)
+        )
+        # Set-based statements bypass the ORM events
+        invalidate_on_commit(db.session, *(tag('book', book_id) for book_id in chunk))
+        db.session.commit()
+        updated += result.rowcount
+        processed += len(chunk)
+        _report(job, processed, total, f'Đã cập nhật {updated} sách')
+
+    status_text = 'kích hoạt' if status else 'ẩn'
+    return {'updated': updated, 'message': f'Đã {status_text} {updated} sách!'}
+
+
+def delete_books(selection, job=None):
+    """
+    Delete the selected books that nobody has bought.
+
+    Books referenced by an order are skipped (one anti-join per chunk). The
+    reviews of deleted books go with them, and their covers and files are
+    released from the asset registry; assets no longer used by any book are
+    deleted in batches once the chunk is committed.
+
+    Args:
+        selection: The :class:`BookSelection` to delete
+        job: The background job to report progress to, if any
+
+    Returns:
+        dict: ``deleted`` and ``skipped`` counts and a ``message`` for the admin
+    """
+    total = selection.count()
+    processed = deleted = 0
+    ordered = exists().where(OrderDetail.BookID == Book.BookID)
+    for chunk in selection.chunks(current_app.config.get('BULK_CHUNK_SIZE', 1000)):
+        rows = db.session.execute(
+            select(Book.BookID, Book.CoverImage, Book.FilePath).where(Book.BookID.in_(chunk), ~ordered)
+        ).all()
+        if rows:
+            ids = [row.BookID for row in rows]
+            db.session.execute(delete(Review).where(Review.BookID.in_(ids)))
+            db.session.execute(delete(Book).where(Book.BookID.in_(ids)).execution_options(synchronize_session=False))
+            release_urls(db.session, [url for row in rows for url in (row.CoverImage, row.FilePath)])
+            invalidate_on_commit(db.session, *(tag('book', book_id) for book_id in ids))
+        db.session.commit()
+
+        deleted += len(rows)
+        processed += len(chunk)
+        _report(job, processed, total, f'Đã xóa {deleted} sách')
+
+    skipped = total - deleted
+    message = f'Đã xóa {deleted} sách!'
+    if skipped:
+        message += f' {skipped} sách không thể xóa vì đã có người mua.'
+    return {'deleted': deleted, 'skipped': skipped, 'message': message}
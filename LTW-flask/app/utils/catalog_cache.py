@@ -0,0 +1,118 @@
+"""
+Process caches of small reference data: the category tree and role names.
+
+Both are read on most requests (facets, category filters, admin checks) and
+change rarely, so every worker keeps an immutable copy. Committed changes
+of categories and roles reach every worker through the invalidation bus,
+which drops the copy; it is reloaded at the latest once it is older than
+``CATALOG_CACHE_SECONDS``.
+"""
+import threading
+import time
+
+from flask import current_app
+
+from app import db
+from app.models import Category, Role
+from app.utils.invalidation import bus
+
+
+class CategoryTree:
+    """Immutable snapshot of the categories."""
+
+    def __init__(self, rows):
+        """
+        Args:
+            rows: ``(CategoryID, CategoryName, ParentCategoryID, Status)`` tuples
+        """
+        self.rows = [(category_id, name, parent_id) for category_id, name, parent_id, _ in rows]
+        self.names = {category_id: name for category_id, name, _, _ in rows}
+        self.parents = {category_id: parent_id for category_id, _, parent_id, _ in rows}
+        self.active = {category_id for category_id, _, _, status in rows if status}
+        self.children = {}
+        self._lineages = {}
+        for category_id, name, parent_id, _ in sorted(rows, key=lambda row: row[1]):
+            self.children.setdefault(parent_id, []).append(category_id)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def descendants(self, category_id):
+        """The ID of a category followed by the IDs of all its descendants."""
+        ids, pending = [], [category_id]
+        while pending:
+            current = pending.pop()
+            if current in ids:
+                continue
+            ids.append(current)
+            pending.extend(self.children.get(current, []))
+        return ids
+
+    def lineage(self, category_id):
+        """The ID of a category followed by the IDs of its ancestors."""
+        if category_id not in self._lineages:
+            chain, current = [], category_id
+            while current is not None and current not in chain:
+                chain.append(current)
+                current = self.parents.get(current)
+            self._lineages[category_id] = chain
+        return self._lineages[category_id]
+
+
+class CatalogCache:
+    """Holds the current snapshots and reloads them when outdated."""
+
+    def __init__(self):
+        self._tree = None
+        self._roles = None
+        self._lock = threading.Lock()
+
+    def _fresh(self, entry):
+        return entry is not None and time.monotonic() - entry[0] <= current_app.config.get('CATALOG_CACHE_SECONDS', 300)
+
+    def category_tree(self):
+        """Return the current :class:`CategoryTree`."""
+        entry = self._tree
+        if not self._fresh(entry):
+            with self._lock:
+                entry = self._tree
+                if not self._fresh(entry):
+                    since = bus.sequence()
+                    rows = db.session.query(Category.CategoryID, Category.CategoryName,
+                                            Category.ParentCategoryID, Category.Status).all()
+                    entry = (time.monotonic(), CategoryTree([tuple(row) for row in rows]))
+                    # Not kept when a change was announced while loading
+                    if not bus.changed_since(['category:*'], since):
+                        self._tree = entry
+        return entry[1]
+
+    def role_names(self):
+        """Return the role names by RoleID."""
+        entry = self._roles
+        if not self._fresh(entry):
+            with self._lock:
+                entry = self._roles
+                if not self._fresh(entry):
+                    since = bus.sequence()
+                    entry = (time.monotonic(), dict(db.session.query(Role.RoleID, Role.RoleName).all()))
+                    if not bus.changed_since(['role:*'], since):
+                        self._roles = entry
+        return entry[1]
+
+    def invalidate(self):
+        """Drop the snapshots of this worker, they are reloaded on next use."""
+        self._tree = None
+        self._roles = None
+
+    def invalidate_categories(self, tags):
+        """Bus callback: any changed category outdates the whole tree."""
+        self._tree = None
+
+    def invalidate_roles(self, tags):
+        """Bus callback for changed roles."""
+        self._roles = None
+
+
+catalog = CatalogCache()
+bus.subscribe('category', catalog.invalidate_categories)
+bus.subscribe('role', catalog.invalidate_roles)
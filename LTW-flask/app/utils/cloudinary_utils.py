@@ -1,6 +1,7 @@
-import cloudinary
-import cloudinary.uploader
 from flask import current_app
+from app.utils.metrics import metrics
+from app.utils.resilience import ServiceUnavailable
+from app.utils.storage import get_storage
 import os
 
 def upload_image(file, folder='img'):
@@ -18,16 +19,18 @@ def upload_image(file, folder='img'):
         if not file:
             return None
             
-        # Upload the file to Cloudinary
-        result = cloudinary.uploader.upload(
-            file,
-            folder=folder,
-            use_filename=True,
-            unique_filename=True
-        )
+        # Upload the file to the configured storage (Cloudinary by default)
+        with metrics.timer('cloudinary_request_duration_seconds', operation='upload_image'):
+            result = get_storage().put(file, folder=folder)
         
         return result
+    except ServiceUnavailable as e:
+        # Rejected at once (circuit open, too many calls in flight) or out of time
+        metrics.inc('cloudinary_errors_total', operation='upload_image', reason=e.reason)
+        current_app.logger.warning(f"Cloudinary unavailable, image not uploaded: {str(e)}")
+        return None
     except Exception as e:
+        metrics.inc('cloudinary_errors_total', operation='upload_image', reason='error')
         current_app.logger.error(f"Error uploading to Cloudinary: {str(e)}")
         return None
 
@@ -46,26 +49,54 @@ def upload_file(file, folder='book_files'):
         if not file:
             return None
             
-        # Upload the file to Cloudinary
-        result = cloudinary.uploader.upload(
-            file,
-            folder=folder,
-            resource_type="raw",
-            use_filename=True,
-            unique_filename=True
-        )
+        # Upload the file to the configured storage (Cloudinary by default)
+        with metrics.timer('cloudinary_request_duration_seconds', operation='upload_file'):
+            result = get_storage().put(file, folder=folder, resource_type="raw")
         
         return result
+    except ServiceUnavailable as e:
+        metrics.inc('cloudinary_errors_total', operation='upload_file', reason=e.reason)
+        current_app.logger.warning(f"Cloudinary unavailable, file not uploaded: {str(e)}")
+        return None
     except Exception as e:
+        metrics.inc('cloudinary_errors_total', operation='upload_file', reason='error')
         current_app.logger.error(f"Error uploading file to Cloudinary: {str(e)}")
         return None
 
-def delete_asset(public_id):
+def upload_image_variant(data, public_id, image_format):
+    """
+    Upload a generated image variant (resized cover) to Cloudinary.
+    
+    Args:
+        data: File-like object with the encoded image
+        public_id: The public ID to store the variant under
+        image_format: The image format of the data (webp, jpeg)
+        
+    Returns:
+        dict: Cloudinary upload response or None if upload failed
+    """
+    try:
+        # Variants are already encoded, keep them as they are
+        with metrics.timer('cloudinary_request_duration_seconds', operation='upload_image_variant'):
+            result = get_storage().put(data, public_id=public_id, image_format=image_format)
+        
+        return result
+    except ServiceUnavailable as e:
+        metrics.inc('cloudinary_errors_total', operation='upload_image_variant', reason=e.reason)
+        current_app.logger.warning(f"Cloudinary unavailable, image variant not uploaded: {str(e)}")
+        return None
+    except Exception as e:
+        metrics.inc('cloudinary_errors_total', operation='upload_image_variant', reason='error')
+        current_app.logger.error(f"Error uploading image variant to Cloudinary: {str(e)}")
+        return None
+
+def delete_asset(public_id, resource_type='image'):
     """
     Delete an asset from Cloudinary.
     
     Args:
         public_id: The public ID of the asset to delete
+        resource_type: The Cloudinary resource type (image, raw)
         
     Returns:
         dict: Cloudinary deletion response or None if deletion failed
@@ -74,10 +105,45 @@ def delete_asset(public_id):
         if not public_id:
             return None
             
-        # Delete the asset from Cloudinary
-        result = cloudinary.uploader.destroy(public_id)
+        # Delete the asset from the configured storage
+        with metrics.timer('cloudinary_request_duration_seconds', operation='delete_asset'):
+            result = get_storage().delete(public_id, resource_type=resource_type)
         
         return result
+    except ServiceUnavailable as e:
+        metrics.inc('cloudinary_errors_total', operation='delete_asset', reason=e.reason)
+        current_app.logger.warning(f"Cloudinary unavailable, asset not deleted: {str(e)}")
+        return None
     except Exception as e:
+        metrics.inc('cloudinary_errors_total', operation='delete_asset', reason='error')
         current_app.logger.error(f"Error deleting from Cloudinary: {str(e)}")
-        return None
\ No newline at end of file
+        return None
+
+def delete_assets(public_ids, resource_type='image'):
+    """
+    Delete several assets in as few requests as possible.
+    
+    Args:
+        public_ids: The public IDs of the assets to delete
+        resource_type: The Cloudinary resource type (image, raw)
+        
+    Returns:
+        dict: Cloudinary deletion response or None if deletion failed
+    """
+    try:
+        if not public_ids:
+            return None
+            
+        # Delete the assets from the configured storage in batches
+        with metrics.timer('cloudinary_request_duration_seconds', operation='delete_assets'):
+            result = get_storage().delete_many(public_ids, resource_type=resource_type)
+        
+        return result
+    except ServiceUnavailable as e:
+        metrics.inc('cloudinary_errors_total', operation='delete_assets', reason=e.reason)
+        current_app.logger.warning(f"Cloudinary unavailable, assets not deleted: {str(e)}")
+        return None
+    except Exception as e:
+        metrics.inc('cloudinary_errors_total', operation='delete_assets', reason='error')
+        current_app.logger.error(f"Error deleting from Cloudinary: {str(e)}")
+        return None
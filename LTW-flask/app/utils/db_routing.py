@@ -0,0 +1,159 @@
+"""
+Read/write splitting between the primary database and read replicas.
+
+Replica URLs from ``SQLALCHEMY_REPLICA_URIS`` are registered as the
+``replica_<n>`` binds. Views decorated with :func:`read_only` run their
+queries on a healthy replica; everything else, all flushes and every
+request that follows a commit by the same browser session within
+``READ_YOUR_WRITES_WINDOW`` seconds stay on the primary.
+
+Replica lag is measured with the ``ReplicaHeartbeats`` table: every
+measurement reads the heartbeat of the primary, then refreshes it. A replica
+that has received the beat read is up to date; otherwise its lag is the age
+of that beat. (The heartbeat is only written when measuring, so comparing
+with the current time would count the idle time since the last measurement
+as lag.) A replica lagging more than ``REPLICA_MAX_LAG`` seconds is skipped
+until it catches up.
+"""
+import random
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+
+from flask import current_app, g, has_request_context, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, select, update, insert
+
+REPLICA_BIND_PREFIX = 'replica_'
+PRIMARY_UNTIL_KEY = '_primary_until'
+
+
+def configure_replicas(app):
+    """Register the configured replica URLs as SQLAlchemy binds."""
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    for index, uri in enumerate(app.config.get('SQLALCHEMY_REPLICA_URIS') or []):
+        binds[f'{REPLICA_BIND_PREFIX}{index}'] = uri
+
+
+class RoutingSession(Session):
+    """Session sending reads of read-only views to the replica picked for the request."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not self.info.get('wrote') and has_request_context():
+            replica = g.get('db_replica')
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _mark_write(db_session, flush_context):
+    db_session.info['wrote'] = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _stick_to_primary(db_session):
+    if not db_session.info.pop('wrote', False) or not has_request_context():
+        return
+    # Read your own writes: this request and the next few go to the primary
+    g.db_replica = None
+    session[PRIMARY_UNTIL_KEY] = time.time() + current_app.config.get('READ_YOUR_WRITES_WINDOW', 5)
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _clear_write(db_session, transaction):
+    # A rolled back savepoint leaves the writes of the outer transaction
+    if transaction.parent is None:
+        db_session.info.pop('wrote', None)
+
+
+class ReplicaLagMonitor:
+    """Caches the measured lag of every replica for a short interval."""
+
+    def __init__(self):
+        self._lags = {}
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def healthy_replicas(self, db):
+        """Return the replica engines whose lag is within ``REPLICA_MAX_LAG``."""
+        config = current_app.config
+        if time.monotonic() - self._checked_at >= config.get('REPLICA_LAG_CHECK_INTERVAL', 2) \
+                and self._lock.acquire(blocking=False):
+            # One thread refreshes, the others keep using the previous result
+            try:
+                self._lags = self._measure(db)
+                self._checked_at = time.monotonic()
+            finally:
+                self._lock.release()
+
+        max_lag = config.get('REPLICA_MAX_LAG', 5)
+        return [engine for engine, lag in self._lags.items() if lag is not None and lag <= max_lag]
+
+    def _measure(self, db):
+        from app.models import ReplicaHeartbeat
+        table = ReplicaHeartbeat.__table__
+        replicas = [engine for key, engine in db.engines.items()
+                    if key and key.startswith(REPLICA_BIND_PREFIX)]
+        if not replicas:
+            return {}
+
+        try:
+            previous_beat, now = _beat(db.engines[None], table)
+        except Exception as e:
+            current_app.logger.error(f"Error writing replica heartbeat: {str(e)}")
+            return {}
+
+        lags = {}
+        for engine in replicas:
+            try:
+                with engine.connect() as connection:
+                    replica_beat = connection.execute(
+                        select(table.c.BeatDate).where(table.c.HeartbeatID == 1)
+                    ).scalar()
+                if replica_beat is None:
+                    lags[engine] = None
+                elif previous_beat is None or replica_beat >= previous_beat:
+                    lags[engine] = 0.0
+                else:
+                    # Missing a beat written that long ago
+                    lags[engine] = (now - previous_beat).total_seconds()
+            except Exception as e:
+                current_app.logger.warning(f"Replica {engine.url!r} unavailable: {str(e)}")
+                lags[engine] = None
+        return lags
+
+
+def _beat(engine, table):
+    """Refresh the heartbeat on the primary, return (its previous value or None, its new value)."""
+    now = datetime.utcnow()
+    with engine.begin() as connection:
+        previous = connection.execute(select(table.c.BeatDate).where(table.c.HeartbeatID == 1)).scalar()
+        updated = connection.execute(
+            update(table).where(table.c.HeartbeatID == 1).values(BeatDate=now)
+        ).rowcount
+        if not updated:
+            connection.execute(insert(table).values(HeartbeatID=1, BeatDate=now))
+    return previous, now
+
+
+lag_monitor = ReplicaLagMonitor()
+
+
+def read_only(f):
+    """
+    Decorator for views that only read, letting their queries go to a replica.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.db_replica = None
+        if PRIMARY_UNTIL_KEY in session and time.time() >= session[PRIMARY_UNTIL_KEY]:
+            session.pop(PRIMARY_UNTIL_KEY)
+        if PRIMARY_UNTIL_KEY not in session:
+            from app import db
+            replicas = lag_monitor.healthy_replicas(db)
+            if replicas:
+                g.db_replica = random.choice(replicas)
+        return f(*args, **kwargs)
+    return decorated_function
@@ -0,0 +1,159 @@
+"""
+Read-through cache of books and categories by primary key.
+
+Book pages, reviews, purchases and downloads all start with a primary key
+lookup of a row that rarely changes. :data:`books` and :data:`categories`
+keep compact read-only snapshots of those rows (plain ``__slots__``
+objects, never live ORM instances, so nothing is bound to a session) in a
+per-process LRU of ``ENTITY_CACHE_SIZES`` entries.
+
+Entries are evicted when the invalidation bus announces a change of their
+row (ORM updates and deletes, bulk operations; from any worker), and
+reloaded at the latest after ``ENTITY_CACHE_SECONDS``. Snapshots are read
+from the primary database, never from a possibly lagging replica, and a
+snapshot loaded while an invalidation of its row arrived is not kept.
+
+Write paths keep loading the ORM entity they modify.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import abort, current_app
+from sqlalchemy import select
+
+from app import db
+from app.models import Book, Category
+from app.utils.invalidation import bus, tag
+from app.utils.metrics import metrics
+from app.utils.rows import SlotsRow
+
+# Cached "no such row", so requests for missing IDs do not reach the database either
+MISSING = object()
+
+
+class CategorySnapshot(SlotsRow):
+    """A category row, with its parent resolved through the cache."""
+    __slots__ = ('CategoryID', 'CategoryName', 'Description', 'ParentCategoryID', 'Status')
+
+    @property
+    def parent(self):
+        return categories.get(self.ParentCategoryID) if self.ParentCategoryID is not None else None
+
+    def __repr__(self):
+        return f'<CategorySnapshot {self.CategoryName}>'
+
+
+class BookSnapshot(SlotsRow):
+    """A book row including its description, with its category resolved through the cache."""
+    __slots__ = ('BookID', 'Title', 'Author', 'Publisher', 'PublishYear', 'CategoryID', 'Description', 'Price',
+                 'CoverImage', 'CoverVariants', 'CoverPlaceholder', 'FilePath', 'PageCount', 'AddedDate',
+                 'UpdatedDate', 'Status')
+
+    @property
+    def category(self):
+        return categories.get(self.CategoryID) if self.CategoryID is not None else None
+
+    slug = Book.slug
+
+    def __repr__(self):
+        return f'<BookSnapshot {self.Title}>'
+
+
+class EntityCache:
+    """LRU of snapshots of one model, keyed by primary key."""
+
+    def __init__(self, model, snapshot_class, kind):
+        """
+        Args:
+            model: The mapped class whose rows are cached
+            snapshot_class: ``__slots__`` class built from the columns named by its slots
+            kind: Tag kind of the model on the invalidation bus
+        """
+        self.model = model
+        self.snapshot_class = snapshot_class
+        self.kind = kind
+        self._columns = [getattr(model, name) for name in snapshot_class.__slots__]
+        self._primary_key = model.__mapper__.primary_key[0]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def _max_size(self):
+        return current_app.config.get('ENTITY_CACHE_SIZES', {}).get(self.kind, 1000)
+
+    def get(self, entity_id):
+        """Return the snapshot of the row with primary key ``entity_id``, or None."""
+        entry = self._entries.get(entity_id)
+        if entry is not None and time.monotonic() - entry[0] <= current_app.config.get('ENTITY_CACHE_SECONDS', 600):
+            self.hits += 1
+            metrics.inc('entity_cache_requests_total', entity=self.kind, result='hit')
+            with self._lock:
+                if entity_id in self._entries:
+                    self._entries.move_to_end(entity_id)
+            return None if entry[1] is MISSING else entry[1]
+
+        self.misses += 1
+        metrics.inc('entity_cache_requests_total', entity=self.kind, result='miss')
+        since = bus.sequence()
+        row = db.session.execute(
+            select(*self._columns).where(self._primary_key == entity_id),
+            # The primary: a replica may not have the change that invalidated the entry yet
+            bind_arguments={'bind': db.engine}
+        ).first()
+        snapshot = self.snapshot_class(*row) if row is not None else None
+        if not bus.changed_since([tag(self.kind, entity_id)], since):
+            self._store(entity_id, MISSING if snapshot is None else snapshot)
+        return snapshot
+
+    def get_or_404(self, entity_id):
+        """Like :meth:`get`, aborting with 404 when the row does not exist."""
+        snapshot = self.get(entity_id)
+        if snapshot is None:
+            abort(404)
+        return snapshot
+
+    def _store(self, entity_id, snapshot):
+        max_size = self._max_size()
+        with self._lock:
+            self._entries[entity_id] = (time.monotonic(), snapshot)
+            self._entries.move_to_end(entity_id)
+            while len(self._entries) > max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+                metrics.inc('entity_cache_evictions_total', entity=self.kind)
+
+    def invalidate(self, tags):
+        """Bus callback: drop the entries of the tagged rows (all of them for ``<kind>:*``)."""
+        with self._lock:
+            for tag_name in tags:
+                key = tag_name.partition(':')[2]
+                if key == '*':
+                    self.invalidations += len(self._entries)
+                    self._entries.clear()
+                    continue
+                try:
+                    entity_id = int(key)
+                except ValueError:
+                    continue
+                if self._entries.pop(entity_id, None) is not None:
+                    self.invalidations += 1
+
+    def stats(self):
+        """Counters of this process since it started."""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'max_entries': self._max_size(),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
+
+
+books = EntityCache(Book, BookSnapshot, 'book')
+categories = EntityCache(Category, CategorySnapshot, 'category')
+bus.subscribe('book', books.invalidate)
+bus.subscribe('category', categories.invalidate)
@@ -0,0 +1,287 @@
+"""
+Streaming exports of the admin reports (orders, users, books, reviews).
+
+Rows come from the same filtered projection queries as the admin pages
+(:mod:`app.utils.report_queries`), read from a server-side cursor by
+:func:`stream_rows` and encoded chunk by chunk as CSV or XLSX, so neither
+a streamed response nor the file written by a background job ever holds
+more than a chunk of rows in memory.
+
+XLSX has no dependency: the workbook is a zip archive whose sheet is
+deflated as the rows arrive, with strings stored inline so that no shared
+string table has to be kept until the end.
+"""
+import csv
+import io
+import os
+import re
+import zipfile
+from datetime import datetime
+from operator import attrgetter
+from xml.sax.saxutils import escape
+
+from flask import current_app
+from sqlalchemy import desc
+
+from app.models import Book
+from app.utils.projections import book_list_query, BookListItem, OrderListItem, ReviewListItem, UserListItem
+from app.utils.report_queries import filter_orders, filter_reviews, filter_users, book_filter_conditions
+from app.utils.streaming import stream_rows, STREAM_CHUNK_SIZE
+
+# Rows encoded before a chunk is sent (or written)
+EXPORT_CHUNK_SIZE = STREAM_CHUNK_SIZE
+# Rows of an Excel sheet, the header included
+XLSX_MAX_ROWS = 1048576
+
+
+def _book_query(args):
+    return book_list_query().filter(*book_filter_conditions(args)).order_by(desc(Book.AddedDate))
+
+
+# Export name -> (query builder, row class, [(column header, attribute)])
+EXPORTS = {
+    'orders': (filter_orders, OrderListItem, [
+        ('Mã đơn', 'OrderID'), ('Khách hàng', 'Username'), ('Ngày đặt', 'OrderDate'),
+        ('Tổng tiền', 'TotalAmount'), ('Phương thức', 'PaymentMethod'), ('Đã thanh toán', 'PaymentStatus'),
+        ('Trạng thái', 'OrderStatus'),
+    ]),
+    'users': (filter_users, UserListItem, [
+        ('ID', 'UserID'), ('Tên tài khoản', 'Username'), ('Email', 'Email'), ('Họ và tên', 'FullName'),
+        ('Vai trò', 'RoleName'), ('Ngày đăng ký', 'RegisterDate'), ('Hoạt động', 'Status'),
+    ]),
+    'books': (_book_query, BookListItem, [
+        ('ID', 'BookID'), ('Tiêu đề', 'Title'), ('Tác giả', 'Author'), ('Thể loại', 'CategoryName'),
+        ('Giá', 'Price'), ('Ngày thêm', 'AddedDate'), ('Hiển thị', 'Status'),
+    ]),
+    'reviews': (filter_reviews, ReviewListItem, [
+        ('ID', 'ReviewID'), ('Người dùng', 'Username'), ('Mã sách', 'BookID'), ('Sách', 'Title'),
+        ('Số sao', 'Rating'), ('Nhận xét', 'Comment'), ('Ngày đánh giá', 'ReviewDate'), ('Hiển thị', 'Status'),
+    ]),
+}
+
+
+def count_rows(name, args):
+    """Number of rows an export with these filters would contain."""
+    build_query = EXPORTS[name][0]
+    return build_query(args).order_by(None).count()
+
+
+def export_rows(name, args):
+    """
+    Iterate over the rows of an export.
+
+    Args:
+        name: Key of :data:`EXPORTS`
+        args: The filters of the report page
+
+    Returns:
+        tuple: (column headers, generator of value tuples)
+    """
+    build_query, item_class, columns = EXPORTS[name]
+    getter = attrgetter(*(attribute for _, attribute in columns))
+    rows = (getter(item) for item in stream_rows(build_query(args), item_class))
+    return [header for header, _ in columns], rows
+
+
+# CSV
+
+# Cells a spreadsheet would run as a formula (user input such as review comments)
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_chunks(headers, rows, title=None):
+    """Encode rows as UTF-8 CSV, yielding a chunk every ``EXPORT_CHUNK_SIZE`` rows."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    # The byte order mark makes Excel read the file as UTF-8
+    buffer.write('\ufeff')
+    writer.writerow(headers)
+    for count, values in enumerate(rows, 1):
+        writer.writerow([_csv_value(value) for value in values])
+        if count % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+
+# XLSX
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+SPREADSHEET_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIP_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_RELATIONSHIP_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+
+XLSX_PARTS = {
+    '[Content_Types].xml': (
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        f'<Relationships xmlns="{PACKAGE_RELATIONSHIP_NS}">'
+        f'<Relationship Id="rId1" Type="{RELATIONSHIP_NS}/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    'xl/workbook.xml': (
+        f'<workbook xmlns="{SPREADSHEET_NS}" xmlns:r="{RELATIONSHIP_NS}">'
+        '<sheets><sheet name="{sheet}" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    'xl/_rels/workbook.xml.rels': (
+        f'<Relationships xmlns="{PACKAGE_RELATIONSHIP_NS}">'
+        f'<Relationship Id="rId1" Type="{RELATIONSHIP_NS}/worksheet" Target="worksheets/sheet1.xml"/>'
+        f'<Relationship Id="rId2" Type="{RELATIONSHIP_NS}/styles" Target="styles.xml"/>'
+        '</Relationships>'
+    ),
+    # Style 1 displays date serial numbers as dates (built-in format 22)
+    'xl/styles.xml': (
+        f'<styleSheet xmlns="{SPREADSHEET_NS}">'
+        '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
+        '<fills count="2"><fill><patternFill patternType="none"/></fill>'
+        '<fill><patternFill patternType="gray125"/></fill></fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+        '<xf numFmtId="22" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
+        '</styleSheet>'
+    ),
+}
+
+# Characters XML 1.0 cannot carry
+INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+EXCEL_EPOCH = datetime(1899, 12, 30)
+
+
+def _xlsx_cell(value):
+    if value is None:
+        return '<c/>'
+    if isinstance(value, bool):
+        return f'<c t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c><v>{value!r}</v></c>'
+    if isinstance(value, datetime):
+        serial = (value.replace(tzinfo=None) - EXCEL_EPOCH).total_seconds() / 86400
+        return f'<c s="1"><v>{serial!r}</v></c>'
+    text = escape(INVALID_XML_CHARS.sub('', str(value)))
+    return f'<c t="inlineStr"><is><t xml:space="preserve">{text}</t></is></c>'
+
+
+class _Sink:
+    """Write-only file collecting what the zip writer produces, drained after every chunk."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def xlsx_chunks(headers, rows, title='Sheet1'):
+    """
+    Encode rows as an XLSX workbook of one sheet named ``title``, yielding the archive as it is written.
+
+    Rows beyond the limit of a sheet (``XLSX_MAX_ROWS``) are left out.
+    """
+    sink = _Sink()
+    # The sink cannot seek: sizes and checksums follow each member (data descriptors)
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for part, content in XLSX_PARTS.items():
+            archive.writestr(part, XML_DECLARATION + content.replace('{sheet}', escape(title)))
+
+        with archive.open('xl/worksheets/sheet1.xml', 'w') as stream:
+            buffer = [XML_DECLARATION, f'<worksheet xmlns="{SPREADSHEET_NS}"><sheetData>',
+                      '<row>', *(_xlsx_cell(header) for header in headers), '</row>']
+            for count, values in enumerate(rows, 2):
+                if count > XLSX_MAX_ROWS:
+                    break
+                buffer.append('<row>')
+                buffer.extend(_xlsx_cell(value) for value in values)
+                buffer.append('</row>')
+                if count % EXPORT_CHUNK_SIZE == 0:
+                    stream.write(''.join(buffer).encode('utf-8'))
+                    buffer = []
+                    data = sink.drain()
+                    if data:
+                        yield data
+            buffer.append('</sheetData></worksheet>')
+            stream.write(''.join(buffer).encode('utf-8'))
+    yield sink.drain()
+
+
+# Format -> (encoder, MIME type)
+FORMATS = {
+    'csv': (csv_chunks, 'text/csv; charset=utf-8'),
+    'xlsx': (xlsx_chunks, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+}
+
+
+def export_filename(name, fmt):
+    return f'{name}-{datetime.now():%Y%m%d-%H%M}.{fmt}'
+
+
+def export_chunks(name, fmt, args):
+    """Return a generator of the encoded export, for a streamed response."""
+    headers, rows = export_rows(name, args)
+    return FORMATS[fmt][0](headers, rows, title=name)
+
+
+def write_export(name, fmt, args, job=None):
+    """
+    Write an export to ``JOBS_DIR``, as a background job.
+
+    Returns:
+        dict: ``message``, ``rows``, ``export`` (the file in ``JOBS_DIR``) and
+        ``filename`` (the name it is downloaded as)
+    """
+    headers, rows = export_rows(name, args)
+    count = 0
+
+    def counted(rows):
+        nonlocal count
+        for count, values in enumerate(rows, 1):
+            if job is not None and count % EXPORT_CHUNK_SIZE == 0:
+                job.progress(count)
+            yield values
+
+    export = f'{job.id}.{fmt}' if job is not None else export_filename(name, fmt)
+    path = os.path.join(current_app.config['JOBS_DIR'], export)
+    chunks = FORMATS[fmt][0](headers, counted(rows), title=name)
+    # Written under another name first, so a partial file is never downloaded
+    with open(f'{path}.tmp', 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(f'{path}.tmp', path)
+
+    if job is not None:
+        job.progress(count)
+    return {'message': f'Đã xuất {count} dòng.', 'rows': count, 'export': export,
+            'filename': export_filename(name, fmt)}
@@ -0,0 +1,141 @@
+"""
+Facet counts for book listings.
+
+Books are counted per category (rolled up to every ancestor category),
+publish-year bucket and price band with a single grouped query. Facets are
+disjunctive: the counts of one facet honour the selections made in the
+other two facets but not its own, so every option shows how many books
+selecting it would give.
+"""
+from collections import Counter
+
+from sqlalchemy import case, func, literal_column, select, and_
+
+from app import db
+from app.models import Book
+from app.utils.catalog_cache import catalog
+
+FACET_FIELDS = ('category', 'year', 'price')
+
+# (key, label, lower bound included, upper bound excluded)
+YEAR_BUCKETS = (
+    ('truoc-2000', 'Trước 2000', None, 2000),
+    ('2000-2009', '2000 - 2009', 2000, 2010),
+    ('2010-2019', '2010 - 2019', 2010, 2020),
+    ('tu-2020', 'Từ 2020', 2020, None),
+)
+PRICE_BANDS = (
+    ('duoi-50k', 'Dưới 50.000 VND', None, 50000),
+    ('50k-100k', '50.000 - 100.000 VND', 50000, 100000),
+    ('100k-200k', '100.000 - 200.000 VND', 100000, 200000),
+    ('tren-200k', 'Trên 200.000 VND', 200000, None),
+)
+
+
+def _bucket_index(column, buckets):
+    """SQL expression numbering the bucket of ``column`` (-1 when NULL)."""
+    # Inline literals keep the expression identical wherever SQL Server compares it
+    whens = [(column.is_(None), literal_column('-1'))]
+    whens += [(column < literal_column(str(upper)), literal_column(str(index)))
+              for index, (_, _, _, upper) in enumerate(buckets) if upper is not None]
+    return case(*whens, else_=literal_column(str(len(buckets) - 1)))
+
+
+def _find_bucket(buckets, key):
+    for index, bucket in enumerate(buckets):
+        if bucket[0] == key:
+            return index
+    return None
+
+
+def bucket_condition(column, buckets, key):
+    """Return the SQL condition selecting one bucket, or None for an unknown key."""
+    index = _find_bucket(buckets, key)
+    if index is None:
+        return None
+    _, _, lower, upper = buckets[index]
+    bounds = []
+    if lower is not None:
+        bounds.append(column >= lower)
+    if upper is not None:
+        bounds.append(column < upper)
+    return and_(*bounds)
+
+
+def facet_args(args):
+    """Keep only the facet selections of the request arguments."""
+    return {name: args.get(name) for name in FACET_FIELDS if args.get(name)}
+
+
+def facet_counts(conditions, args):
+    """
+    Count the books matching ``conditions`` per facet option.
+
+    Args:
+        conditions: SQL conditions of the non-facet filters (search, status...)
+        args: Request arguments holding the facet selections
+            (``category``, ``year``, ``price``)
+
+    Returns:
+        dict: ``categories``, ``years`` and ``prices`` lists of options, each a
+        dict with ``key``, ``label``, ``count`` and ``selected`` (categories
+        also have ``depth`` and come in tree order)
+    """
+    groups = select(
+        Book.CategoryID.label('category_id'),
+        _bucket_index(Book.PublishYear, YEAR_BUCKETS).label('year_bucket'),
+        _bucket_index(Book.Price, PRICE_BANDS).label('price_band'),
+    ).where(*conditions).subquery()
+    rows = db.session.execute(
+        select(groups.c.category_id, groups.c.year_bucket, groups.c.price_band, func.count().label('books'))
+        .group_by(groups.c.category_id, groups.c.year_bucket, groups.c.price_band)
+    ).all()
+
+    tree = catalog.category_tree()
+
+    category = args.get('category')
+    selected_category = int(category) if str(category or '').isdigit() else None
+    selected_year = _find_bucket(YEAR_BUCKETS, args.get('year'))
+    selected_price = _find_bucket(PRICE_BANDS, args.get('price'))
+
+    category_counts, year_counts, price_counts = Counter(), Counter(), Counter()
+    for category_id, year_bucket, price_band, count in rows:
+        in_category = selected_category is None or selected_category in tree.lineage(category_id)
+        in_year = selected_year is None or year_bucket == selected_year
+        in_price = selected_price is None or price_band == selected_price
+        if in_year and in_price:
+            for ancestor in tree.lineage(category_id):
+                category_counts[ancestor] += count
+        if in_category and in_price:
+            year_counts[year_bucket] += count
+        if in_category and in_year:
+            price_counts[price_band] += count
+
+    return {
+        'categories': _category_options(tree.rows, category_counts, selected_category),
+        'years': _bucket_options(YEAR_BUCKETS, year_counts, selected_year),
+        'prices': _bucket_options(PRICE_BANDS, price_counts, selected_price),
+    }
+
+
+def _bucket_options(buckets, counts, selected):
+    return [{'key': key, 'label': label, 'count': counts[index], 'selected': index == selected}
+            for index, (key, label, _, _) in enumerate(buckets)]
+
+
+def _category_options(categories, counts, selected):
+    children = {}
+    for category_id, name, parent_id in sorted(categories, key=lambda c: c[1]):
+        children.setdefault(parent_id, []).append((category_id, name))
+
+    options = []
+
+    def walk(parent_id, depth):
+        for category_id, name in children.get(parent_id, []):
+            if counts[category_id] or category_id == selected:
+                options.append({'key': category_id, 'label': name, 'count': counts[category_id],
+                                'selected': category_id == selected, 'depth': depth})
+            walk(category_id, depth + 1)
+
+    walk(None, 0)
+    return options
@@ -0,0 +1,175 @@
+"""
+Cover image derivatives.
+
+When a cover is uploaded, a fixed set of resized WebP and JPEG variants and
+a tiny blurred placeholder are generated with Pillow. The variants are
+uploaded next to the original and recorded on ``Book.CoverVariants`` (JSON)
+and ``Book.CoverPlaceholder`` (data URI); templates render them with
+:func:`cover_image` / :func:`cover_srcset`.
+"""
+import base64
+import json
+from io import BytesIO
+
+from flask import current_app, url_for
+from markupsafe import Markup, escape
+from PIL import Image, ImageFilter, ImageOps
+
+from app.utils.cloudinary_utils import upload_image, upload_image_variant
+
+# Variant name -> width in pixels (height follows the aspect ratio)
+COVER_VARIANTS = {
+    'thumb': 160,
+    'card': 400,
+    'large': 800,
+}
+VARIANT_FORMATS = {
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+    'jpeg': {'format': 'JPEG', 'quality': 82, 'progressive': True, 'optimize': True},
+}
+PLACEHOLDER_WIDTH = 16
+DEFAULT_COVER = 'img/book1.png'
+
+
+def _open_image(file):
+    """Open an uploaded image, applying its EXIF orientation."""
+    stream = getattr(file, 'stream', file)
+    stream.seek(0)
+    image = Image.open(stream)
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'L'):
+        # JPEG has no alpha channel, flatten transparent covers on white
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.convert('RGBA').getchannel('A'))
+        image = background
+    return image.convert('RGB')
+
+
+def _resize(image, width):
+    if image.width <= width:
+        return image.copy()
+    height = max(1, round(image.height * width / image.width))
+    return image.resize((width, height), Image.LANCZOS)
+
+
+def _encode(image, image_format):
+    buffer = BytesIO()
+    options = dict(VARIANT_FORMATS[image_format])
+    image.save(buffer, **options)
+    buffer.seek(0)
+    return buffer
+
+
+def build_placeholder(image):
+    """Return a tiny blurred JPEG of the cover as a data URI."""
+    small = _resize(image, PLACEHOLDER_WIDTH).filter(ImageFilter.GaussianBlur(1))
+    buffer = BytesIO()
+    small.save(buffer, format='JPEG', quality=40)
+    return 'data:image/jpeg;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def create_cover_derivatives(file, public_id):
+    """
+    Generate and upload the variants of an uploaded cover.
+
+    Args:
+        file: The uploaded image file
+        public_id: Cloudinary public ID of the original, variants are stored next to it
+
+    Returns:
+        tuple: (variants JSON string, placeholder data URI), or (None, None) on failure
+    """
+    try:
+        image = _open_image(file)
+        variants = {}
+        for name, width in COVER_VARIANTS.items():
+            resized = _resize(image, width)
+            variant = {'width': resized.width, 'height': resized.height}
+            for image_format in VARIANT_FORMATS:
+                result = upload_image_variant(_encode(resized, image_format), f'{public_id}_{name}_{image_format}',
+                                              image_format)
+                if not result:
+                    return None, None
+                variant[image_format] = result['secure_url']
+            variants[name] = variant
+            resized.close()
+
+        return json.dumps(variants), build_placeholder(image)
+    except Exception as e:
+        current_app.logger.error(f"Error creating cover derivatives: {str(e)}")
+        return None, None
+    finally:
+        stream = getattr(file, 'stream', file)
+        stream.seek(0)
+
+
+def process_cover_upload(file):
+    """
+    Upload a cover image together with its derivatives.
+
+    Returns:
+        dict: ``CoverImage``, ``CoverVariants`` and ``CoverPlaceholder`` values
+        for the book plus the ``PublicID`` of the original, or None if the
+        original could not be uploaded
+    """
+    result = upload_image(file)
+    if not result:
+        return None
+
+    variants, placeholder = create_cover_derivatives(file, result['public_id'])
+    return {
+        'CoverImage': result['secure_url'],
+        'CoverVariants': variants,
+        'CoverPlaceholder': placeholder,
+        'PublicID': result['public_id'],
+    }
+
+
+def _cover_variants(book):
+    raw = getattr(book, 'CoverVariants', None)
+    if not raw:
+        return []
+    try:
+        return sorted(json.loads(raw).values(), key=lambda variant: variant['width'])
+    except (ValueError, KeyError, TypeError):
+        return []
+
+
+def cover_srcset(book, image_format='jpeg'):
+    """Build the ``srcset`` attribute value of a book cover."""
+    return ', '.join(f"{variant[image_format]} {variant['width']}w" for variant in _cover_variants(book))
+
+
+def cover_image(book, sizes='100vw', alt=None, default=DEFAULT_COVER, **attrs):
+    """
+    Render a book cover as a responsive ``<picture>``.
+
+    WebP variants are offered first with JPEG as fallback, and the blurred
+    placeholder is shown until the image has loaded. Books without variants
+    fall back to the original image, or the ``default`` static cover.
+    """
+    alt = book.Title if alt is None else alt
+    variants = _cover_variants(book)
+
+    if variants and getattr(book, 'CoverPlaceholder', None):
+        placeholder = f'background: url({book.CoverPlaceholder}) center / cover no-repeat;'
+        attrs['style'] = f"{placeholder} {attrs['style']}" if attrs.get('style') else placeholder
+    extra = ''.join(f' {name}="{escape(value)}"' for name, value in attrs.items())
+
+    if not variants:
+        src = book.CoverImage or url_for('static', filename=default)
+        return Markup(f'<img src="{escape(src)}" alt="{escape(alt)}" loading="lazy"{extra}>')
+
+    largest = variants[-1]
+    dimensions = ''
+    if 'width' not in attrs and 'height' not in attrs:
+        # Intrinsic size lets the browser reserve space before the image loads
+        dimensions = f' width="{largest["width"]}" height="{largest["height"]}"'
+
+    return Markup(
+        '<picture>'
+        f'<source type="image/webp" srcset="{escape(cover_srcset(book, "webp"))}" sizes="{escape(sizes)}">'
+        f'<img src="{escape(largest["jpeg"])}" srcset="{escape(cover_srcset(book))}" sizes="{escape(sizes)}"'
+        f'{dimensions} alt="{escape(alt)}" loading="lazy"{extra}>'
+        '</picture>'
+    )
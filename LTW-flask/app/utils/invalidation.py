@@ -0,0 +1,393 @@
+"""
+Invalidation bus keeping the process caches of all workers and nodes fresh.
+
+Every commit publishes the tags of the rows it changed (``book:123``,
+``category:7``, ``user:45``, or ``category:*`` for a whole kind) once the
+transaction is committed. Every process subscribes and passes the tags to
+the caches registered for their kind, which evict the matching entries.
+
+A message carries a version number that only grows. A process ignores a
+message for a tag when it has already applied a newer one (a late or
+duplicated message cannot evict data loaded after a newer change, and
+nothing is applied twice). A cache filling itself from the database
+remembers :meth:`InvalidationBus.sequence` before it loads and checks
+:meth:`InvalidationBus.changed_since` before it stores: when an
+invalidation arrived in between, the loaded data may predate it and is not
+kept.
+
+``INVALIDATION_BROKER`` selects how messages travel between processes:
+
+- ``local``: only within this process (development, a single worker).
+- ``database``: rows of the ``InvalidationEvents`` table, polled every
+  ``INVALIDATION_POLL_INTERVAL`` seconds; needs no extra service.
+- ``redis``: Redis pub/sub on ``INVALIDATION_REDIS_URL``, delivered at once.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import delete, event, func, insert, or_, select
+from sqlalchemy.orm import object_session
+
+from app import db
+from app.models import Book, Category, InvalidationEvent, Role, User
+from app.utils.db_routing import RoutingSession
+
+PENDING_KEY = 'invalidation_tags'
+WILDCARD = '*'
+# More tags of one kind in a commit are sent as "<kind>:*"
+MAX_TAGS_PER_KIND = 100
+# Tags whose last version is remembered; older ones are forgotten conservatively
+MAX_TRACKED_TAGS = 10000
+
+TAGGED_MODELS = {
+    'book': Book,
+    'category': Category,
+    'user': User,
+    'role': Role,
+}
+
+
+def tag(kind, key=WILDCARD):
+    """Build the tag of one row (``tag('book', 12)``) or of a whole kind (``tag('book')``)."""
+    return f'{kind}:{key}'
+
+
+def _split(tag_name):
+    kind, _, key = tag_name.partition(':')
+    return kind, key
+
+
+def _collapse(tags):
+    """Replace the tags of a kind by its wildcard when there are too many of them."""
+    by_kind = {}
+    for tag_name in tags:
+        by_kind.setdefault(_split(tag_name)[0], set()).add(tag_name)
+    collapsed = []
+    for kind, kind_tags in sorted(by_kind.items()):
+        if tag(kind) in kind_tags or len(kind_tags) > MAX_TAGS_PER_KIND:
+            collapsed.append(tag(kind))
+        else:
+            collapsed.extend(sorted(kind_tags))
+    return collapsed
+
+
+class LocalBroker:
+    """In-process broker: delivers to the buses started on it, at once (single worker, scripts)."""
+
+    def __init__(self):
+        self._buses = []
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def publish(self, tags):
+        with self._lock:
+            self._version += 1
+            version = self._version
+        for bus in list(self._buses):
+            bus.deliver(version, tags)
+        return version
+
+    def start(self, bus, app):
+        if bus not in self._buses:
+            self._buses.append(bus)
+
+    def stop(self):
+        self._buses = []
+
+
+class DatabaseBroker:
+    """Messages are rows of ``InvalidationEvents``; ``EventID`` is the version."""
+
+    def __init__(self, poll_interval=1.0, grace=10, retention=3600):
+        self.poll_interval = poll_interval
+        # Rows are re-read for this long: a transaction may commit after one with a higher EventID
+        self.grace = grace
+        self.retention = retention
+        self._last = None
+        self._pruned_at = 0.0
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def publish(self, tags):
+        with db.engine.begin() as connection:
+            result = connection.execute(
+                insert(InvalidationEvent).values(Tags=','.join(tags), CreatedDate=datetime.utcnow())
+            )
+            return result.inserted_primary_key[0]
+
+    def start(self, bus, app):
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._poll, args=(bus, app, self._stopping),
+                                        name='invalidation-poll', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _poll(self, bus, app, stopping):
+        with app.app_context():
+            while not stopping.is_set():
+                try:
+                    self._read(bus)
+                    if time.monotonic() - self._pruned_at > 60:
+                        self._prune()
+                except Exception as e:
+                    app.logger.error(f"Error polling invalidation events: {str(e)}")
+                finally:
+                    db.session.remove()
+                stopping.wait(self.poll_interval)
+
+    def _read(self, bus):
+        with db.engine.connect() as connection:
+            if self._last is None:
+                # A new process has nothing cached that older events could concern
+                self._last = connection.execute(select(func.max(InvalidationEvent.EventID))).scalar() or 0
+            recent = datetime.utcnow() - timedelta(seconds=self.grace)
+            rows = connection.execute(
+                select(InvalidationEvent.EventID, InvalidationEvent.Tags)
+                .where(or_(InvalidationEvent.EventID > self._last, InvalidationEvent.CreatedDate >= recent))
+                .order_by(InvalidationEvent.EventID)
+            ).all()
+        for event_id, tags in rows:
+            bus.deliver(event_id, tags.split(','))
+            self._last = max(self._last, event_id)
+
+    def _prune(self):
+        self._pruned_at = time.monotonic()
+        with db.engine.begin() as connection:
+            connection.execute(delete(InvalidationEvent).where(
+                InvalidationEvent.CreatedDate < datetime.utcnow() - timedelta(seconds=self.retention)
+            ))
+
+
+class RedisBroker:
+    """Redis pub/sub; the version comes from an INCR counter next to the channel."""
+
+    def __init__(self, url, channel='invalidation'):
+        self.url = url
+        self.channel = channel
+        self.version_key = f'{channel}:version'
+        self._clients = {}
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def _client(self):
+        # Never share a connection with the process we were forked from
+        client = self._clients.get(os.getpid())
+        if client is None:
+            import redis
+            client = self._clients[os.getpid()] = redis.Redis.from_url(self.url)
+        return client
+
+    def publish(self, tags):
+        client = self._client()
+        version = client.incr(self.version_key)
+        client.publish(self.channel, json.dumps({'version': version, 'tags': tags}))
+        return version
+
+    def start(self, bus, app):
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._listen, args=(bus, app, self._stopping),
+                                        name='invalidation-listen', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _listen(self, bus, app, stopping):
+        backoff = 1
+        while not stopping.is_set():
+            try:
+                pubsub = self._client().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                # Messages sent while we were not subscribed are lost, evict everything if there were any
+                bus.resync(int(self._client().get(self.version_key) or 0))
+                backoff = 1
+                while not stopping.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        data = json.loads(message['data'])
+                        bus.deliver(data['version'], data['tags'])
+                pubsub.close()
+            except Exception as e:
+                app.logger.error(f"Error listening for invalidations: {str(e)}")
+                stopping.wait(backoff)
+                backoff = min(backoff * 2, 30)
+
+
+def create_broker(config):
+    """Build the broker selected by ``INVALIDATION_BROKER``."""
+    broker = config.get('INVALIDATION_BROKER', 'local')
+    if broker == 'database':
+        return DatabaseBroker(config.get('INVALIDATION_POLL_INTERVAL', 1.0),
+                              config.get('INVALIDATION_POLL_GRACE', 10),
+                              config.get('INVALIDATION_RETENTION', 3600))
+    if broker == 'redis':
+        return RedisBroker(config['INVALIDATION_REDIS_URL'], config.get('INVALIDATION_CHANNEL', 'invalidation'))
+    return LocalBroker()
+
+
+class InvalidationBus:
+    """Publishes the tags of committed changes and dispatches received ones to the caches."""
+
+    def __init__(self, broker=None):
+        self.broker = broker or LocalBroker()
+        self.app = None
+        self._callbacks = {}
+        # tag -> (version, sequence) of the last invalidation applied
+        self._tags = OrderedDict()
+        self._kinds = {}
+        self._forgotten = (0, 0)
+        self._sequence = 0
+        self._highest = 0
+        self._pid = None
+        self._lock = threading.RLock()
+
+    def init_app(self, app):
+        """Use the broker configured for ``app``; listening starts in each process on its first request."""
+        self.broker = create_broker(app.config)
+        self.app = app
+        self._pid = None
+        app.before_request(self.ensure_started)
+
+    def ensure_started(self):
+        """Start receiving in this process (again after a fork)."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                app = self.app or current_app._get_current_object()
+                self.broker.start(self, app)
+
+    def stop(self):
+        """Stop receiving, e.g. in a master process before it forks."""
+        with self._lock:
+            self.broker.stop()
+            self._pid = None
+
+    def subscribe(self, kind, callback):
+        """Call ``callback(tags)`` with the received tags of ``kind``."""
+        self._callbacks.setdefault(kind, []).append(callback)
+
+    def sequence(self):
+        """Local counter of applied invalidations, to pass to :meth:`changed_since`."""
+        return self._sequence
+
+    def changed_since(self, tags, sequence):
+        """Whether an invalidation of one of ``tags`` was applied after ``sequence``."""
+        with self._lock:
+            for tag_name in tags:
+                kind, key = _split(tag_name)
+                if key == WILDCARD:
+                    if self._kinds.get(kind, 0) > sequence:
+                        return True
+                    continue
+                known = self._tags.get(tag_name) or self._tags.get(tag(kind))
+                if known is not None and known[1] > sequence:
+                    return True
+                if known is None and self._forgotten[1] > sequence:
+                    return True
+        return False
+
+    def publish(self, tags):
+        """Send ``tags`` to every process, this one included; call it only after the commit."""
+        tags = _collapse(tags)
+        if not tags:
+            return
+        try:
+            version = self.broker.publish(tags)
+        except Exception as e:
+            # The other processes catch up through the cache lifetimes
+            current_app.logger.error(f"Error publishing invalidation {','.join(tags)}: {str(e)}")
+            version = None
+        self.deliver(version, tags)
+
+    def deliver(self, version, tags):
+        """Apply a received message; ``version`` None always applies (local only)."""
+        applied = {}
+        with self._lock:
+            self._sequence += 1
+            for tag_name in tags:
+                kind, key = _split(tag_name)
+                known = self._tags.get(tag_name)
+                whole_kind = self._tags.get(tag(kind)) if key != WILDCARD else None
+                if version is not None and any(state is not None and state[0] is not None and state[0] >= version
+                                               for state in (known, whole_kind)):
+                    continue
+                self._tags[tag_name] = (version, self._sequence)
+                self._tags.move_to_end(tag_name)
+                self._kinds[kind] = self._sequence
+                applied.setdefault(kind, []).append(tag_name)
+            while len(self._tags) > MAX_TRACKED_TAGS:
+                _, (forgotten_version, forgotten_sequence) = self._tags.popitem(last=False)
+                self._forgotten = (max(self._forgotten[0], forgotten_version or 0),
+                                   max(self._forgotten[1], forgotten_sequence))
+            if version is not None:
+                self._highest = max(self._highest, version)
+
+        for kind, kind_tags in applied.items():
+            for callback in self._callbacks.get(kind, []):
+                try:
+                    callback(kind_tags)
+                except Exception as e:
+                    (self.app or current_app).logger.error(f"Error evicting {','.join(kind_tags)}: {str(e)}")
+
+    def resync(self, latest_version):
+        """Evict every kind when messages up to ``latest_version`` may have been missed."""
+        if latest_version > self._highest:
+            self.deliver(latest_version, [tag(kind) for kind in self._callbacks])
+
+
+bus = InvalidationBus()
+
+
+def invalidate_on_commit(db_session, *tags):
+    """
+    Publish ``tags`` once the current transaction of ``db_session`` commits.
+
+    The ORM changes of the tagged models are collected automatically; use it
+    for set-based statements, which bypass the ORM events.
+    """
+    db_session.info.setdefault(PENDING_KEY, set()).update(tags)
+
+
+def _listen_for_changes(kind, model):
+    def _collect(mapper, connection, target):
+        db_session = object_session(target)
+        if db_session is not None:
+            key = mapper.primary_key_from_instance(target)[0]
+            db_session.info.setdefault(PENDING_KEY, set()).add(tag(kind, key))
+
+    for name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, name, _collect)
+
+
+for _kind, _model in TAGGED_MODELS.items():
+    _listen_for_changes(_kind, _model)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def _publish_changes(db_session):
+    tags = db_session.info.pop(PENDING_KEY, None)
+    if tags:
+        bus.publish(tags)
+
+
+@event.listens_for(RoutingSession, 'after_transaction_end')
+def _forget_changes(db_session, transaction):
+    # Only when the whole transaction ends: a rolled back savepoint (after_rollback
+    # fires for those too) leaves the changes of the outer transaction to publish
+    if transaction.parent is None:
+        db_session.info.pop(PENDING_KEY, None)
@@ -0,0 +1,203 @@
+"""
+Background jobs for long-running admin operations.
+
+A job runs in a daemon thread inside an app context. Its progress is kept
+as a small JSON file in ``JOBS_DIR`` (written atomically, throttled to
+``JOB_PROGRESS_INTERVAL``) so the status endpoint answers from any worker
+process, not only the one running the job. Finished jobs older than
+``JOB_RETENTION`` seconds are swept when new jobs are submitted.
+
+A job dies with the process running it. Servers call :func:`wait_for_jobs`
+before a worker exits (serve.py also keeps a worker running jobs from being
+recycled), and :func:`get_job` reports a job whose process is gone as
+failed instead of running forever.
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+from flask import current_app
+
+from app.utils.metrics import pid_alive
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Threads of the jobs running in this process, by job ID
+_running = {}
+_running_lock = threading.Lock()
+
+
+class Job:
+    """Progress of one background job, as seen by the code running it."""
+
+    def __init__(self, directory, kind, total=None, owner=None, interval=1.0):
+        self.id = uuid.uuid4().hex
+        self.directory = directory
+        self.kind = kind
+        self.owner = owner
+        self.status = PENDING
+        self.total = total
+        self.done = 0
+        self.message = None
+        self.result = None
+        self.created = time.time()
+        self.finished = None
+        self.pid = os.getpid()
+        self.host = socket.gethostname()
+        self._interval = interval
+        self._saved_at = 0.0
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'owner': self.owner,
+            'status': self.status,
+            'total': self.total,
+            'done': self.done,
+            'message': self.message,
+            'result': self.result,
+            'created': self.created,
+            'finished': self.finished,
+            'pid': self.pid,
+            'host': self.host,
+        }
+
+    def save(self):
+        _write(os.path.join(self.directory, f'{self.id}.json'), self.to_dict())
+        self._saved_at = time.monotonic()
+
+    def progress(self, done, total=None, message=None):
+        """Record progress, persisting it at most every ``JOB_PROGRESS_INTERVAL`` seconds."""
+        self.done = done
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message
+        if time.monotonic() - self._saved_at >= self._interval:
+            self.save()
+
+
+def _run(app, job, func, args, kwargs):
+    try:
+        with app.app_context():
+            job.status = RUNNING
+            job.save()
+            try:
+                job.result = func(*args, job=job, **kwargs)
+                job.status = DONE
+            except Exception as e:
+                job.status = FAILED
+                job.message = str(e)
+                app.logger.error(f"Error in background job {job.kind} {job.id}: {str(e)}")
+            job.finished = time.time()
+            job.save()
+    finally:
+        with _running_lock:
+            _running.pop(job.id, None)
+
+
+def submit_job(kind, func, *args, owner=None, total=None, **kwargs):
+    """
+    Run ``func(*args, job=job, **kwargs)`` in a background thread.
+
+    Args:
+        kind: Short name of the operation, shown on the status page
+        func: The function doing the work, its return value becomes the job result
+        owner: ID of the user who started the job
+        total: Number of items to process, if known up front
+
+    Returns:
+        str: The job ID
+    """
+    app = current_app._get_current_object()
+    directory = app.config['JOBS_DIR']
+    os.makedirs(directory, exist_ok=True)
+    _sweep(directory, app.config.get('JOB_RETENTION', 86400))
+
+    job = Job(directory, kind, total=total, owner=owner, interval=app.config.get('JOB_PROGRESS_INTERVAL', 1.0))
+    thread = threading.Thread(target=_run, args=(app, job, func, args, kwargs), name=f'job-{kind}', daemon=True)
+    with _running_lock:
+        _running[job.id] = thread
+    job.save()
+    thread.start()
+    return job.id
+
+
+def running_jobs():
+    """Number of jobs running in this process."""
+    with _running_lock:
+        return len(_running)
+
+
+def wait_for_jobs(timeout=None):
+    """
+    Wait for the jobs running in this process to finish, e.g. before it exits.
+
+    Returns:
+        bool: Whether they all finished within ``timeout`` seconds
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while True:
+        with _running_lock:
+            threads = list(_running.values())
+        if not threads:
+            return True
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        if remaining is not None and remaining <= 0:
+            return False
+        threads[0].join(remaining)
+
+
+def get_job(job_id):
+    """Return the last saved state of a job as a dict, or None if unknown."""
+    if not job_id.isalnum():
+        return None
+    path = os.path.join(current_app.config['JOBS_DIR'], f'{job_id}.json')
+    try:
+        with open(path, encoding='utf-8') as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if job['status'] in (PENDING, RUNNING) and _orphaned(job):
+        job['status'] = FAILED
+        job['message'] = 'Tác vụ bị dừng vì tiến trình xử lý đã thoát trước khi hoàn tất.'
+        job['finished'] = time.time()
+        _write(path, job)
+    return job
+
+
+def _orphaned(job):
+    """Whether the process that ran ``job`` is gone (only known on the same machine)."""
+    if job.get('host') != socket.gethostname() or not job.get('pid'):
+        return False
+    if job['pid'] == os.getpid():
+        with _running_lock:
+            return job['id'] not in _running
+    return not pid_alive(job['pid'])
+
+
+def _write(path, data):
+    # Atomic: readers in other processes never see a partial file
+    temporary = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temporary, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(temporary, path)
+
+
+def _sweep(directory, retention):
+    cutoff = time.time() - retention
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,328 @@
+"""
+Lightweight metrics for the application, exposed in Prometheus text format.
+
+Every thread writes into its own shard (plain dicts owned by that thread),
+so recording a sample never takes a lock. Shards are only merged when the
+metrics are collected. Each worker process periodically flushes its merged
+snapshot to ``METRICS_DIR`` so that the ``/metrics`` endpoint served by any
+worker can aggregate the numbers of all processes.
+"""
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, request
+
+# Fixed latency buckets (seconds) shared by all histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# name -> (type, help)
+METRIC_DEFINITIONS = {
+    'http_requests_total': ('counter', 'HTTP requests by endpoint and status code.'),
+    'http_request_duration_seconds': ('histogram', 'HTTP request latency by endpoint.'),
+    'http_requests_in_flight': ('gauge', 'Requests currently being served by blueprint.'),
+    'db_pool_checkout_wait_seconds': ('histogram', 'Time spent waiting for a DB pool connection.'),
+    'cloudinary_request_duration_seconds': ('histogram', 'Cloudinary call latency by operation.'),
+    'cloudinary_errors_total': ('counter', 'Failed Cloudinary calls by operation and reason.'),
+    'external_calls_total': ('counter', 'Attempts to call an external service by operation and result.'),
+    'external_retries_total': ('counter', 'Retries of idempotent external calls.'),
+    'external_hedged_requests_total': ('counter', 'Second requests sent because the first one was slow.'),
+    'external_calls_in_flight': ('gauge', 'External calls in flight (bulkhead slots in use).'),
+    'external_circuit_open': ('gauge', 'Workers whose circuit breaker for the service is open.'),
+    'external_circuit_transitions_total': ('counter', 'Circuit breaker state changes by new state.'),
+    'purchases_total': ('counter', 'Completed book purchases.'),
+    'downloads_total': ('counter', 'Book downloads.'),
+    'logins_total': ('counter', 'Login attempts by result.'),
+    'searches_total': ('counter', 'Catalog searches.'),
+    'entity_cache_requests_total': ('counter', 'Entity cache lookups by entity and result (hit or miss).'),
+    'entity_cache_evictions_total': ('counter', 'Entity cache entries evicted to stay within the size limit.'),
+    'password_hashes_total': ('counter', 'Password hashes by operation (hash, verify) and result.'),
+    'password_hashes_pending': ('gauge', 'Password hashes queued or running.'),
+    'password_hash_duration_seconds': ('histogram', 'Time requests wait for a password hash, by operation.'),
+    'throttled_requests_total': ('counter', 'Attempts refused by a token bucket, by key kind.'),
+    'pdf_ingest_duration_seconds': ('histogram', 'Time spent reading uploaded PDFs by step (metadata, preview).'),
+    'exports_total': ('counter', 'Report exports by export, format and mode (stream, job).'),
+    'payment_results_total': ('counter', 'Payment outcomes by source (webhook, poll, worker, reconciliation), outcome and result.'),
+}
+
+
+def _labels_key(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class _Shard:
+    """Metric values written by a single thread."""
+    __slots__ = ('thread', 'counters', 'gauges', 'histograms')
+
+    def __init__(self, thread):
+        self.thread = thread
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [count per bucket..., +Inf count, sum]
+        self.histograms = {}
+
+
+class Metrics:
+    """Registry of counters, gauges and histograms kept in per-thread shards."""
+
+    def __init__(self, app=None):
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard(None)
+        # Only taken when a new thread registers its shard or on collection
+        self._lock = threading.Lock()
+        self._metrics_dir = None
+        self._flush_interval = 5
+        self._last_flush = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._metrics_dir = app.config.get('METRICS_DIR')
+        self._flush_interval = app.config.get('METRICS_FLUSH_INTERVAL', 5)
+        if self._metrics_dir:
+            os.makedirs(self._metrics_dir, exist_ok=True)
+
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+        from app import db
+        with app.app_context():
+            for engine in db.engines.values():
+                instrument_engine(engine)
+
+    # Recording
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter."""
+        counters = self._shard().counters
+        key = (name, _labels_key(labels))
+        counters[key] = counters.get(key, 0) + value
+
+    def gauge_add(self, name, value, **labels):
+        """Add ``value`` (possibly negative) to a gauge."""
+        gauges = self._shard().gauges
+        key = (name, _labels_key(labels))
+        gauges[key] = gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Record a sample in a fixed-bucket histogram."""
+        histograms = self._shard().histograms
+        key = (name, _labels_key(labels))
+        values = histograms.get(key)
+        if values is None:
+            values = histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        values[bisect_left(LATENCY_BUCKETS, value)] += 1
+        values[-1] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the duration of the ``with`` block."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # Collection
+
+    def snapshot(self):
+        """Merge all thread shards of this process into plain dicts."""
+        with self._lock:
+            alive = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    alive.append(shard)
+                else:
+                    # The owner thread is gone, nobody writes to it any more
+                    _merge_into(self._retired, shard.counters, shard.gauges, shard.histograms)
+            self._shards = alive
+
+            merged = _Shard(None)
+            _merge_into(merged, self._retired.counters, self._retired.gauges, self._retired.histograms)
+            for shard in alive:
+                _merge_into(merged, shard.counters.copy(), shard.gauges.copy(),
+                            {key: list(values) for key, values in shard.histograms.copy().items()})
+        return merged
+
+    def flush(self):
+        """Write this process' snapshot to the shared metrics directory."""
+        self._last_flush = time.monotonic()
+        if not self._metrics_dir:
+            return
+        merged = self.snapshot()
+        data = {
+            'pid': os.getpid(),
+            'counters': [[name, list(labels), value] for (name, labels), value in merged.counters.items()],
+            'gauges': [[name, list(labels), value] for (name, labels), value in merged.gauges.items()],
+            'histograms': [[name, list(labels), values] for (name, labels), values in merged.histograms.items()],
+        }
+        path = os.path.join(self._metrics_dir, f'metrics_{os.getpid()}.json')
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def collect(self):
+        """Aggregate the live snapshot with the snapshots of all other workers."""
+        total = self.snapshot()
+        if not self._metrics_dir:
+            return total
+
+        own_file = f'metrics_{os.getpid()}.json'
+        for path in glob.glob(os.path.join(self._metrics_dir, 'metrics_*.json')):
+            if os.path.basename(path) == own_file:
+                continue
+            try:
+                with open(path, encoding='utf-8') as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+
+            counters = {(name, _as_labels(labels)): value for name, labels, value in data['counters']}
+            histograms = {(name, _as_labels(labels)): values for name, labels, values in data['histograms']}
+            # Gauges of dead workers are meaningless, counters keep their totals
+            gauges = {}
+            if pid_alive(data['pid']):
+                gauges = {(name, _as_labels(labels)): value for name, labels, value in data['gauges']}
+            _merge_into(total, counters, gauges, histograms)
+        return total
+
+    def render(self):
+        """Render all metrics of all workers in Prometheus text format."""
+        total = self.collect()
+        series = {}
+        for (name, labels), value in total.counters.items():
+            series.setdefault(name, []).append((labels, value))
+        for (name, labels), value in total.gauges.items():
+            series.setdefault(name, []).append((labels, value))
+        for (name, labels), values in total.histograms.items():
+            series.setdefault(name, []).append((labels, values))
+
+        lines = []
+        for name in sorted(series):
+            metric_type, help_text = METRIC_DEFINITIONS.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for labels, value in sorted(series[name]):
+                if metric_type != 'histogram':
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, value):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                cumulative += value[len(LATENCY_BUCKETS)]
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(value[-1])}')
+                lines.append(f'{name}_count{_format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    # Request hooks
+
+    def _before_request(self):
+        g._metrics_start = time.perf_counter()
+        g._metrics_blueprint = request.blueprint or 'app'
+        self.gauge_add('http_requests_in_flight', 1, blueprint=g._metrics_blueprint)
+
+    def _after_request(self, response):
+        self.inc('http_requests_total', endpoint=request.endpoint or 'unknown', status=str(response.status_code))
+        return response
+
+    def _teardown_request(self, exc):
+        start = g.pop('_metrics_start', None)
+        if start is None:
+            return
+        self.observe('http_request_duration_seconds', time.perf_counter() - start,
+                     endpoint=request.endpoint or 'unknown')
+        self.gauge_add('http_requests_in_flight', -1, blueprint=g.pop('_metrics_blueprint'))
+        if time.monotonic() - self._last_flush >= self._flush_interval:
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+
+def _merge_into(target, counters, gauges, histograms):
+    for key, value in counters.items():
+        target.counters[key] = target.counters.get(key, 0) + value
+    for key, value in gauges.items():
+        target.gauges[key] = target.gauges.get(key, 0) + value
+    for key, values in histograms.items():
+        current = target.histograms.get(key)
+        if current is None:
+            target.histograms[key] = list(values)
+        else:
+            target.histograms[key] = [a + b for a, b in zip(current, values)]
+
+
+def _as_labels(labels):
+    return tuple(tuple(pair) for pair in labels)
+
+
+def pid_alive(pid):
+    """Whether a process with this ID runs on this machine."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value):
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+def instrument_engine(engine):
+    """Measure how long requests wait for a connection from the engine's pool."""
+    def instrument_pool(pool):
+        checkout = pool.connect
+
+        def timed_connect():
+            start = time.perf_counter()
+            try:
+                return checkout()
+            finally:
+                metrics.observe('db_pool_checkout_wait_seconds', time.perf_counter() - start)
+
+        pool.connect = timed_connect
+
+    instrument_pool(engine.pool)
+
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'engine_disposed')
+    def reinstrument(engine):
+        # dispose() replaces the pool with a fresh one
+        instrument_pool(engine.pool)
+
+
+metrics = Metrics()
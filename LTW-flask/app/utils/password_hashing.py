@@ -0,0 +1,160 @@
+"""
+Password hashing off the request threads.
+
+bcrypt is meant to be slow: at the default cost one hash takes a core for
+a few hundred milliseconds, so a burst of logins run on the request
+threads would keep every worker busy. :data:`passwords` runs the hashes on
+a small pool of ``PASSWORD_HASH_WORKERS`` processes per web worker instead.
+At most ``PASSWORD_HASH_MAX_PENDING`` hashes are queued or running per web
+worker; beyond that, or when a hash is not done after
+``PASSWORD_HASH_TIMEOUT`` seconds, :class:`HashingBusy` is raised at once
+and the request is answered with 429.
+
+The hashes are those of Flask-Bcrypt, and the cost comes from the same
+``BCRYPT_LOG_ROUNDS`` setting. :meth:`PasswordHasher.needs_rehash` tells
+whether a stored hash was made with another cost, so it can be replaced at
+the next successful login.
+"""
+import os
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+import bcrypt
+from flask import current_app
+
+from app.utils.metrics import metrics
+
+# bcrypt only uses the first 72 bytes (newer versions refuse longer passwords)
+MAX_PASSWORD_BYTES = 72
+
+
+class HashingBusy(Exception):
+    """No hashing capacity left; the client should retry later."""
+
+
+def _password_bytes(password):
+    return password.encode('utf-8')[:MAX_PASSWORD_BYTES]
+
+
+class PasswordHasher:
+    """Bounded pool of hashing processes, per web worker."""
+
+    def __init__(self):
+        self._executor = None
+        self._executor_pid = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _get_executor(self, workers):
+        # Started on first use: processes do not survive a fork, every web worker starts its own
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+                # spawn, not fork: the web worker already runs threads. The
+                # hashing processes only need bcrypt's own functions
+                self._executor = ProcessPoolExecutor(max_workers=workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _acquire(self, operation):
+        with self._lock:
+            if self._pending >= current_app.config.get('PASSWORD_HASH_MAX_PENDING', 8):
+                metrics.inc('password_hashes_total', operation=operation, result='rejected')
+                raise HashingBusy(f"{self._pending} password hashes already pending")
+            self._pending += 1
+        metrics.gauge_add('password_hashes_pending', 1)
+
+    def _release(self, *args):
+        with self._lock:
+            self._pending -= 1
+        metrics.gauge_add('password_hashes_pending', -1)
+
+    def _run(self, operation, fn, *args):
+        config = current_app.config
+        workers = config.get('PASSWORD_HASH_WORKERS', 2)
+        self._acquire(operation)
+        with metrics.timer('password_hash_duration_seconds', operation=operation):
+            if not workers:
+                # Tests and scripts: hash on the calling thread
+                try:
+                    result = fn(*args)
+                finally:
+                    self._release()
+            else:
+                try:
+                    future = self._get_executor(workers).submit(fn, *args)
+                except Exception:
+                    # A hashing process died (BrokenProcessPool): start a new pool next time
+                    self._release()
+                    self.shutdown()
+                    raise
+                # Released when the hash is done, not when the request stops
+                # waiting: a hash that timed out still occupies the pool
+                future.add_done_callback(self._release)
+                try:
+                    result = future.result(timeout=config.get('PASSWORD_HASH_TIMEOUT', 5))
+                except FutureTimeoutError:
+                    future.cancel()
+                    metrics.inc('password_hashes_total', operation=operation, result='timeout')
+                    raise HashingBusy(f"Password {operation} did not finish in time")
+        metrics.inc('password_hashes_total', operation=operation, result='ok')
+        return result
+
+    def hash(self, password):
+        """
+        Hash a password with the configured cost.
+
+        Returns:
+            str: The hash, as stored in ``Users.Password``
+
+        Raises:
+            HashingBusy: Too many hashes are pending
+        """
+        salt = bcrypt.gensalt(rounds=current_app.config.get('BCRYPT_LOG_ROUNDS', 12))
+        return self._run('hash', bcrypt.hashpw, _password_bytes(password), salt).decode('utf-8')
+
+    def verify(self, password_hash, password):
+        """
+        Check a password against a stored hash.
+
+        Raises:
+            HashingBusy: Too many hashes are pending
+        """
+        if not password_hash:
+            return False
+        try:
+            password_hash = password_hash.encode('utf-8')
+            # A malformed stored hash fails here, before it takes a hashing slot
+            cost = int(password_hash.split(b'$')[2])
+        except (IndexError, ValueError):
+            return False
+        if not 4 <= cost <= 31:
+            return False
+        return self._run('verify', bcrypt.checkpw, _password_bytes(password), password_hash)
+
+    def needs_rehash(self, password_hash):
+        """Whether a hash was made with another cost than ``BCRYPT_LOG_ROUNDS``."""
+        try:
+            cost = int(password_hash.split('$')[2])
+        except (AttributeError, IndexError, ValueError):
+            return True
+        return cost != current_app.config.get('BCRYPT_LOG_ROUNDS', 12)
+
+    def start(self):
+        """Start the hashing processes now rather than at the first login."""
+        workers = current_app.config.get('PASSWORD_HASH_WORKERS', 2)
+        if workers:
+            executor = self._get_executor(workers)
+            for _ in range(workers):
+                executor.submit(bcrypt.gensalt)
+
+    def shutdown(self, wait=False):
+        with self._lock:
+            if self._executor is not None and self._executor_pid == os.getpid():
+                self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+
+passwords = PasswordHasher()
@@ -0,0 +1,384 @@
+"""
+Payment pipeline: checkout, gateway callbacks and expiry of stale payments.
+
+Checkout only records an order awaiting payment and a pending
+``PaymentTransaction`` and sends the buyer to the gateway; nothing waits
+for the provider. The outcome arrives later, from either:
+
+- the gateway's webhook (``POST /payments/webhook``), signed with
+  ``PAYMENT_WEBHOOK_SECRET`` (HMAC-SHA256 of ``<timestamp>.<body>``, sent as
+  ``X-Payment-Signature: t=<timestamp>,v1=<hex digest>``), or
+- the payment worker (payment_worker.py), which asks the gateway about
+  payments pending for ``PAYMENT_POLL_AFTER`` seconds (in case a webhook
+  was lost) and expires those pending for ``PAYMENT_EXPIRY`` seconds.
+
+Both go through :func:`apply_result`, which only makes the transitions
+listed in ``TRANSACTION_TRANSITIONS`` and ``ORDER_TRANSITIONS`` and treats a
+result that was already applied as a no-op, so callbacks can be delivered
+any number of times, in any order. Every change is a compare-and-set
+``UPDATE ... WHERE Status = <status read>``: of two processes handling the
+same payment at once, only the one whose update matched a row acts on it,
+the other reads the new status and decides again (SQL Server ignores
+``SELECT ... FOR UPDATE``, so a locking read would not serialize them).
+
+``PAYMENT_GATEWAY`` selects the gateway; ``mock`` is a local stand-in whose
+checkout page (served by the app) lets the buyer approve or decline the
+payment and then delivers a signed webhook like a real provider would.
+Anyone can pay through it, so it is refused unless DEBUG or TESTING is set.
+"""
+import abc
+import hashlib
+import hmac
+import json
+import math
+import secrets
+import string
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app, url_for
+from sqlalchemy import exists, select, update
+
+from app import db
+from app.models import Order, OrderDetail, PaymentTransaction
+from app.utils.metrics import metrics
+
+# Order states (Orders.OrderStatus)
+ORDER_CONFIRMING = 'Chờ xác nhận'  # set by hand by admins
+ORDER_AWAITING_PAYMENT = 'Chờ thanh toán'
+ORDER_COMPLETED = 'Hoàn thành'
+ORDER_CANCELLED = 'Đã hủy'
+
+# Transaction states (PaymentTransactions.Status)
+TRANSACTION_PENDING = 'Đang xử lý'
+TRANSACTION_SUCCEEDED = 'Thành công'
+TRANSACTION_FAILED = 'Thất bại'
+TRANSACTION_EXPIRED = 'Hết hạn'
+
+ORDER_TRANSITIONS = {
+    ORDER_CONFIRMING: {ORDER_AWAITING_PAYMENT, ORDER_COMPLETED, ORDER_CANCELLED},
+    ORDER_AWAITING_PAYMENT: {ORDER_COMPLETED, ORDER_CANCELLED},
+    # A payment confirmed after the order expired was still taken from the buyer
+    ORDER_CANCELLED: {ORDER_COMPLETED},
+    ORDER_COMPLETED: set(),
+}
+TRANSACTION_TRANSITIONS = {
+    TRANSACTION_PENDING: {TRANSACTION_SUCCEEDED, TRANSACTION_FAILED, TRANSACTION_EXPIRED},
+    TRANSACTION_EXPIRED: {TRANSACTION_SUCCEEDED},
+    TRANSACTION_SUCCEEDED: set(),
+    TRANSACTION_FAILED: set(),
+}
+
+# Outcomes reported by gateways
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+PENDING = 'pending'
+RESULT_STATES = {SUCCEEDED: TRANSACTION_SUCCEEDED, FAILED: TRANSACTION_FAILED}
+
+SIGNATURE_HEADER = 'X-Payment-Signature'
+CODE_ALPHABET = string.ascii_uppercase + string.digits
+
+
+# Attempts of a compare-and-set before giving up (each one follows a change by another process)
+MAX_ATTEMPTS = 5
+
+
+class InvalidTransition(Exception):
+    """A state change not allowed by the transition tables."""
+
+
+def sources(state, transitions):
+    """States from which ``state`` may be reached, ``state`` itself included (a no-op)."""
+    return {current for current, targets in transitions.items() if state in targets} | {state}
+
+
+# Signatures
+
+def sign(body, secret, timestamp=None):
+    """Return the signature header value of a webhook body."""
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    digest = hmac.new(secret.encode('utf-8'), b'%d.' % timestamp + body, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={digest}'
+
+
+def verify_signature(body, header, secret, tolerance=300):
+    """Whether ``header`` signs ``body`` with ``secret`` and is at most ``tolerance`` seconds old."""
+    try:
+        fields = dict(part.split('=', 1) for part in header.split(','))
+        timestamp = int(fields['t'])
+    except (KeyError, ValueError):
+        return False
+    # Old signatures are refused, so a captured callback cannot be replayed later
+    if abs(time.time() - timestamp) > tolerance:
+        return False
+    expected = sign(body, secret, timestamp).partition(',v1=')[2]
+    return hmac.compare_digest(expected, fields.get('v1', ''))
+
+
+# Gateways
+
+class PaymentGateway(abc.ABC):
+    """What the pipeline needs from a payment provider."""
+
+    @abc.abstractmethod
+    def checkout_url(self, transaction):
+        """Return the URL of the provider page where the buyer pays ``transaction``."""
+
+    def query(self, transaction_code):
+        """Return the outcome known to the provider (SUCCEEDED, FAILED, PENDING), or None if unknown."""
+        return None
+
+
+class MockGateway(PaymentGateway):
+    """Local stand-in: its checkout page is served by the app (payment_routes)."""
+
+    def checkout_url(self, transaction):
+        return url_for('payments.mock_checkout', code=transaction.TransactionCode)
+
+    def webhook(self, transaction, outcome):
+        """Build the signed callback a provider would send: (body, signature header)."""
+        body = json.dumps({
+            'event_id': uuid.uuid4().hex,
+            'transaction_code': transaction.TransactionCode,
+            'status': outcome,
+            'amount': transaction.Amount,
+        }).encode('utf-8')
+        return body, sign(body, current_app.config['PAYMENT_WEBHOOK_SECRET'])
+
+
+GATEWAYS = {
+    'mock': lambda app: MockGateway(),
+}
+
+
+# Gateways that let anyone pay, for development and tests only
+LOCAL_GATEWAYS = ('mock',)
+
+
+def _create_gateway(app):
+    name = app.config.get('PAYMENT_GATEWAY')
+    if not name:
+        raise ValueError("PAYMENT_GATEWAY is not set")
+    if name not in GATEWAYS:
+        raise ValueError(f"Unknown PAYMENT_GATEWAY: {name}")
+    if name in LOCAL_GATEWAYS and not (app.debug or app.testing):
+        raise ValueError(f"PAYMENT_GATEWAY {name} is only allowed with DEBUG or TESTING")
+    return GATEWAYS[name](app)
+
+
+def init_payments(app):
+    """Create the gateway selected by ``PAYMENT_GATEWAY``, so a missing or unsafe one stops the startup."""
+    app.extensions['payment_gateway'] = _create_gateway(app)
+
+
+def get_gateway():
+    """Return the gateway selected by ``PAYMENT_GATEWAY``, created on first use (maintenance scripts)."""
+    gateway = current_app.extensions.get('payment_gateway')
+    if gateway is None:
+        gateway = current_app.extensions['payment_gateway'] = _create_gateway(current_app)
+    return gateway
+
+
+# State changes
+
+def new_transaction(order, payment_method):
+    """Add a pending transaction for the whole amount of ``order`` to the session."""
+    transaction = PaymentTransaction(
+        OrderID=order.OrderID,
+        Amount=order.TotalAmount,
+        PaymentMethod=payment_method or order.PaymentMethod,
+        TransactionDate=datetime.utcnow(),
+        TransactionCode=''.join(secrets.choice(CODE_ALPHABET) for _ in range(12)),
+        Status=TRANSACTION_PENDING
+    )
+    db.session.add(transaction)
+    return transaction
+
+
+def _read_transaction(transaction_code):
+    return db.session.execute(
+        select(PaymentTransaction).where(PaymentTransaction.TransactionCode == transaction_code)
+    ).scalar_one_or_none()
+
+
+def _set_status(transaction_id, current, state):
+    """Move a transaction from ``current`` to ``state``; False if another process changed it first."""
+    return db.session.execute(
+        update(PaymentTransaction)
+        .where(PaymentTransaction.TransactionID == transaction_id, PaymentTransaction.Status == current)
+        .values(Status=state)
+        .execution_options(synchronize_session=False)
+    ).rowcount == 1
+
+
+def _complete_order(order_id):
+    completed = db.session.execute(
+        update(Order)
+        .where(Order.OrderID == order_id, Order.OrderStatus.in_(sources(ORDER_COMPLETED, ORDER_TRANSITIONS)))
+        .values(OrderStatus=ORDER_COMPLETED, PaymentStatus=True)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    if not completed:
+        raise InvalidTransition(f"Order {order_id} cannot go to '{ORDER_COMPLETED}'")
+
+
+def apply_result(transaction_code, outcome, amount=None, source='webhook'):
+    """
+    Apply an outcome reported by the gateway and commit.
+
+    Args:
+        transaction_code: ``TransactionCode`` of the payment
+        outcome: ``SUCCEEDED`` or ``FAILED``
+        amount: Amount reported by the gateway, checked against the transaction
+        source: What reported it (webhook, poll), for metrics and logs
+
+    Returns:
+        str: ``applied``, ``duplicate`` (already applied), ``ignored`` (not a
+        valid transition, e.g. a failure after a success), ``unknown``
+        (no such transaction) or ``amount_mismatch``
+    """
+    state = RESULT_STATES[outcome]
+    order_id = None
+    for _ in range(MAX_ATTEMPTS):
+        transaction = _read_transaction(transaction_code)
+        if transaction is None:
+            result = 'unknown'
+        elif transaction.Status == state:
+            result = 'duplicate'
+        elif state not in TRANSACTION_TRANSITIONS.get(transaction.Status, ()):
+            current_app.logger.warning(f"Payment {transaction_code}: {outcome} ignored, transaction is "
+                                       f"'{transaction.Status}' ({source})")
+            result = 'ignored'
+        elif amount is not None and abs(float(amount) - transaction.Amount) > 0.005:
+            current_app.logger.error(f"Payment {transaction_code}: {amount} reported for {transaction.Amount} "
+                                     f"({source})")
+            result = 'amount_mismatch'
+        elif not _set_status(transaction.TransactionID, transaction.Status, state):
+            # Changed by another process since it was read: decide again from its new status
+            db.session.rollback()
+            continue
+        else:
+            order_id = transaction.OrderID
+            if state == TRANSACTION_SUCCEEDED:
+                _complete_order(order_id)
+            # After a failure the order keeps waiting: the buyer may pay again
+            result = 'applied'
+        break
+    else:
+        raise RuntimeError(f"Payment {transaction_code}: status kept changing, {outcome} not applied")
+
+    db.session.commit()
+    metrics.inc('payment_results_total', source=source, outcome=outcome, result=result)
+    if result == 'applied' and state == TRANSACTION_SUCCEEDED:
+        _record_purchase(order_id)
+    return result
+
+
+def _record_purchase(order_id):
+    from app.utils import entity_cache, rankings
+
+    metrics.inc('purchases_total')
+    for book_id in db.session.execute(select(OrderDetail.BookID).where(OrderDetail.OrderID == order_id)).scalars():
+        book = entity_cache.books.get(book_id)
+        if book is not None:
+            rankings.record_event(book, rankings.PURCHASE)
+
+
+def expire(transaction_code):
+    """
+    Expire a payment still pending, cancelling its order unless another payment of it is pending.
+
+    Returns:
+        bool: Whether the payment was expired (False if its outcome arrived meanwhile)
+    """
+    transaction = _read_transaction(transaction_code)
+    if transaction is None or transaction.Status != TRANSACTION_PENDING:
+        db.session.commit()
+        return False
+    if not _set_status(transaction.TransactionID, TRANSACTION_PENDING, TRANSACTION_EXPIRED):
+        db.session.rollback()
+        return False
+
+    # Checked by the update itself: a payment of the order may succeed meanwhile
+    other_pending = exists().where(PaymentTransaction.OrderID == Order.OrderID,
+                                   PaymentTransaction.Status == TRANSACTION_PENDING)
+    db.session.execute(
+        update(Order)
+        .where(Order.OrderID == transaction.OrderID, Order.PaymentStatus == False,
+               Order.OrderStatus.in_(sources(ORDER_CANCELLED, ORDER_TRANSITIONS)), ~other_pending)
+        .values(OrderStatus=ORDER_CANCELLED)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    metrics.inc('payment_results_total', source='worker', outcome='expired', result='applied')
+    return True
+
+
+def process_webhook(body, signature):
+    """
+    Verify and apply a gateway callback.
+
+    Returns:
+        tuple: (HTTP status, result); results that a retry cannot change are
+        answered with 200 so the provider stops delivering them
+    """
+    config = current_app.config
+    if not verify_signature(body, signature, config['PAYMENT_WEBHOOK_SECRET'], config['PAYMENT_WEBHOOK_TOLERANCE']):
+        metrics.inc('payment_results_total', source='webhook', outcome='unknown', result='bad_signature')
+        return 400, 'bad_signature'
+    try:
+        event = json.loads(body)
+        transaction_code = str(event['transaction_code'])
+        outcome = event['status']
+        amount = event.get('amount')
+        # Checked here: a signed but odd body must not fail later as a server error
+        if not isinstance(outcome, str):
+            raise TypeError('status is not a string')
+        if amount is not None and (isinstance(amount, bool) or not isinstance(amount, (int, float))
+                                   or not math.isfinite(amount)):
+            raise TypeError('amount is not a number')
+    except (ValueError, KeyError, TypeError):
+        return 400, 'malformed'
+
+    if outcome not in RESULT_STATES:
+        # Intermediate statuses (pending, ...) change nothing here
+        return 200, 'ignored'
+    return 200, apply_result(transaction_code, outcome, amount=amount, source='webhook')
+
+
+def sweep_pending(now=None, batch_size=500):
+    """
+    Poll the gateway about payments pending for a while, and expire stale ones.
+
+    Returns:
+        dict: Counts of ``polled``, ``applied`` and ``expired`` payments
+    """
+    config = current_app.config
+    now = now or datetime.utcnow()
+    poll_before = now - timedelta(seconds=config.get('PAYMENT_POLL_AFTER', 300))
+    expire_before = now - timedelta(seconds=config.get('PAYMENT_EXPIRY', 1800))
+    gateway = get_gateway()
+
+    pending = db.session.execute(
+        select(PaymentTransaction.TransactionCode, PaymentTransaction.TransactionDate)
+        .where(PaymentTransaction.Status == TRANSACTION_PENDING, PaymentTransaction.TransactionDate < poll_before)
+        .order_by(PaymentTransaction.TransactionDate)
+        .limit(batch_size)
+    ).all()
+    db.session.commit()
+
+    counts = {'polled': 0, 'applied': 0, 'expired': 0}
+    for transaction_code, created in pending:
+        try:
+            counts['polled'] += 1
+            outcome = gateway.query(transaction_code)
+            if outcome in RESULT_STATES:
+                if apply_result(transaction_code, outcome, source='poll') == 'applied':
+                    counts['applied'] += 1
+            elif created.replace(tzinfo=None) < expire_before and expire(transaction_code):
+                counts['expired'] += 1
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error sweeping payment {transaction_code}: {str(e)}")
+    return counts
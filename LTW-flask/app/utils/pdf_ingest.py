@@ -0,0 +1,592 @@
+"""
+Streaming inspection of uploaded PDF files.
+
+:func:`inspect_pdf` reads the page count and the title, author and producer
+of a PDF without loading it: it seeks to ``startxref`` at the end of the
+file, follows the cross-reference sections (classic tables, cross-reference
+streams and hybrid files, incremental updates through ``/Prev``) and only
+reads the handful of objects it needs: the trailer, the catalog, the root
+of the page tree and the Info dictionary. Entries of classic tables are
+read at their fixed offsets, compressed sections are inflated in bounded
+chunks, and no object is read beyond ``MAX_OBJECT_SIZE`` bytes, so memory
+stays constant whatever the size of the file.
+
+:func:`render_preview` renders the first page with ``pdftoppm`` (poppler),
+when it is installed, as a fallback cover.
+"""
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import zlib
+from collections import namedtuple
+from io import BytesIO
+
+from flask import current_app
+
+from app.utils.rows import SlotsRow
+
+TAIL_SIZE = 4096  # startxref must be in the last 1024 bytes, leave room for trailing junk
+HEADER_SIZE = 1024
+WINDOW_SIZE = 16 * 1024  # bytes first read at an object offset, doubled while the object does not fit
+MAX_OBJECT_SIZE = 4 * 1024 * 1024  # larger objects (or object streams) are not parsed
+CHUNK_SIZE = 64 * 1024
+MAX_XREF_SECTIONS = 64  # incremental updates followed through /Prev
+
+WHITESPACE = b' \t\r\n\x0c\x00'
+NUMBER_PATTERN = re.compile(rb'[+-]?(?:\d+\.?\d*|\.\d+)')
+REFERENCE_PATTERN = re.compile(rb'\s+(\d+)\s+R(?![^\s()<>\[\]{}/%])')
+NAME_PATTERN = re.compile(rb'/([^\s()<>\[\]{}/%]*)')
+KEYWORD_PATTERN = re.compile(rb'[A-Za-z]+')
+OBJECT_HEADER_PATTERN = re.compile(rb'\s*(\d+)\s+(\d+)\s+obj')
+STREAM_PATTERN = re.compile(rb'\s*stream\r?\n')
+STARTXREF_PATTERN = re.compile(rb'startxref\s+(\d+)')
+VERSION_PATTERN = re.compile(rb'%PDF-(\d\.\d)')
+ESCAPES = {ord('n'): b'\n', ord('r'): b'\r', ord('t'): b'\t', ord('b'): b'\b', ord('f'): b'\f',
+           ord('('): b'(', ord(')'): b')', ord('\\'): b'\\'}
+
+Reference = namedtuple('Reference', 'number generation')
+# What malformed input makes the parser raise, besides PdfError
+MALFORMED_ERRORS = (EOFError, KeyError, TypeError, ValueError, IndexError, AttributeError, zlib.error,
+                    RecursionError)
+
+
+class PdfError(Exception):
+    """The file is not a PDF, or not one this module can read."""
+
+
+class PdfInfo(SlotsRow):
+    """What was read from a PDF; text fields are None when absent or encrypted."""
+    __slots__ = ('page_count', 'title', 'author', 'producer', 'version', 'encrypted')
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f'<PdfInfo {self.page_count} pages {self.title!r}>'
+
+
+# Object syntax
+
+class _Stream:
+    """A stream object: its dictionary and where its data starts in the file."""
+    __slots__ = ('dictionary', 'offset')
+
+    def __init__(self, dictionary, offset):
+        self.dictionary = dictionary
+        self.offset = offset
+
+
+def _skip(data, pos):
+    """Skip whitespace and comments."""
+    while pos < len(data):
+        if data[pos] in WHITESPACE:
+            pos += 1
+        elif data[pos] == 0x25:  # %
+            end = min((i for i in (data.find(b'\n', pos), data.find(b'\r', pos)) if i != -1), default=len(data))
+            pos = end + 1
+        else:
+            break
+    return pos
+
+
+def _parse(data, pos):
+    """
+    Parse one object of ``data`` at ``pos``.
+
+    Names are returned as str, strings as bytes, references as :class:`Reference`.
+
+    Returns:
+        tuple: (object, position after it)
+    """
+    pos = _skip(data, pos)
+    if pos >= len(data):
+        raise EOFError
+    char = data[pos:pos + 1]
+
+    if data.startswith(b'<<', pos):
+        result = {}
+        pos += 2
+        while True:
+            pos = _skip(data, pos)
+            if data.startswith(b'>>', pos):
+                return result, pos + 2
+            key, pos = _parse(data, pos)
+            value, pos = _parse(data, pos)
+            if isinstance(key, str):
+                result[key] = value
+    if char == b'[':
+        result = []
+        pos += 1
+        while True:
+            pos = _skip(data, pos)
+            if data.startswith(b']', pos):
+                return result, pos + 1
+            value, pos = _parse(data, pos)
+            result.append(value)
+    if char == b'/':
+        match = NAME_PATTERN.match(data, pos)
+        name = re.sub(rb'#([0-9A-Fa-f]{2})', lambda m: bytes([int(m.group(1), 16)]), match.group(1))
+        return name.decode('latin-1'), match.end()
+    if char == b'(':
+        return _parse_literal(data, pos + 1)
+    if char == b'<':
+        end = data.find(b'>', pos)
+        if end == -1:
+            raise EOFError
+        digits = re.sub(rb'[^0-9A-Fa-f]', b'', data[pos + 1:end])
+        if len(digits) % 2:
+            digits += b'0'
+        return bytes.fromhex(digits.decode('ascii')), end + 1
+
+    match = NUMBER_PATTERN.match(data, pos)
+    if match:
+        token = match.group()
+        if b'.' in token:
+            return float(token), match.end()
+        reference = REFERENCE_PATTERN.match(data, match.end())
+        if reference:
+            return Reference(int(token), int(reference.group(1))), reference.end()
+        if match.end() == len(data):
+            # "12 0 R" may continue past the end of the window
+            raise EOFError
+        return int(token), match.end()
+
+    match = KEYWORD_PATTERN.match(data, pos)
+    if match:
+        keyword = match.group()
+        if match.end() == len(data):
+            raise EOFError
+        return {b'true': True, b'false': False}.get(keyword), match.end()
+    raise PdfError(f"Unexpected {char!r} at {pos}")
+
+
+def _parse_literal(data, pos):
+    result = bytearray()
+    depth = 1
+    while pos < len(data):
+        byte = data[pos]
+        if byte == 0x5C:  # backslash
+            pos += 1
+            if pos >= len(data):
+                break
+            escaped = data[pos]
+            if escaped in ESCAPES:
+                result += ESCAPES[escaped]
+                pos += 1
+            elif 0x30 <= escaped <= 0x37:
+                digits = re.match(rb'[0-7]{1,3}', data[pos:pos + 3]).group()
+                result.append(int(digits, 8) & 0xFF)
+                pos += len(digits)
+            elif escaped in b'\r\n':
+                # Line continuation
+                pos += 2 if data[pos:pos + 2] == b'\r\n' else 1
+            else:
+                result.append(escaped)
+                pos += 1
+            continue
+        if byte == 0x28:
+            depth += 1
+        elif byte == 0x29:
+            depth -= 1
+            if depth == 0:
+                return bytes(result), pos + 1
+        result.append(byte)
+        pos += 1
+    raise EOFError
+
+
+def _decode_text(value):
+    """Decode a PDF text string (UTF-16 with BOM, UTF-8 with BOM, or PDFDocEncoding)."""
+    if not isinstance(value, bytes):
+        return None
+    if value.startswith(b'\xfe\xff'):
+        text = value[2:].decode('utf-16-be', 'replace')
+    elif value.startswith(b'\xef\xbb\xbf'):
+        text = value[3:].decode('utf-8', 'replace')
+    else:
+        # PDFDocEncoding only differs from Latin-1 in rarely used punctuation
+        text = value.decode('latin-1')
+    text = ' '.join(text.replace('\x00', '').split())
+    return text or None
+
+
+# Reading the file
+
+class _XrefTable:
+    """A classic cross-reference section: subsections of fixed-size entries."""
+
+    def __init__(self, reader, subsections):
+        self.reader = reader
+        self.subsections = subsections  # (first object number, count, offset of the entries, entry size)
+
+    def lookup(self, number):
+        for first, count, offset, entry_size in self.subsections:
+            if first <= number < first + count:
+                entry = self.reader.read_at(offset + (number - first) * entry_size, 18)
+                if entry[17:18] == b'n':
+                    return 'offset', int(entry[:10])
+                return 'free', None
+        return None
+
+
+class _XrefStream:
+    """A cross-reference stream, inflated again on each lookup and never kept."""
+
+    def __init__(self, reader, stream):
+        self.reader = reader
+        self.stream = stream
+        dictionary = stream.dictionary
+        self.widths = dictionary['W']
+        index = dictionary.get('Index') or [0, dictionary['Size']]
+        self.ranges = [(index[i], index[i + 1]) for i in range(0, len(index) - 1, 2)]
+
+    def lookup(self, number):
+        position = 0
+        for first, count in self.ranges:
+            if first <= number < first + count:
+                position += number - first
+                break
+            position += count
+        else:
+            return None
+
+        for row_number, row in enumerate(self.reader.stream_rows(self.stream, sum(self.widths))):
+            if row_number < position:
+                continue
+            fields = []
+            start = 0
+            for width in self.widths:
+                fields.append(int.from_bytes(row[start:start + width], 'big'))
+                start += width
+            entry_type = fields[0] if self.widths[0] else 1
+            if entry_type == 1:
+                return 'offset', fields[1]
+            if entry_type == 2:
+                return 'compressed', (fields[1], fields[2])
+            return 'free', None
+        return None
+
+
+class _Reader:
+    """Random access to the objects of a PDF through its cross-reference sections."""
+
+    def __init__(self, stream):
+        self.file = stream
+        self.file.seek(0, os.SEEK_END)
+        self.size = self.file.tell()
+        self.sections = []
+        self.trailer = {}
+
+    def read_at(self, offset, size):
+        self.file.seek(offset)
+        return self.file.read(size)
+
+    # Cross-reference sections
+
+    def load_xref(self):
+        """Find ``startxref`` and load the chain of sections, newest first."""
+        tail = self.read_at(max(0, self.size - TAIL_SIZE), TAIL_SIZE)
+        matches = list(STARTXREF_PATTERN.finditer(tail))
+        if not matches:
+            raise PdfError("startxref not found")
+        offset = int(matches[-1].group(1))
+
+        seen = set()
+        while offset is not None and offset not in seen and len(self.sections) < MAX_XREF_SECTIONS:
+            seen.add(offset)
+            if not 0 <= offset < self.size:
+                raise PdfError(f"Cross-reference offset {offset} out of the file")
+            head = self.read_at(offset, 32)
+            if _skip(head, 0) < len(head) and head[_skip(head, 0):].startswith(b'xref'):
+                trailer = self._load_table(offset + _skip(head, 0) + 4)
+                # Hybrid files: objects missing from the table are in a cross-reference stream
+                if isinstance(trailer.get('XRefStm'), int):
+                    stream = self.object_at(trailer['XRefStm'])
+                    if isinstance(stream, _Stream):
+                        self.sections.append(_XrefStream(self, stream))
+            else:
+                stream = self.object_at(offset)
+                if not isinstance(stream, _Stream) or stream.dictionary.get('Type') != 'XRef':
+                    raise PdfError("startxref does not point to a cross-reference section")
+                self.sections.append(_XrefStream(self, stream))
+                trailer = stream.dictionary
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            offset = trailer.get('Prev') if isinstance(trailer.get('Prev'), int) else None
+
+    def _load_table(self, pos):
+        """Record the subsections of a classic table and parse its trailer."""
+        subsections = []
+        while True:
+            window = self.read_at(pos, 256)
+            start = _skip(window, 0)
+            if window[start:].startswith(b'trailer'):
+                trailer = self.object_at(pos + start + len(b'trailer'), header=False)
+                if not isinstance(trailer, dict):
+                    raise PdfError("Invalid trailer")
+                self.sections.append(_XrefTable(self, subsections))
+                return trailer
+            match = re.match(rb'(\d+)\s+(\d+)[ \t]*(?:\r\n|\r|\n)', window[start:])
+            if not match:
+                raise PdfError(f"Invalid cross-reference table at {pos}")
+            first, count = int(match.group(1)), int(match.group(2))
+            entries = pos + start + match.end()
+            # 20 bytes per entry, but some writers end lines with a single byte
+            entry_size = 20
+            if count:
+                sample = self.read_at(entries, 21)
+                entry_size = 18 + len(sample[18:]) - len(sample[18:].lstrip(WHITESPACE))
+            subsections.append((first, count, entries, entry_size))
+            pos = entries + count * entry_size
+
+    # Objects
+
+    def object_at(self, offset, header=True):
+        """Parse the (indirect) object at ``offset``, reading as little as possible."""
+        size = WINDOW_SIZE
+        while True:
+            data = self.read_at(offset, size)
+            pos = 0
+            if header:
+                match = OBJECT_HEADER_PATTERN.match(data)
+                if not match:
+                    raise PdfError(f"No object at offset {offset}")
+                pos = match.end()
+            try:
+                value, pos = _parse(data, pos)
+                if isinstance(value, dict):
+                    match = STREAM_PATTERN.match(data, pos)
+                    if match:
+                        return _Stream(value, offset + match.end())
+                    if pos + 16 >= len(data) and len(data) == size:
+                        # "stream" may start past the window
+                        raise EOFError
+                return value
+            except EOFError:
+                if len(data) < size or size >= MAX_OBJECT_SIZE:
+                    raise PdfError(f"Object at offset {offset} is truncated or too large")
+                size *= 2
+
+    def locate(self, number):
+        for section in self.sections:
+            entry = section.lookup(number)
+            if entry is not None:
+                return entry
+        return None
+
+    def get(self, number):
+        """Return the object with the given number, or None if it does not exist."""
+        entry = self.locate(number)
+        if entry is None or entry[0] == 'free':
+            return None
+        if entry[0] == 'offset':
+            return self.object_at(entry[1])
+
+        container_number, index = entry[1]
+        container = self.get(container_number)
+        if not isinstance(container, _Stream):
+            raise PdfError(f"Object stream {container_number} not found")
+        data = b''.join(self.stream_data(container, limit=MAX_OBJECT_SIZE))
+        header, first = container.dictionary.get('N', 0), container.dictionary.get('First', 0)
+        pairs = []
+        pos = 0
+        for _ in range(2 * header):
+            value, pos = _parse(data, pos)
+            pairs.append(value)
+        for i in range(0, len(pairs), 2):
+            if pairs[i] == number:
+                return _parse(data, first + pairs[i + 1])[0]
+        return None
+
+    def resolve(self, value):
+        if isinstance(value, Reference):
+            return self.get(value.number)
+        return value
+
+    # Stream data
+
+    def stream_data(self, stream, limit=None):
+        """Yield the decoded data of a stream in chunks, at most ``limit`` bytes."""
+        dictionary = stream.dictionary
+        length = self.resolve(dictionary.get('Length'))
+        if not isinstance(length, int):
+            raise PdfError("Stream without length")
+        filters = self.resolve(dictionary.get('Filter'))
+        filters = filters if isinstance(filters, list) else [filters] if filters else []
+        if any(name not in ('FlateDecode', 'Fl') for name in filters) or len(filters) > 1:
+            raise PdfError(f"Unsupported stream filters {filters}")
+
+        decompressor = zlib.decompressobj() if filters else None
+        produced = 0
+        remaining = length
+        self.file.seek(stream.offset)
+        while remaining > 0:
+            chunk = self.file.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            position = self.file.tell()
+            while chunk:
+                if decompressor is None:
+                    data, chunk = chunk, b''
+                else:
+                    # Bounded output: a small compressed chunk can inflate enormously
+                    data = decompressor.decompress(chunk, CHUNK_SIZE)
+                    chunk = decompressor.unconsumed_tail
+                produced += len(data)
+                if limit is not None and produced > limit:
+                    raise PdfError(f"Stream larger than {limit} bytes")
+                if data:
+                    yield data
+                    # The consumer may have read elsewhere in the file meanwhile
+                    self.file.seek(position)
+        if decompressor is not None:
+            data = decompressor.flush()
+            if limit is not None and produced + len(data) > limit:
+                raise PdfError(f"Stream larger than {limit} bytes")
+            if data:
+                yield data
+
+    def stream_rows(self, stream, columns):
+        """Yield the rows of a stream of fixed-size records, undoing PNG predictors."""
+        parms = self.resolve(stream.dictionary.get('DecodeParms')) or {}
+        if isinstance(parms, list):
+            parms = parms[0] or {}
+        predictor = parms.get('Predictor', 1)
+        if predictor >= 10:
+            columns = parms.get('Columns', columns)
+        elif predictor != 1:
+            raise PdfError(f"Unsupported predictor {predictor}")
+        row_size = columns + 1 if predictor >= 10 else columns
+
+        previous = bytes(columns)
+        buffer = b''
+        for data in self.stream_data(stream):
+            buffer += data
+            rows = len(buffer) // row_size
+            for i in range(rows):
+                row = buffer[i * row_size:(i + 1) * row_size]
+                if predictor >= 10:
+                    row = previous = _unfilter(row[0], row[1:], previous)
+                yield row
+            buffer = buffer[rows * row_size:]
+
+
+def _unfilter(kind, row, previous):
+    """Undo one PNG filter of a row (one byte per pixel, as in cross-reference streams)."""
+    if kind == 0:
+        return row
+    if kind == 2:
+        return bytes((a + b) & 0xFF for a, b in zip(row, previous))
+    result = bytearray(len(row))
+    for i, value in enumerate(row):
+        left = result[i - 1] if i else 0
+        up = previous[i]
+        if kind == 1:
+            result[i] = (value + left) & 0xFF
+        elif kind == 3:
+            result[i] = (value + (left + up) // 2) & 0xFF
+        elif kind == 4:
+            upper_left = previous[i - 1] if i else 0
+            estimate = left + up - upper_left
+            distances = (abs(estimate - left), abs(estimate - up), abs(estimate - upper_left))
+            nearest = (left, up, upper_left)[distances.index(min(distances))]
+            result[i] = (value + nearest) & 0xFF
+        else:
+            raise PdfError(f"Unknown PNG filter {kind}")
+    return bytes(result)
+
+
+def inspect_pdf(file):
+    """
+    Read the page count and document information of a PDF.
+
+    Args:
+        file: Seekable file-like object (or werkzeug FileStorage)
+
+    Returns:
+        PdfInfo: The page count may be None when the page tree cannot be read
+
+    Raises:
+        PdfError: The file is not a PDF or its cross-reference data is unreadable
+    """
+    stream = getattr(file, 'stream', file)
+    try:
+        reader = _Reader(stream)
+        match = VERSION_PATTERN.search(reader.read_at(0, HEADER_SIZE))
+        if not match:
+            raise PdfError("Missing %PDF header")
+        reader.load_xref()
+
+        encrypted = 'Encrypt' in reader.trailer
+        catalog = reader.resolve(reader.trailer.get('Root'))
+        catalog = catalog.dictionary if isinstance(catalog, _Stream) else catalog
+        if not isinstance(catalog, dict):
+            raise PdfError("Document catalog not found")
+
+        page_count = None
+        try:
+            pages = reader.resolve(catalog.get('Pages'))
+            count = reader.resolve(pages.get('Count')) if isinstance(pages, dict) else None
+            page_count = count if isinstance(count, int) and count >= 0 else None
+        except (PdfError,) + MALFORMED_ERRORS:
+            # Page tree in an encrypted object stream, say
+            pass
+
+        title = author = producer = None
+        if not encrypted:
+            info = reader.resolve(reader.trailer.get('Info'))
+            if isinstance(info, dict):
+                title, author, producer = (_decode_text(reader.resolve(info.get(key)))
+                                           for key in ('Title', 'Author', 'Producer'))
+        return PdfInfo(page_count, title, author, producer, match.group(1).decode('ascii'), encrypted)
+    except MALFORMED_ERRORS as e:
+        raise PdfError(f"Malformed PDF: {e!r}")
+    finally:
+        stream.seek(0)
+
+
+def render_preview(file, width=None):
+    """
+    Render the first page of a PDF as a JPEG with ``pdftoppm``.
+
+    The upload is copied in chunks to a temporary file for the renderer.
+
+    Args:
+        file: The uploaded PDF (werkzeug FileStorage or file-like object)
+        width: Width of the preview in pixels (``PDF_PREVIEW_WIDTH`` by default)
+
+    Returns:
+        BytesIO: The JPEG data, or None if pdftoppm is not installed or failed
+    """
+    command = shutil.which(current_app.config.get('PDF_PREVIEW_COMMAND', 'pdftoppm'))
+    if not command:
+        return None
+    width = width or current_app.config.get('PDF_PREVIEW_WIDTH', 800)
+    stream = getattr(file, 'stream', file)
+
+    with tempfile.TemporaryDirectory(prefix='pdf-preview-') as directory:
+        source = os.path.join(directory, 'book.pdf')
+        stream.seek(0)
+        try:
+            with open(source, 'wb') as f:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    f.write(chunk)
+        finally:
+            stream.seek(0)
+
+        output = os.path.join(directory, 'preview')
+        try:
+            subprocess.run(
+                [command, '-f', '1', '-l', '1', '-singlefile', '-jpeg', '-scale-to-x', str(width),
+                 '-scale-to-y', '-1', source, output],
+                check=True, capture_output=True,
+                timeout=current_app.config.get('PDF_PREVIEW_TIMEOUT', 30)
+            )
+            with open(output + '.jpg', 'rb') as f:
+                return BytesIO(f.read())
+        except (OSError, subprocess.SubprocessError) as e:
+            current_app.logger.warning(f"Could not render PDF preview: {str(e)}")
+            return None
@@ -0,0 +1,244 @@
+"""
+Opt-in sampling profiler for slow endpoints.
+
+A request is profiled when its endpoint is listed in ``PROFILER_ENDPOINTS``
+and it wins the ``PROFILER_SAMPLE_RATE`` lottery, or when an admin sends the
+``X-Profile-Token`` header matching ``PROFILER_TOKEN``. A single background
+thread samples the stacks of the profiled request threads every
+``PROFILER_INTERVAL`` seconds; nothing runs while no request is profiled.
+Finished profiles are kept as JSON files in ``PROFILER_DIR``, which acts as
+a ring buffer of ``PROFILER_MAX_PROFILES`` entries.
+"""
+import hmac
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from flask import current_app, g, request
+
+PROFILE_TOKEN_HEADER = 'X-Profile-Token'
+
+# Time is attributed to the innermost frame that belongs to one of these
+CATEGORIES = (
+    ('jinja', ('jinja2', '.html')),
+    ('sqlalchemy', ('sqlalchemy', 'pyodbc')),
+    ('bcrypt', ('bcrypt',)),
+    ('cloudinary', ('cloudinary', 'urllib3')),
+)
+
+
+class ProfileSession:
+    """Samples collected for one request."""
+
+    def __init__(self, endpoint, path, thread_id):
+        self.endpoint = endpoint
+        self.path = path
+        self.thread_id = thread_id
+        self.started = time.time()
+        self.stacks = Counter()
+        self.categories = Counter()
+
+
+class Sampler:
+    """Background thread that samples the frames of profiled threads."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def start(self, session):
+        with self._lock:
+            self._sessions[session.thread_id] = session
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='profiler-sampler', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def stop(self, session):
+        with self._lock:
+            self._sessions.pop(session.thread_id, None)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                sessions = dict(self._sessions)
+                if not sessions:
+                    self._wakeup.clear()
+                    continue
+
+            frames = sys._current_frames()
+            for thread_id, session in sessions.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stack, category = _collapse(frame)
+                    session.stacks[stack] += 1
+                    session.categories[category] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+def _collapse(frame):
+    """Return the collapsed stack (root first) and the category of a frame."""
+    names = []
+    category = None
+    while frame is not None:
+        code = frame.f_code
+        filename = code.co_filename.replace('\\', '/')
+        if category is None:
+            for name, markers in CATEGORIES:
+                if any(marker in filename for marker in markers):
+                    category = name
+                    break
+        module = os.path.splitext(os.path.basename(filename))[0]
+        names.append(f'{module}.{code.co_name}:{frame.f_lineno}')
+        frame = frame.f_back
+    names.reverse()
+    return ';'.join(names), category or 'python'
+
+
+class Profiler:
+    """Flask extension deciding which requests are profiled and storing results."""
+
+    def __init__(self, app=None):
+        self._sampler = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if not app.config.get('PROFILER_ENABLED'):
+            return
+        os.makedirs(app.config['PROFILER_DIR'], exist_ok=True)
+        self._sampler = Sampler(app.config.get('PROFILER_INTERVAL', 0.005))
+        app.before_request(self._before_request)
+        app.teardown_request(self._teardown_request)
+
+    def _should_profile(self):
+        config = current_app.config
+        token = config.get('PROFILER_TOKEN')
+        header = request.headers.get(PROFILE_TOKEN_HEADER)
+        if token and header:
+            return hmac.compare_digest(header, token)
+        return (request.endpoint in config.get('PROFILER_ENDPOINTS', ())
+                and random.random() < config.get('PROFILER_SAMPLE_RATE', 0))
+
+    def _before_request(self):
+        if not self._should_profile():
+            return
+        session = ProfileSession(request.endpoint, request.full_path, threading.get_ident())
+        g._profile_session = session
+        self._sampler.start(session)
+
+    def _teardown_request(self, exc):
+        session = g.pop('_profile_session', None)
+        if session is None:
+            return
+        self._sampler.stop(session)
+        try:
+            save_profile(session, time.time() - session.started)
+        except OSError as e:
+            current_app.logger.error(f"Error saving profile: {str(e)}")
+
+
+def save_profile(session, duration):
+    """Write a finished profile into the on-disk ring buffer."""
+    directory = current_app.config['PROFILER_DIR']
+    name = f'{time.time_ns()}_{os.getpid()}'
+    data = {
+        'name': name,
+        'endpoint': session.endpoint,
+        'path': session.path,
+        'started': session.started,
+        'duration': duration,
+        'samples': sum(session.stacks.values()),
+        'categories': dict(session.categories),
+        'stacks': dict(session.stacks),
+    }
+    path = os.path.join(directory, f'{name}.json')
+    with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(f'{path}.tmp', path)
+
+    # Drop the oldest profiles beyond the ring buffer size
+    names = sorted(n for n in os.listdir(directory) if n.endswith('.json'))
+    for old in names[:-current_app.config.get('PROFILER_MAX_PROFILES', 50)]:
+        try:
+            os.remove(os.path.join(directory, old))
+        except OSError:
+            pass
+
+
+def list_profiles():
+    """Return the metadata of stored profiles, newest first."""
+    directory = current_app.config['PROFILER_DIR']
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for filename in sorted(os.listdir(directory), reverse=True):
+        if not filename.endswith('.json'):
+            continue
+        profile = load_profile(filename[:-len('.json')])
+        if profile:
+            profile.pop('stacks')
+            profile['started'] = datetime.fromtimestamp(profile['started'])
+            profiles.append(profile)
+    return profiles
+
+
+def load_profile(name):
+    """Load a stored profile by name, or None if it no longer exists."""
+    if not name.replace('_', '').isdigit():
+        return None
+    path = os.path.join(current_app.config['PROFILER_DIR'], f'{name}.json')
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def collapsed_stacks(profile):
+    """Render a profile in the collapsed-stack format used by flamegraph tools."""
+    return ''.join(f'{stack} {count}\n' for stack, count in sorted(profile['stacks'].items()))
+
+
+def flamegraph_rows(profile):
+    """
+    Lay out a profile as an icicle graph.
+
+    Returns:
+        list: One list per depth of (name, offset, width) tuples, where offset
+        and width are percentages of all samples.
+    """
+    total = sum(profile['stacks'].values()) or 1
+    root = {'children': {}, 'count': 0}
+    for stack, count in profile['stacks'].items():
+        node = root
+        for name in stack.split(';'):
+            node = node['children'].setdefault(name, {'children': {}, 'count': 0})
+            node['count'] += count
+
+    rows = []
+
+    def walk(children, depth, offset):
+        for name, node in sorted(children.items()):
+            if depth == len(rows):
+                rows.append([])
+            width = node['count'] * 100.0 / total
+            rows[depth].append((name, offset, width))
+            walk(node['children'], depth + 1, offset)
+            offset += width
+
+    walk(root['children'], 0, 0.0)
+    return rows
+
+
+profiler = Profiler()
@@ -0,0 +1,92 @@
+"""
+Lightweight row objects for list views.
+
+Listing pages only need a handful of columns, so instead of hydrating full
+ORM entities (with the unbounded ``Book.Description`` or the password hash
+of every ``User``) they select exactly the columns their templates render
+and wrap each row in a small ``__slots__`` object.
+"""
+from sqlalchemy import func
+from app import db
+from app.models import Book, Category, User, Role, Order, Review
+from app.utils.rows import SlotsRow
+
+# Listings only show a truncated description
+DESCRIPTION_EXCERPT_LENGTH = 200
+
+
+class BookListItem(SlotsRow):
+    """A book row as rendered by catalog and admin listings."""
+    __slots__ = ('BookID', 'Title', 'Author', 'Price', 'CoverImage', 'CoverVariants', 'CoverPlaceholder',
+                 'AddedDate', 'Status', 'CategoryID', 'CategoryName', 'Description')
+
+    def __repr__(self):
+        return f'<BookListItem {self.Title}>'
+
+
+class UserListItem(SlotsRow):
+    """A user row as rendered by the admin user table."""
+    __slots__ = ('UserID', 'Username', 'Email', 'FullName', 'RegisterDate', 'Status', 'RoleName')
+
+    def __repr__(self):
+        return f'<UserListItem {self.Username}>'
+
+
+class OrderListItem(SlotsRow):
+    """An order row as rendered by the admin order table."""
+    __slots__ = ('OrderID', 'OrderDate', 'TotalAmount', 'PaymentMethod', 'PaymentStatus', 'OrderStatus',
+                 'UserID', 'Username')
+
+    def __repr__(self):
+        return f'<OrderListItem {self.OrderID}>'
+
+
+class ReviewListItem(SlotsRow):
+    """A review row as rendered by the admin review table."""
+    __slots__ = ('ReviewID', 'Rating', 'Comment', 'ReviewDate', 'Status', 'Username', 'BookID', 'Title', 'Author')
+
+    def __repr__(self):
+        return f'<ReviewListItem {self.ReviewID}>'
+
+
+def book_list_query():
+    """
+    Build a query selecting the columns of :class:`BookListItem`.
+
+    ``Description`` only holds the first ``DESCRIPTION_EXCERPT_LENGTH``
+    characters, enough for the ``truncate`` filter used by the templates.
+    """
+    return db.session.query(
+        Book.BookID, Book.Title, Book.Author, Book.Price, Book.CoverImage, Book.CoverVariants, Book.CoverPlaceholder,
+        Book.AddedDate, Book.Status, Book.CategoryID, Category.CategoryName,
+        func.substring(Book.Description, 1, DESCRIPTION_EXCERPT_LENGTH).label('Description')
+    ).outerjoin(Category, Book.CategoryID == Category.CategoryID)
+
+
+def user_list_query():
+    """Build a query selecting the columns of :class:`UserListItem`."""
+    return db.session.query(
+        User.UserID, User.Username, User.Email, User.FullName, User.RegisterDate, User.Status,
+        Role.RoleName
+    ).join(Role, User.RoleID == Role.RoleID)
+
+
+def order_list_query():
+    """Build a query selecting the columns of :class:`OrderListItem`."""
+    return db.session.query(
+        Order.OrderID, Order.OrderDate, Order.TotalAmount, Order.PaymentMethod, Order.PaymentStatus,
+        Order.OrderStatus, Order.UserID, User.Username
+    ).join(User, Order.UserID == User.UserID)
+
+
+def review_list_query():
+    """Build a query selecting the columns of :class:`ReviewListItem`."""
+    return db.session.query(
+        Review.ReviewID, Review.Rating, Review.Comment, Review.ReviewDate, Review.Status,
+        User.Username, Book.BookID, Book.Title, Book.Author
+    ).join(User, Review.UserID == User.UserID).join(Book, Review.BookID == Book.BookID)
+
+
+def book_items(query):
+    """Materialize a :func:`book_list_query` into :class:`BookListItem` objects."""
+    return [BookListItem(*row) for row in query]
@@ -0,0 +1,254 @@
+"""
+Time-decayed sales rankings (bestsellers and trending books and categories).
+
+Every purchase and first download adds to the score of the book and of its
+category. Scores decay exponentially with the half-life configured for the
+ranking in ``RANKING_HALF_LIVES``; instead of decaying every row over time,
+an event at time ``t`` adds ``weight * 2 ** ((t - epoch) / half_life)``, so
+the stored scores of a ranking stay comparable and can be ordered by an
+index. Compaction periodically moves the epoch forward, scales the stored
+scores down accordingly (keeping the numbers small) and drops the rows that
+decayed to nothing.
+
+Pages read the ordered lists from a per-process cache that is reloaded at
+most every ``RANKING_CACHE_SECONDS``, and at once after a compaction or a
+rebuild (announced as ``ranking:<name>`` on the invalidation bus).
+"""
+import math
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import delete, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import Book, Order, OrderDetail, RankingEpoch, RankingScore
+from app.utils.invalidation import bus, invalidate_on_commit, tag
+
+PURCHASE = 'purchase'
+DOWNLOAD = 'download'
+ENTITY_TYPES = ('book', 'category')
+
+# SQL Server ignores SELECT ... FOR UPDATE: its locks are taken with table hints,
+# HOLDLOCK keeping them until the commit
+SHARED_LOCK = 'WITH (HOLDLOCK, ROWLOCK)'
+UPDATE_LOCK = 'WITH (UPDLOCK, HOLDLOCK, ROWLOCK)'
+
+
+def rankings():
+    """Names of the configured rankings."""
+    return tuple(current_app.config['RANKING_HALF_LIVES'])
+
+
+def _growth(ranking, since_epoch):
+    """``2 ** (seconds / half_life)``: the weight of an event ``since_epoch`` after the epoch."""
+    half_life = current_app.config['RANKING_HALF_LIVES'][ranking]
+    return math.exp(math.log(2) * since_epoch.total_seconds() / half_life)
+
+
+def _locked_epoch(ranking, hint, read):
+    """Read the epoch row of ``ranking`` with a lock held until the commit (shared if ``read``)."""
+    return db.session.execute(
+        select(RankingEpoch).where(RankingEpoch.Ranking == ranking)
+        .with_for_update(read=read)
+        .with_hint(RankingEpoch, hint, 'mssql')
+        .execution_options(populate_existing=True)
+    ).scalar_one_or_none()
+
+
+def _epoch(ranking, now):
+    """Return the epoch of ``ranking``, starting it at ``now`` on first use."""
+    # Shared lock: compaction cannot move the epoch until this event is committed
+    row = _locked_epoch(ranking, SHARED_LOCK, read=True)
+    if row is None:
+        try:
+            with db.session.begin_nested():
+                row = RankingEpoch(Ranking=ranking, Epoch=now)
+                db.session.add(row)
+        except IntegrityError:
+            row = db.session.get(RankingEpoch, ranking)
+    return row.Epoch
+
+
+def _add_score(ranking, entity_type, entity_id, purchase, download):
+    """Add to one score row, creating it if needed (atomic, safe under concurrency)."""
+    score = purchase + current_app.config['RANKING_DOWNLOAD_WEIGHT'] * download
+    statement = update(RankingScore).where(
+        RankingScore.Ranking == ranking,
+        RankingScore.EntityType == entity_type,
+        RankingScore.EntityID == entity_id
+    ).values(
+        PurchaseScore=RankingScore.PurchaseScore + purchase,
+        DownloadScore=RankingScore.DownloadScore + download,
+        Score=RankingScore.Score + score
+    ).execution_options(synchronize_session=False)
+
+    if db.session.execute(statement).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(RankingScore(Ranking=ranking, EntityType=entity_type, EntityID=entity_id,
+                                        PurchaseScore=purchase, DownloadScore=download, Score=score))
+    except IntegrityError:
+        # Created by a concurrent event meanwhile
+        db.session.execute(statement)
+
+
+def record_event(book, signal, when=None):
+    """
+    Add a purchase or a download of ``book`` to every ranking and commit.
+
+    Rankings are best effort: a failure is logged and never reaches the
+    purchase or download that triggered it.
+
+    Args:
+        book: The :class:`Book` bought or downloaded
+        signal: ``PURCHASE`` or ``DOWNLOAD``
+        when: Time of the event (naive UTC), defaults to now
+    """
+    when = when or datetime.utcnow()
+    try:
+        for ranking in rankings():
+            value = _growth(ranking, when - _epoch(ranking, when))
+            purchase, download = (value, 0.0) if signal == PURCHASE else (0.0, value)
+            _add_score(ranking, 'book', book.BookID, purchase, download)
+            if book.CategoryID is not None:
+                _add_score(ranking, 'category', book.CategoryID, purchase, download)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error recording {signal} of book {book.BookID} in rankings: {str(e)}")
+
+
+def compact(now=None):
+    """
+    Move the epoch of every ranking to ``now`` and drop negligible scores.
+
+    Returns:
+        dict: Number of rows removed per ranking
+    """
+    now = now or datetime.utcnow()
+    removed = {}
+    for ranking in rankings():
+        # Update lock: compatible with the shared locks of events in flight, so writing
+        # the epoch waits for them, but another compaction waits for this one
+        epoch = _locked_epoch(ranking, UPDATE_LOCK, read=False)
+        if epoch is None:
+            continue
+        factor = 1.0 / _growth(ranking, now - epoch.Epoch)
+        # Written first, so events wait for the rescaled scores instead of using the old epoch
+        epoch.Epoch = now
+        db.session.flush()
+        in_ranking = RankingScore.Ranking == ranking
+        db.session.execute(
+            update(RankingScore).where(in_ranking).values(
+                PurchaseScore=RankingScore.PurchaseScore * factor,
+                DownloadScore=RankingScore.DownloadScore * factor,
+                Score=RankingScore.Score * factor
+            ).execution_options(synchronize_session=False)
+        )
+        result = db.session.execute(
+            delete(RankingScore).where(in_ranking, RankingScore.Score < current_app.config['RANKING_MIN_SCORE'])
+            .execution_options(synchronize_session=False)
+        )
+        invalidate_on_commit(db.session, tag('ranking', ranking))
+        db.session.commit()
+        removed[ranking] = result.rowcount
+    return removed
+
+
+def rebuild(now=None):
+    """
+    Recompute every ranking from the order history, with the epoch at ``now``.
+
+    Returns:
+        int: Number of score rows written
+    """
+    now = now or datetime.utcnow()
+    weight = current_app.config['RANKING_DOWNLOAD_WEIGHT']
+    minimum = current_app.config['RANKING_MIN_SCORE']
+    scores = defaultdict(lambda: [0.0, 0.0])
+
+    rows = db.session.execute(
+        select(OrderDetail.BookID, Book.CategoryID, Order.OrderDate, OrderDetail.DownloadDate)
+        .join(Order, Order.OrderID == OrderDetail.OrderID)
+        .join(Book, Book.BookID == OrderDetail.BookID)
+        .where(Order.PaymentStatus == True)
+        .execution_options(yield_per=1000)
+    )
+    for book_id, category_id, order_date, download_date in rows:
+        entities = [('book', book_id)] + ([('category', category_id)] if category_id is not None else [])
+        for ranking in rankings():
+            events = [(0, order_date)] + ([(1, download_date)] if download_date else [])
+            for column, when in events:
+                value = _growth(ranking, when.replace(tzinfo=None) - now)
+                for entity_type, entity_id in entities:
+                    scores[ranking, entity_type, entity_id][column] += value
+
+    db.session.execute(delete(RankingScore))
+    db.session.execute(delete(RankingEpoch))
+    db.session.add_all(RankingEpoch(Ranking=ranking, Epoch=now) for ranking in rankings())
+    written = 0
+    for (ranking, entity_type, entity_id), (purchase, download) in scores.items():
+        if purchase + weight * download < minimum:
+            continue
+        db.session.add(RankingScore(Ranking=ranking, EntityType=entity_type, EntityID=entity_id,
+                                    PurchaseScore=purchase, DownloadScore=download,
+                                    Score=purchase + weight * download))
+        written += 1
+    invalidate_on_commit(db.session, tag('ranking'))
+    db.session.commit()
+    return written
+
+
+class Leaderboard:
+    """Per-process cache of the ordered ranking lists."""
+
+    def __init__(self):
+        self._lists = {}
+        self._lock = threading.Lock()
+
+    def top(self, ranking, entity_type='book', limit=None):
+        """
+        Return the best entries of a ranking, best first.
+
+        Returns:
+            list: ``(entity ID, current score)`` tuples, the scores decayed to now
+        """
+        key = (ranking, entity_type)
+        cached = self._lists.get(key)
+        if cached is None or time.monotonic() - cached[0] > current_app.config['RANKING_CACHE_SECONDS']:
+            with self._lock:
+                cached = self._lists.get(key)
+                if cached is None or time.monotonic() - cached[0] > current_app.config['RANKING_CACHE_SECONDS']:
+                    cached = self._lists[key] = self._load(ranking, entity_type)
+        _, epoch, entries = cached
+        if epoch is None:
+            return []
+        decay = 1.0 / _growth(ranking, datetime.utcnow() - epoch)
+        return [(entity_id, score * decay) for entity_id, score in entries[:limit]]
+
+    def invalidate(self, tags=None):
+        """Drop the cached lists of the rankings in ``tags`` (all by default), they are reloaded on next use."""
+        rankings_changed = {tag_name.partition(':')[2] for tag_name in tags or [tag('ranking')]}
+        if '*' in rankings_changed:
+            self._lists = {}
+        else:
+            self._lists = {key: cached for key, cached in self._lists.items() if key[0] not in rankings_changed}
+
+    def _load(self, ranking, entity_type):
+        epoch = db.session.get(RankingEpoch, ranking)
+        entries = db.session.execute(
+            select(RankingScore.EntityID, RankingScore.Score)
+            .where(RankingScore.Ranking == ranking, RankingScore.EntityType == entity_type)
+            .order_by(RankingScore.Score.desc(), RankingScore.EntityID)
+            .limit(current_app.config['RANKING_SIZE'])
+        ).all()
+        return time.monotonic(), epoch.Epoch if epoch else None, [tuple(entry) for entry in entries]
+
+
+leaderboard = Leaderboard()
+bus.subscribe('ranking', leaderboard.invalidate)
@@ -0,0 +1,193 @@
+"""
+Filtered queries behind the admin reports (orders, reviews, users) and the
+admin book filters.
+
+Each function applies the filters sent by the report's filter modal in
+SQL and returns a projection query ready to be streamed.
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import desc, or_
+from app import db
+from app.models import Book, Order, Review, User
+from app.utils.catalog_cache import catalog
+from app.utils.facets import YEAR_BUCKETS, PRICE_BANDS, bucket_condition
+from app.utils.projections import order_list_query, review_list_query, user_list_query
+
+ORDER_COMPLETED = 'Hoàn thành'
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d')
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_flag(value):
+    if value in ('0', '1'):
+        return value == '1'
+    return None
+
+
+def _parse_price(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def date_range_conditions(column, args):
+    """Conditions keeping the rows whose ``column`` falls between ``start_date`` and ``end_date`` (inclusive)."""
+    conditions = []
+    start_date = _parse_date(args.get('start_date'))
+    if start_date:
+        conditions.append(column >= start_date)
+    end_date = _parse_date(args.get('end_date'))
+    if end_date:
+        conditions.append(column < end_date + timedelta(days=1))
+    return conditions
+
+
+def category_descendants(category_id):
+    """Return the ID of a category followed by the IDs of all its descendants."""
+    return catalog.category_tree().descendants(category_id)
+
+
+def book_filter_conditions(args, include_facets=True):
+    """
+    Translate the book filters into SQL conditions on ``Book``.
+
+    Args:
+        args: Request arguments (``status``, ``price_min``, ``price_max``,
+            ``search`` and the facets ``category`` including its
+            subcategories, ``year`` bucket and ``price`` band)
+        include_facets: False to leave out the facet filters, for counting
+            the facet options themselves
+
+    Returns:
+        list: Conditions to combine with AND (empty when nothing is filtered)
+    """
+    conditions = []
+
+    if include_facets:
+        if str(args.get('category', '')).isdigit():
+            conditions.append(Book.CategoryID.in_(category_descendants(int(args['category']))))
+        for column, buckets, name in ((Book.PublishYear, YEAR_BUCKETS, 'year'), (Book.Price, PRICE_BANDS, 'price')):
+            condition = bucket_condition(column, buckets, args.get(name))
+            if condition is not None:
+                conditions.append(condition)
+
+    status = _parse_flag(args.get('status'))
+    if status is not None:
+        conditions.append(Book.Status == status)
+
+    price_min = _parse_price(args.get('price_min'))
+    if price_min is not None:
+        conditions.append(Book.Price >= price_min)
+    price_max = _parse_price(args.get('price_max'))
+    if price_max is not None:
+        conditions.append(Book.Price <= price_max)
+
+    search = (args.get('search') or '').strip()
+    if search:
+        conditions.append(or_(Book.Title.like(f'%{search}%'), Book.Author.like(f'%{search}%')))
+
+    return conditions
+
+
+def filter_orders(args):
+    """
+    Build the admin order report query.
+
+    Args:
+        args: Request arguments (``tab``, ``status``, ``payment``,
+            ``start_date``, ``end_date``, ``search``)
+
+    Returns:
+        Query: Orders matching the filters, newest first
+    """
+    query = order_list_query()
+
+    tab = args.get('tab')
+    if tab == 'pending':
+        query = query.filter(Order.OrderStatus != ORDER_COMPLETED)
+    elif tab == 'completed':
+        query = query.filter(Order.OrderStatus == ORDER_COMPLETED)
+
+    if args.get('status'):
+        query = query.filter(Order.OrderStatus == args['status'])
+
+    payment = _parse_flag(args.get('payment'))
+    if payment is not None:
+        query = query.filter(Order.PaymentStatus == payment)
+
+    query = query.filter(*date_range_conditions(Order.OrderDate, args))
+
+    search = (args.get('search') or '').strip().lstrip('#')
+    if search:
+        conditions = [User.Username.like(f'%{search}%')]
+        if search.isdigit():
+            conditions.append(Order.OrderID == int(search))
+        query = query.filter(or_(*conditions))
+
+    return query.order_by(desc(Order.OrderDate))
+
+
+def filter_reviews(args):
+    """
+    Build the admin review report query.
+
+    Args:
+        args: Request arguments (``status``, ``rating``, ``start_date``,
+            ``end_date``, ``search``)
+
+    Returns:
+        Query: Reviews matching the filters, newest first
+    """
+    query = review_list_query()
+
+    status = _parse_flag(args.get('status'))
+    if status is not None:
+        query = query.filter(Review.Status == status)
+
+    if args.get('rating', '').isdigit():
+        query = query.filter(Review.Rating == int(args['rating']))
+
+    query = query.filter(*date_range_conditions(Review.ReviewDate, args))
+
+    search = (args.get('search') or '').strip()
+    if search:
+        query = query.filter(or_(User.Username.like(f'%{search}%'), Book.Title.like(f'%{search}%')))
+
+    return query.order_by(desc(Review.ReviewDate))
+
+
+def filter_users(args):
+    """
+    Build the admin user report query.
+
+    Args:
+        args: Request arguments (``role``, ``status``, ``start_date``,
+            ``end_date`` of registration, ``search``)
+
+    Returns:
+        Query: Users matching the filters, ordered by ID
+    """
+    query = user_list_query()
+
+    if args.get('role', '').isdigit():
+        query = query.filter(User.RoleID == int(args['role']))
+
+    status = _parse_flag(args.get('status'))
+    if status is not None:
+        query = query.filter(User.Status == status)
+
+    query = query.filter(*date_range_conditions(User.RegisterDate, args))
+
+    search = (args.get('search') or '').strip()
+    if search:
+        query = query.filter(or_(User.Username.like(f'%{search}%'),
+                                 User.Email.like(f'%{search}%'),
+                                 User.FullName.like(f'%{search}%')))
+
+    return query.order_by(User.UserID)
@@ -0,0 +1,253 @@
+"""
+Resilience layer for calls to external services (Cloudinary).
+
+Every call made through a :class:`Guard` gets:
+
+- a deadline: the whole call, retries included, must finish within it; each
+  attempt gets the remaining time as its socket timeout;
+- a circuit breaker: after ``threshold`` consecutive failures calls fail
+  fast with :class:`CircuitOpen` for ``reset_timeout`` seconds, then a
+  single trial call decides whether the circuit closes again;
+- jittered exponential retries, for idempotent operations only;
+- optional hedging for idempotent reads: when the first attempt has not
+  answered after ``hedge_after`` seconds a second one is sent, and the
+  first answer wins;
+- a bulkhead: at most ``max_concurrent`` calls of a worker are in flight,
+  later ones wait up to ``max_wait`` seconds and are then rejected with
+  :class:`BulkheadFull` instead of tying up the worker.
+
+The state is per worker process and visible in ``/metrics``.
+"""
+import os
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+
+from app.utils.metrics import metrics
+
+
+class ServiceUnavailable(Exception):
+    """The call was not (completely) made; ``reason`` says why."""
+    reason = 'unavailable'
+
+
+class CircuitOpen(ServiceUnavailable):
+    reason = 'circuit_open'
+
+
+class BulkheadFull(ServiceUnavailable):
+    reason = 'bulkhead_full'
+
+
+class DeadlineExceeded(ServiceUnavailable):
+    reason = 'deadline'
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker (closed, open, half-open)."""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, service, threshold=5, reset_timeout=30):
+        self.service = service
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise :class:`CircuitOpen` unless a call may be made now."""
+        with self._lock:
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._trial_running):
+                raise CircuitOpen(f"{self.service} circuit is open")
+            if self.state == self.HALF_OPEN:
+                self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_running = False
+            if self.state != self.CLOSED:
+                self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.threshold):
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+    def release(self):
+        """Give up a trial call that was never made."""
+        with self._lock:
+            self._trial_running = False
+
+    def _set_state(self, state):
+        # The gauge sums over workers: number of workers whose circuit is open
+        if state == self.OPEN:
+            metrics.gauge_add('external_circuit_open', 1, service=self.service)
+        elif self.state == self.OPEN:
+            metrics.gauge_add('external_circuit_open', -1, service=self.service)
+        metrics.inc('external_circuit_transitions_total', service=self.service, state=state)
+        self.state = state
+
+
+class Bulkhead:
+    """Caps the concurrent calls of a worker to one service."""
+
+    def __init__(self, service, max_concurrent=4, max_wait=1.0):
+        self.service = service
+        self.max_concurrent = max_concurrent
+        self.max_wait = max_wait
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+
+    @contextmanager
+    def slot(self, timeout):
+        if not self._slots.acquire(timeout=max(0.0, min(self.max_wait, timeout))):
+            raise BulkheadFull(f"{self.max_concurrent} {self.service} calls already in flight")
+        metrics.gauge_add('external_calls_in_flight', 1, service=self.service)
+        try:
+            yield
+        finally:
+            metrics.gauge_add('external_calls_in_flight', -1, service=self.service)
+            self._slots.release()
+
+
+class Guard:
+    """Runs the calls to one service through its breaker, bulkhead, deadline and retry policy."""
+
+    def __init__(self, service, breaker, bulkhead, max_attempts=3, base_delay=0.2, max_delay=2.0,
+                 retryable=lambda error: True):
+        """
+        Args:
+            service: Name used in metrics and messages
+            breaker: The :class:`CircuitBreaker` of the service
+            bulkhead: The :class:`Bulkhead` of the service
+            max_attempts: Attempts of an idempotent call, the first one included
+            base_delay: Upper bound of the first retry delay, doubled on each retry
+            max_delay: Upper bound of any retry delay
+            retryable: Tells transient errors (worth a retry, counted by the
+                breaker) from permanent ones (the service answered, e.g. 404)
+        """
+        self.service = service
+        self.breaker = breaker
+        self.bulkhead = bulkhead
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retryable = retryable
+        self._executor = None
+        self._executor_pid = None
+
+    @classmethod
+    def from_config(cls, service, config, retryable=lambda error: True):
+        """Build a guard from the ``EXTERNAL_*`` settings."""
+        return cls(
+            service,
+            CircuitBreaker(service, config.get('EXTERNAL_BREAKER_THRESHOLD', 5),
+                           config.get('EXTERNAL_BREAKER_RESET', 30)),
+            Bulkhead(service, config.get('EXTERNAL_MAX_CONCURRENT', 4), config.get('EXTERNAL_BULKHEAD_WAIT', 1.0)),
+            max_attempts=config.get('EXTERNAL_RETRY_ATTEMPTS', 3),
+            base_delay=config.get('EXTERNAL_RETRY_BASE_DELAY', 0.2),
+            max_delay=config.get('EXTERNAL_RETRY_MAX_DELAY', 2.0),
+            retryable=retryable,
+        )
+
+    def call(self, operation, fn, deadline, idempotent=False, hedge_after=None):
+        """
+        Call ``fn(timeout)`` within ``deadline`` seconds.
+
+        Args:
+            operation: Name of the operation, for metrics
+            fn: Makes one attempt; ``timeout`` is the time left in seconds
+            deadline: Seconds the whole call may take, retries included
+            idempotent: Whether failed attempts may be retried (and hedged)
+            hedge_after: Seconds after which an idempotent attempt is hedged
+
+        Returns:
+            The result of the first successful attempt
+
+        Raises:
+            ServiceUnavailable: The circuit is open, the bulkhead is full or
+                the deadline passed before an attempt could be made
+            Exception: The error of the last attempt
+        """
+        end = time.monotonic() + deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"{self.service} {operation} exceeded its {deadline}s deadline")
+            try:
+                self.breaker.before_call()
+            except CircuitOpen:
+                metrics.inc('external_calls_total', service=self.service, operation=operation, result='rejected')
+                raise
+            try:
+                with self.bulkhead.slot(remaining):
+                    if idempotent and hedge_after is not None:
+                        result = self._hedged(operation, fn, end, hedge_after)
+                    else:
+                        result = fn(end - time.monotonic())
+            except ServiceUnavailable:
+                self.breaker.release()
+                metrics.inc('external_calls_total', service=self.service, operation=operation, result='rejected')
+                raise
+            except Exception as e:
+                if not self.retryable(e):
+                    # The service answered, it is only this request that failed
+                    self.breaker.record_success()
+                    metrics.inc('external_calls_total', service=self.service, operation=operation, result='error')
+                    raise
+                self.breaker.record_failure()
+                metrics.inc('external_calls_total', service=self.service, operation=operation, result='failure')
+                # Full jitter: a random delay up to the exponential bound
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+                if not idempotent or attempt >= self.max_attempts or time.monotonic() + delay >= end:
+                    raise
+                metrics.inc('external_retries_total', service=self.service, operation=operation)
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            metrics.inc('external_calls_total', service=self.service, operation=operation, result='ok')
+            return result
+
+    def _hedged(self, operation, fn, end, hedge_after):
+        executor = self._get_executor()
+        pending = {executor.submit(fn, end - time.monotonic())}
+        done, pending = wait(pending, timeout=min(hedge_after, max(0.0, end - time.monotonic())))
+        if not done:
+            metrics.inc('external_hedged_requests_total', service=self.service, operation=operation)
+            pending.add(executor.submit(fn, end - time.monotonic()))
+        error = None
+        while pending or done:
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            if not pending:
+                break
+            done, pending = wait(pending, timeout=max(0.0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not done:
+                # A slow service is a failing one, for the breaker and the retries
+                raise TimeoutError(f"{self.service} {operation} did not answer in time")
+        raise error
+
+    def _get_executor(self):
+        # Threads do not survive a fork, every worker starts its own
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=2 * self.bulkhead.max_concurrent,
+                                                thread_name_prefix=f'{self.service}-hedge')
+            self._executor_pid = os.getpid()
+        return self._executor
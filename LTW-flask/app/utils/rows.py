@@ -0,0 +1,15 @@
+"""Base class of the small read-only row objects (list items, cache snapshots, PDF facts)."""
+
+
+class SlotsRow:
+    """
+    Row of values named by the ``__slots__`` of the subclass.
+
+    ``Row(*values)`` sets the slots in order, so a subclass only declares its
+    ``__slots__`` in the order of the columns it is built from.
+    """
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
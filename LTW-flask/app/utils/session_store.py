@@ -0,0 +1,208 @@
+"""
+Server-side sessions (Flask-Session).
+
+Only a random session ID travels in the cookie; the session data (login
+state, flashed messages, CSRF token) stays on the server. ``SESSION_TYPE``
+selects the backend:
+
+- ``sqlite`` (default): :class:`LocalRedis`, a SQLite file implementing the
+  part of the Redis API Flask-Session uses. It is shared by all worker
+  processes of one machine and needs no extra service.
+- ``redis``: a real Redis server at ``SESSION_REDIS_URL``, for several nodes.
+- ``filesystem``: Flask-Session's file backend (one file per session).
+
+Sessions expire after ``PERMANENT_SESSION_LIFETIME``. Expired entries are
+dropped lazily: when read, and by a sweep run at most every
+``SESSION_SWEEP_INTERVAL`` seconds when sessions are written.
+
+The IDs of the sessions of every logged in user are indexed, so all of
+them can be revoked at once (e.g. when a user is banned).
+"""
+import os
+import sqlite3
+import threading
+import time
+
+from flask import current_app, session
+from flask_session import Session
+
+USER_INDEX_PREFIX = 'user_sessions:'
+
+
+class LocalRedis:
+    """SQLite-backed stand-in for the subset of ``redis.Redis`` used for sessions."""
+
+    def __init__(self, path, sweep_interval=300):
+        self.path = path
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._swept_at = 0.0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, expires REAL)')
+        conn.execute('CREATE TABLE IF NOT EXISTS sets (key TEXT, member TEXT, expires REAL, '
+                     'PRIMARY KEY (key, member))')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_kv_expires ON kv (expires)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_sets_expires ON sets (expires)')
+
+    def _connection(self):
+        # One connection per thread and process (never reuse one across a fork);
+        # SQLite serializes the writers of all processes
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _expires(self, seconds):
+        if seconds is None:
+            return None
+        if hasattr(seconds, 'total_seconds'):
+            seconds = seconds.total_seconds()
+        return time.time() + seconds
+
+    def _maybe_sweep(self, conn):
+        now = time.time()
+        if now - self._swept_at < self.sweep_interval:
+            return
+        self._swept_at = now
+        conn.execute('DELETE FROM kv WHERE expires IS NOT NULL AND expires <= ?', (now,))
+        conn.execute('DELETE FROM sets WHERE expires IS NOT NULL AND expires <= ?', (now,))
+
+    def get(self, name):
+        row = self._connection().execute('SELECT value, expires FROM kv WHERE key = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        if row[1] is not None and row[1] <= time.time():
+            self.delete(name)
+            return None
+        return row[0]
+
+    def set(self, name, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+                     (name, value, self._expires(ex)))
+        self._maybe_sweep(conn)
+        return True
+
+    def setex(self, name, time, value):
+        return self.set(name, value, ex=time)
+
+    def delete(self, *names):
+        conn = self._connection()
+        deleted = 0
+        for name in names:
+            removed = conn.execute('DELETE FROM kv WHERE key = ?', (name,)).rowcount
+            removed += conn.execute('DELETE FROM sets WHERE key = ?', (name,)).rowcount
+            deleted += bool(removed)
+        return deleted
+
+    def expire(self, name, time):
+        conn = self._connection()
+        expires = self._expires(time)
+        changed = conn.execute('UPDATE kv SET expires = ? WHERE key = ?', (expires, name)).rowcount
+        changed += conn.execute('UPDATE sets SET expires = ? WHERE key = ?', (expires, name)).rowcount
+        return bool(changed)
+
+    def sadd(self, name, *values):
+        conn = self._connection()
+        # New members inherit the expiry of the set
+        row = conn.execute('SELECT expires FROM sets WHERE key = ? LIMIT 1', (name,)).fetchone()
+        expires = row[0] if row else None
+        return sum(conn.execute('INSERT OR IGNORE INTO sets (key, member, expires) VALUES (?, ?, ?)',
+                                (name, str(value), expires)).rowcount for value in values)
+
+    def srem(self, name, *values):
+        conn = self._connection()
+        return sum(conn.execute('DELETE FROM sets WHERE key = ? AND member = ?', (name, str(value))).rowcount
+                   for value in values)
+
+    def smembers(self, name):
+        rows = self._connection().execute(
+            'SELECT member FROM sets WHERE key = ? AND (expires IS NULL OR expires > ?)', (name, time.time())
+        ).fetchall()
+        return {row[0].encode('utf-8') for row in rows}
+
+
+def init_sessions(app):
+    """Configure Flask-Session for ``app`` according to ``SESSION_TYPE``."""
+    session_type = app.config.setdefault('SESSION_TYPE', 'sqlite')
+    if session_type == 'sqlite':
+        app.config['SESSION_TYPE'] = 'redis'
+        app.config['SESSION_REDIS'] = LocalRedis(app.config['SESSION_SQLITE_PATH'],
+                                                 app.config.get('SESSION_SWEEP_INTERVAL', 300))
+    elif session_type == 'redis' and app.config.get('SESSION_REDIS') is None:
+        import redis
+        app.config['SESSION_REDIS'] = redis.Redis.from_url(app.config['SESSION_REDIS_URL'])
+
+    Session(app)
+    app.config['SESSION_TYPE'] = session_type
+
+
+def _delete_keys(interface, keys):
+    if hasattr(interface, 'redis'):
+        interface.redis.delete(*keys)
+    else:
+        for key in keys:
+            interface.cache.delete(key)
+
+
+def _index_add(interface, user_id, sid, lifetime):
+    key = f'{USER_INDEX_PREFIX}{user_id}'
+    if hasattr(interface, 'redis'):
+        interface.redis.sadd(key, sid)
+        interface.redis.expire(key, lifetime)
+    else:
+        sids = interface.cache.get(key) or set()
+        sids.add(sid)
+        interface.cache.set(key, sids, timeout=int(lifetime.total_seconds()))
+
+
+def _index_pop(interface, user_id):
+    key = f'{USER_INDEX_PREFIX}{user_id}'
+    if hasattr(interface, 'redis'):
+        sids = {sid.decode('utf-8') for sid in interface.redis.smembers(key)}
+        interface.redis.delete(key)
+    else:
+        sids = interface.cache.get(key) or set()
+        interface.cache.delete(key)
+    return sids
+
+
+def start_user_session(user_id):
+    """
+    Give the current session a new ID and index it under ``user_id``.
+
+    Call it right after logging a user in; the new ID prevents a session ID
+    planted before the login from being used afterwards.
+    """
+    interface = current_app.session_interface
+    old_sid = getattr(session, 'sid', None)
+    if old_sid is None:
+        return
+    _delete_keys(interface, [interface.key_prefix + old_sid])
+    session.sid = interface._generate_sid()
+    session.modified = True
+    _index_add(interface, user_id, session.sid, current_app.permanent_session_lifetime)
+
+
+def revoke_user_sessions(user_id):
+    """
+    Delete every server-side session of a user, logging them out everywhere.
+
+    Returns:
+        int: Number of sessions revoked
+    """
+    interface = current_app.session_interface
+    sids = _index_pop(interface, user_id)
+    keys = [interface.key_prefix + sid for sid in sids]
+    if keys:
+        _delete_keys(interface, keys)
+    return len(keys)
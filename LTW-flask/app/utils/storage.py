@@ -0,0 +1,413 @@
+"""
+Pluggable storage backends for uploaded assets.
+
+``STORAGE_BACKEND`` selects where covers and book files live:
+
+* ``cloudinary`` (default) keeps everything on Cloudinary as before.
+* ``local`` stores files below ``STORAGE_LOCAL_ROOT`` and serves them through
+  the ``storage.serve_file`` route, so the whole app runs without network
+  access (tests, benchmarks, self-hosted PDFs).
+
+Both backends identify assets by a Cloudinary-style public ID and return
+upload results shaped like Cloudinary's (``secure_url``, ``public_id``,
+``bytes``), which keeps :mod:`app.utils.cloudinary_utils` unchanged for its
+callers.
+
+Every Cloudinary call goes through a :class:`app.utils.resilience.Guard`
+(deadline from ``CLOUDINARY_DEADLINES``, circuit breaker, retries of
+idempotent operations, bulkhead); ``CLOUDINARY_UPLOAD_PREFIX`` points the
+API calls at another server, e.g. ``fake_cloudinary_server.py``.
+"""
+import abc
+import hashlib
+import json
+import mmap
+import os
+import re
+import secrets
+import tempfile
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from flask import current_app
+from werkzeug.utils import secure_filename
+
+from app.utils.resilience import Guard
+
+STREAM_CHUNK_SIZE = 64 * 1024
+# Cloudinary deletes at most this many assets per Admin API call
+DELETE_BATCH_SIZE = 100
+
+# Magic numbers of the file types we accept (see ALLOWED_EXTENSIONS)
+CONTENT_TYPES = (
+    (b'%PDF', 'application/pdf'),
+    (b'\x89PNG', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'RIFF', 'image/webp'),
+)
+
+
+class StorageBackend(abc.ABC):
+    """Interface implemented by every storage backend."""
+
+    @abc.abstractmethod
+    def put(self, file, folder=None, public_id=None, resource_type='image', image_format=None):
+        """
+        Store a file.
+
+        Args:
+            file: File-like object (or werkzeug FileStorage) to store
+            folder: Folder to store the file in, a unique public ID is generated from its name
+            public_id: Explicit public ID, an existing asset with that ID is overwritten
+            resource_type: Cloudinary resource type (image, raw)
+            image_format: Format of already encoded image data (webp, jpeg)
+
+        Returns:
+            dict: ``secure_url``, ``public_id`` and ``bytes`` of the stored asset
+        """
+
+    def get(self, public_id, resource_type='image'):
+        """Return the whole content of an asset as bytes."""
+        content = bytearray()
+        for chunk in self.stream_range(public_id, resource_type=resource_type):
+            content += chunk
+        return bytes(content)
+
+    @abc.abstractmethod
+    def delete(self, public_id, resource_type='image'):
+        """Delete an asset, returning a Cloudinary-style ``{'result': ...}`` dict."""
+
+    def delete_many(self, public_ids, resource_type='image'):
+        """Delete several assets of the same resource type."""
+        for public_id in public_ids:
+            self.delete(public_id, resource_type)
+        return {'result': 'ok'}
+
+    @abc.abstractmethod
+    def url(self, public_id, resource_type='image'):
+        """Return the public URL of an asset."""
+
+    @abc.abstractmethod
+    def locate(self, url):
+        """Return ``(public_id, resource_type)`` of an asset URL, or None if it is not ours."""
+
+    @abc.abstractmethod
+    def stat(self, public_id, resource_type='image'):
+        """Return ``size``, ``content_type`` and ``modified`` of an asset, or None if missing."""
+
+    @abc.abstractmethod
+    def stream_range(self, public_id, start=0, end=None, resource_type='image'):
+        """
+        Yield the bytes ``[start, end)`` of an asset in chunks.
+
+        Chunks are bytes-like (``memoryview`` for local files) and only valid
+        until the next one is requested: copy what must be kept.
+        """
+
+
+class CloudinaryError(Exception):
+    """A refused call to Cloudinary's upload API, with the HTTP status it was answered with."""
+
+    def __init__(self, code, message):
+        super().__init__(f"Error {code} - {message}")
+        self.code = code
+
+
+class CloudinaryStorage(StorageBackend):
+    """Assets stored on Cloudinary."""
+
+    URL_PATTERN = re.compile(r'^https?://res\.cloudinary\.com/[^/]+/(image|raw)/upload/(?:v\d+/)?(.+)$')
+    # Errors of the Admin API meaning Cloudinary answered and refused this request:
+    # not retried, not counted by the breaker (the upload API is classified by HTTP status)
+    PERMANENT_ERRORS = ('BadRequest', 'AuthorizationRequired', 'NotAllowed', 'NotFound', 'AlreadyExists')
+
+    def __init__(self, cloud_name=None, api_key=None, api_secret=None, upload_prefix=None, guard=None,
+                 deadlines=None, hedge_after=None):
+        self.credentials = {'cloud_name': cloud_name, 'api_key': api_key, 'api_secret': api_secret}
+        if upload_prefix:
+            self.credentials['upload_prefix'] = upload_prefix
+        self.guard = guard or Guard.from_config('cloudinary', {}, retryable=self.retryable)
+        self.deadlines = deadlines or {}
+        self.hedge_after = hedge_after
+        self._configured = False
+
+    @classmethod
+    def retryable(cls, error):
+        # Server errors and throttling are worth a retry, other refusals are final
+        if isinstance(error, (urllib.error.HTTPError, CloudinaryError)):
+            return error.code >= 500 or error.code == 429
+        return type(error).__name__ not in cls.PERMANENT_ERRORS
+
+    def _configure(self):
+        # The SDK is slow to import, so it is loaded and configured on first use
+        if not self._configured:
+            import cloudinary
+            import cloudinary.utils
+            cloudinary.config(**self.credentials)
+            self._http = cloudinary.utils.get_http_connector(cloudinary.config(), cloudinary.CERT_KWARGS)
+            self._configured = True
+
+    def _upload_api(self, action, params, timeout, resource_type, file=None):
+        """
+        Make a signed call to the upload API (``upload``, ``destroy``).
+
+        The request is sent here rather than by ``cloudinary.uploader``, which
+        raises the same error for a 400 as for a 500 and keeps the status to
+        itself; only the SDK's public helpers build and sign the parameters.
+
+        Raises:
+            CloudinaryError: Cloudinary answered with an error, see :meth:`retryable`
+        """
+        import cloudinary
+        import cloudinary.utils
+        params = cloudinary.utils.sign_request(cloudinary.utils.cleanup_params(params), {})
+        fields = []
+        for name, value in params.items():
+            if isinstance(value, list):
+                fields.extend((f'{name}[]', item) for item in value)
+            elif value:
+                fields.append((name, value))
+        if file is not None:
+            stream = getattr(file, 'stream', file)
+            # A retry starts over from the beginning of the stream
+            stream.seek(0)
+            filename = getattr(file, 'filename', None) or os.path.basename(str(getattr(stream, 'name', '')))
+            fields.append(('file', (filename or 'file', stream.read())))
+
+        # Retries are left to the guard, which knows the deadline
+        response = self._http.request('POST', cloudinary.utils.cloudinary_api_url(action, resource_type=resource_type),
+                                      fields=fields, headers={'User-Agent': cloudinary.get_user_agent()},
+                                      timeout=timeout, retries=False)
+        try:
+            result = json.loads(response.data.decode('utf-8'))
+        except ValueError:
+            raise CloudinaryError(response.status, f'Unreadable response {response.data[:200]!r}')
+        if response.status >= 400 or 'error' in result:
+            raise CloudinaryError(response.status, result.get('error', {}).get('message'))
+        return result
+
+    def _call(self, operation, fn, idempotent, hedge=False):
+        return self.guard.call(operation, fn, self.deadlines.get(operation, 30), idempotent=idempotent,
+                               hedge_after=self.hedge_after if hedge else None)
+
+    def put(self, file, folder=None, public_id=None, resource_type='image', image_format=None):
+        self._configure()
+        import cloudinary.utils
+        options = {'resource_type': resource_type}
+        if public_id:
+            options.update(public_id=public_id, overwrite=True)
+        else:
+            options.update(folder=folder, use_filename=True, unique_filename=True)
+        if image_format:
+            options['format'] = image_format
+
+        def upload(timeout):
+            # Signed again on every attempt: the timestamp is part of the signature
+            params = cloudinary.utils.build_upload_params(**options)
+            return self._upload_api('upload', params, timeout, resource_type, file=file)
+
+        # Without an explicit public ID a repeated upload would create a second asset
+        return self._call('upload', upload, idempotent=bool(public_id))
+
+    def delete(self, public_id, resource_type='image'):
+        self._configure()
+        import cloudinary.utils
+
+        def destroy(timeout):
+            params = {'timestamp': cloudinary.utils.now(), 'public_id': public_id}
+            return self._upload_api('destroy', params, timeout, resource_type)
+
+        return self._call('delete', destroy, idempotent=True)
+
+    def delete_many(self, public_ids, resource_type='image'):
+        self._configure()
+        import cloudinary.api
+        public_ids = list(public_ids)
+        deleted = {}
+        for start in range(0, len(public_ids), DELETE_BATCH_SIZE):
+            batch = public_ids[start:start + DELETE_BATCH_SIZE]
+            result = self._call('delete', lambda timeout: cloudinary.api.delete_resources(
+                batch, resource_type=resource_type, timeout=timeout), idempotent=True)
+            deleted.update(result.get('deleted', {}))
+        return {'deleted': deleted}
+
+    def url(self, public_id, resource_type='image'):
+        self._configure()
+        import cloudinary.utils
+        return cloudinary.utils.cloudinary_url(public_id, resource_type=resource_type, secure=True)[0]
+
+    def locate(self, url):
+        match = self.URL_PATTERN.match(url or '')
+        if not match:
+            return None
+        resource_type, public_id = match.groups()
+        if resource_type == 'image':
+            # Image public IDs do not include the delivery format
+            public_id = os.path.splitext(public_id)[0]
+        return public_id, resource_type
+
+    def stat(self, public_id, resource_type='image'):
+        request = urllib.request.Request(self.url(public_id, resource_type), method='HEAD')
+
+        def head(timeout):
+            try:
+                with urllib.request.urlopen(request, timeout=timeout) as response:
+                    return {
+                        'size': int(response.headers.get('Content-Length', 0)),
+                        'content_type': response.headers.get('Content-Type'),
+                        'modified': response.headers.get('Last-Modified'),
+                    }
+            except urllib.error.HTTPError as e:
+                if e.code == 404:
+                    return None
+                raise
+
+        return self._call('stat', head, idempotent=True, hedge=True)
+
+    def stream_range(self, public_id, start=0, end=None, resource_type='image'):
+        request = urllib.request.Request(self.url(public_id, resource_type))
+        if start or end is not None:
+            last = '' if end is None else end - 1
+            request.add_header('Range', f'bytes={start}-{last}')
+        # Only opening the response is guarded, the body is streamed afterwards without holding a slot
+        response = self._call('read', lambda timeout: urllib.request.urlopen(request, timeout=timeout),
+                              idempotent=True)
+        with response:
+            for chunk in iter(lambda: response.read(STREAM_CHUNK_SIZE), b''):
+                yield chunk
+
+
+class LocalStorage(StorageBackend):
+    """
+    Assets stored on the local disk.
+
+    Files are sharded in two directory levels by the SHA-256 of their public
+    ID (``ab/cd/abcd...``) so no directory grows too large, written to a
+    temporary file and renamed into place so readers never see partial
+    files, and read back through memory maps. Their URLs are ``url_prefix``
+    followed by the public ID (``STORAGE_LOCAL_URL``, where
+    ``storage.serve_file`` is mounted).
+    """
+
+    def __init__(self, root, url_prefix='/files/'):
+        self.root = root
+        self.url_prefix = url_prefix
+
+    def _path(self, public_id):
+        digest = hashlib.sha256(public_id.encode('utf-8')).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def _new_public_id(self, file, folder):
+        filename = secure_filename(getattr(file, 'filename', None) or '') or 'file'
+        stem = os.path.splitext(filename)[0]
+        # Same naming as Cloudinary's use_filename + unique_filename
+        return f'{folder}/{stem}_{secrets.token_hex(3)}' if folder else f'{stem}_{secrets.token_hex(3)}'
+
+    def put(self, file, folder=None, public_id=None, resource_type='image', image_format=None):
+        public_id = public_id or self._new_public_id(file, folder)
+        path = self._path(public_id)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+
+        stream = getattr(file, 'stream', file)
+        stream.seek(0)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in iter(lambda: stream.read(STREAM_CHUNK_SIZE), b''):
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        finally:
+            stream.seek(0)
+
+        return {
+            'public_id': public_id,
+            'secure_url': self.url(public_id, resource_type),
+            'resource_type': resource_type,
+            'bytes': size,
+        }
+
+    def get(self, public_id, resource_type='image'):
+        with open(self._path(public_id), 'rb') as f:
+            return f.read()
+
+    def delete(self, public_id, resource_type='image'):
+        try:
+            os.remove(self._path(public_id))
+        except FileNotFoundError:
+            return {'result': 'not found'}
+        return {'result': 'ok'}
+
+    def url(self, public_id, resource_type='image'):
+        # Built from the configuration rather than url_for: jobs have no request to build URLs from
+        return self.url_prefix + urllib.parse.quote(public_id)
+
+    def locate(self, url):
+        if not url or not url.startswith(self.url_prefix):
+            return None
+        return urllib.parse.unquote(url[len(self.url_prefix):]), 'image'
+
+    def stat(self, public_id, resource_type='image'):
+        path = self._path(public_id)
+        try:
+            info = os.stat(path)
+            with open(path, 'rb') as f:
+                head = f.read(16)
+        except FileNotFoundError:
+            return None
+        content_type = next((mime for magic, mime in CONTENT_TYPES if head.startswith(magic)),
+                            'application/octet-stream')
+        return {'size': info.st_size, 'content_type': content_type, 'modified': info.st_mtime}
+
+    def stream_range(self, public_id, start=0, end=None, resource_type='image'):
+        with open(self._path(public_id), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            end = size if end is None else min(end, size)
+            if start >= end:
+                return
+            # The page cache backs the map, chunks are views of it (no copy); each one
+            # is released before the next, the map cannot be closed while one is alive
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, memoryview(mapped) as view:
+                for offset in range(start, end, STREAM_CHUNK_SIZE):
+                    chunk = view[offset:min(offset + STREAM_CHUNK_SIZE, end)]
+                    try:
+                        yield chunk
+                    finally:
+                        chunk.release()
+
+
+BACKENDS = {
+    'cloudinary': lambda app: CloudinaryStorage(
+        app.config['CLOUDINARY_CLOUD_NAME'], app.config['CLOUDINARY_API_KEY'], app.config['CLOUDINARY_API_SECRET'],
+        upload_prefix=app.config.get('CLOUDINARY_UPLOAD_PREFIX'),
+        guard=Guard.from_config('cloudinary', app.config, retryable=CloudinaryStorage.retryable),
+        deadlines=app.config.get('CLOUDINARY_DEADLINES'),
+        hedge_after=app.config.get('CLOUDINARY_HEDGE_AFTER'),
+    ),
+    'local': lambda app: LocalStorage(app.config['STORAGE_LOCAL_ROOT'],
+                                      url_prefix=app.config.get('STORAGE_LOCAL_URL', '/files/')),
+}
+
+
+def init_storage(app):
+    """Create the storage backend selected by ``STORAGE_BACKEND``."""
+    name = app.config.get('STORAGE_BACKEND', 'cloudinary')
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown STORAGE_BACKEND: {name}")
+    app.extensions['storage'] = BACKENDS[name](app)
+
+
+def get_storage():
+    """Return the storage backend of the current app."""
+    return current_app.extensions['storage']
@@ -0,0 +1,48 @@
+"""
+Helpers for streaming large pages.
+
+Rows are read from a server-side cursor in chunks and rendered by a
+streamed Jinja template, so the first bytes leave the worker before the
+last rows have been fetched and memory stays bounded by the chunk size.
+"""
+from flask import Response, current_app, get_flashed_messages, stream_with_context
+from flask_wtf.csrf import generate_csrf
+
+# Rows fetched per round trip from the server-side cursor
+STREAM_CHUNK_SIZE = 500
+# Template events buffered before a chunk is sent to the client
+STREAM_BUFFER_SIZE = 100
+
+
+def stream_rows(query, item_class, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Iterate over a projection query without loading all rows at once.
+
+    Args:
+        query: A column query as built in ``app.utils.projections``
+        item_class: The row class wrapping each result row
+        chunk_size: Rows fetched per round trip
+
+    Returns:
+        generator: ``item_class`` objects
+    """
+    for row in query.execution_options(stream_results=True).yield_per(chunk_size):
+        yield item_class(*row)
+
+
+def stream_page(template_name, **context):
+    """
+    Render a template as a streamed response.
+
+    Everything that writes to the session (flashed messages, the CSRF token)
+    is resolved before the first byte is sent, as the session cookie can no
+    longer change once streaming has started.
+    """
+    get_flashed_messages(with_categories=True)
+    generate_csrf()
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(STREAM_BUFFER_SIZE)
+    return Response(stream_with_context(stream), mimetype='text/html')
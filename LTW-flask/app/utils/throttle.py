@@ -0,0 +1,75 @@
+"""
+Token-bucket throttling of login and registration attempts.
+
+Every key (``ip:<address>``, ``username:<name>``) has a bucket of
+``capacity`` tokens refilled continuously at ``capacity / period`` tokens
+per second. An attempt takes one token, and is refused while the bucket is
+empty, before any password is hashed.
+
+Buckets live in the memory of each worker process (at most
+``THROTTLE_MAX_KEYS`` of them, least recently used dropped first), so the
+limits apply per worker.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app
+
+from app.utils.metrics import metrics
+
+
+class Throttle:
+    """Token buckets by key."""
+
+    def __init__(self):
+        self._buckets = OrderedDict()  # key -> (tokens, updated at)
+        self._lock = threading.Lock()
+
+    def hit(self, key, capacity, period):
+        """
+        Take a token from the bucket of ``key``.
+
+        Args:
+            key: Kind and value of what is throttled, e.g. ``ip:10.0.0.1``
+            capacity: Attempts allowed in a burst
+            period: Seconds needed to refill an empty bucket
+
+        Returns:
+            float: 0 if the attempt is allowed, else the seconds until it would be
+        """
+        now = time.monotonic()
+        rate = capacity / period
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > current_app.config.get('THROTTLE_MAX_KEYS', 100000):
+                self._buckets.popitem(last=False)
+        if allowed:
+            return 0
+        metrics.inc('throttled_requests_total', kind=key.partition(':')[0])
+        return (1 - tokens) / rate
+
+    def check(self, *limits):
+        """
+        Take a token from several buckets, e.g. the client address and the username.
+
+        Args:
+            limits: ``(key, (capacity, period))`` pairs
+
+        Returns:
+            float: 0 if allowed by all of them, else the longest wait in seconds
+        """
+        return max([self.hit(key, *limit) for key, limit in limits] or [0])
+
+    def reset(self, key):
+        """Forget a bucket, e.g. the username bucket after a successful login."""
+        with self._lock:
+            self._buckets.pop(key, None)
+
+
+throttle = Throttle()
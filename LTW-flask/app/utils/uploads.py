@@ -0,0 +1,63 @@
+"""
+Uploaded files hashed while the request body is parsed.
+
+The asset registry needs the SHA-256 of every uploaded cover and book file
+before anything is sent to Cloudinary. Reading the spooled upload a second
+time for it costs a full pass over the file (from disk for anything above
+werkzeug's 500 KB spooling threshold), so :class:`UploadRequest` hands the
+multipart parser a :class:`HashingStream` that feeds every chunk to the
+digest as it is written. :func:`app.utils.asset_registry.hash_upload` uses
+that digest, and only reads files that did not come from a request body
+(generated previews, files opened by scripts).
+"""
+import hashlib
+
+from flask import Request
+
+
+class HashingStream:
+    """
+    Writable file wrapper computing the SHA-256 and size of what is written to it.
+
+    The digest covers the content only while it was written front to back:
+    a write after the stream was rewound (the parser rewinds it once done)
+    makes :meth:`hashed` return None.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._digest = hashlib.sha256()
+        self._size = 0
+        self._rewound = False
+        self._valid = True
+
+    def write(self, data):
+        if self._rewound:
+            self._valid = False
+        else:
+            self._digest.update(data)
+            self._size += len(data)
+        return self._stream.write(data)
+
+    def seek(self, *args):
+        self._rewound = True
+        return self._stream.seek(*args)
+
+    def hashed(self):
+        """Return ``(hex digest, size in bytes)`` of the written content, or None if it was modified."""
+        if not self._valid:
+            return None
+        return self._digest.hexdigest(), self._size
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class UploadRequest(Request):
+    """Request whose uploaded files are hashed as they are received."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingStream(super()._get_file_stream(total_content_length, content_type, filename, content_length))
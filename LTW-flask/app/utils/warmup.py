@@ -0,0 +1,172 @@
+"""
+Warm-up run before a server reports ready.
+
+Right after a deploy or a worker recycle the first requests used to pay for
+template compilation, empty process caches and new database connections
+all at once. :func:`warm_up` compiles every template into the persistent
+Jinja bytecode cache, fills the process caches (category tree, role names,
+search index, rankings) and renders the hottest pages once, which loads
+their book snapshots into the entity cache and the database pages they
+need into memory. :func:`prime_pool` opens the database
+connections of a worker before it accepts requests.
+
+Warm-up never takes longer than ``WARMUP_BUDGET`` seconds: steps that do not
+fit are skipped, and the server then starts with partly cold caches.
+"""
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+
+from app import db
+
+OK = 'ok'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+def configure_template_cache(app):
+    """Keep compiled templates in ``JINJA_BYTECODE_CACHE_DIR``, shared by workers and restarts."""
+    directory = app.config.get('JINJA_BYTECODE_CACHE_DIR')
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def _templates(app, deadline):
+    names = app.jinja_env.list_templates(extensions=('html',))
+    compiled = 0
+    for name in names:
+        if time.monotonic() > deadline:
+            break
+        app.jinja_env.get_template(name)
+        compiled += 1
+    return f'{compiled}/{len(names)} templates compiled'
+
+
+def _catalog(app, deadline):
+    from app.utils.catalog_cache import catalog
+    return f'{len(catalog.category_tree())} categories, {len(catalog.role_names())} roles'
+
+
+def _search_index(app, deadline):
+    from app.utils.autocomplete import autocomplete
+    autocomplete.suggest('a')
+    return 'search suggestions index built'
+
+
+def _rankings(app, deadline):
+    from app.utils.rankings import leaderboard, rankings
+    lists = 0
+    for ranking in rankings():
+        for entity_type in ('book', 'category'):
+            leaderboard.top(ranking, entity_type)
+            lists += 1
+    return f'{lists} ranking lists loaded'
+
+
+def _hot_pages(app, deadline):
+    from sqlalchemy import desc, select
+    from app.models import Book
+    from app.utils.rankings import leaderboard
+
+    # Best sellers first, the newest books when there are no sales yet
+    limit = app.config.get('WARMUP_TOP_BOOKS', 20)
+    book_ids = [book_id for book_id, _ in leaderboard.top('bestsellers', 'book', limit)]
+    if len(book_ids) < limit:
+        book_ids += db.session.execute(
+            select(Book.BookID).where(Book.Status == True, Book.BookID.notin_(book_ids or [0]))
+            .order_by(desc(Book.AddedDate)).limit(limit - len(book_ids))
+        ).scalars().all()
+
+    paths = ['/new', '/category', '/bestsellers', '/trending'] + [f'/book/{book_id}' for book_id in book_ids]
+    client = app.test_client()
+    rendered = errors = 0
+    for path in paths:
+        if time.monotonic() > deadline:
+            break
+        try:
+            ok = client.get(path).status_code == 200
+        except Exception as e:
+            # A broken page must not stop the warm-up of the others
+            app.logger.warning(f"Warm-up could not render {path}: {str(e)}")
+            ok = False
+        if ok:
+            rendered += 1
+        else:
+            errors += 1
+    detail = f'{rendered}/{len(paths)} pages rendered ({len(book_ids)} books)'
+    return detail + (f', {errors} errors' if errors else '')
+
+
+STEPS = (
+    ('templates', _templates),
+    ('catalog', _catalog),
+    ('search', _search_index),
+    ('rankings', _rankings),
+    ('pages', _hot_pages),
+)
+
+
+def warm_up(app, budget=None):
+    """
+    Run the warm-up steps in order within the time budget.
+
+    Args:
+        app: The application to warm up
+        budget: Seconds available, defaults to ``WARMUP_BUDGET``
+
+    Returns:
+        list: One dict per step with ``step``, ``status``, ``seconds`` and
+        ``detail``; also kept in ``app.extensions['warmup']``
+    """
+    budget = budget if budget is not None else app.config.get('WARMUP_BUDGET', 30)
+    deadline = time.monotonic() + budget
+    report = []
+    with app.app_context():
+        for name, step in STEPS:
+            started = time.monotonic()
+            if started > deadline:
+                report.append({'step': name, 'status': SKIPPED, 'seconds': 0.0, 'detail': 'time budget exhausted'})
+                continue
+            try:
+                detail, status = step(app, deadline), OK
+            except Exception as e:
+                db.session.rollback()
+                detail, status = str(e), FAILED
+            finally:
+                db.session.remove()
+            report.append({'step': name, 'status': status,
+                           'seconds': round(time.monotonic() - started, 3), 'detail': detail})
+
+    for entry in report:
+        log = app.logger.warning if entry['status'] != OK else app.logger.info
+        log(f"Warm-up {entry['step']}: {entry['status']} in {entry['seconds']:.2f}s, {entry['detail']}")
+    app.extensions['warmup'] = report
+    return report
+
+
+def prime_pool(app):
+    """
+    Open ``WARMUP_POOL_SIZE`` connections per database engine and return them to the pool.
+
+    Returns:
+        int: Number of connections opened
+    """
+    size = app.config.get('WARMUP_POOL_SIZE', 5)
+    opened = 0
+    with app.app_context():
+        for engine in db.engines.values():
+            # Never more than the pool keeps, extra connections would just be closed again
+            pool_size = engine.pool.size() if hasattr(engine.pool, 'size') else size
+            connections = []
+            try:
+                for _ in range(min(size, pool_size)):
+                    connections.append(engine.connect())
+            except Exception as e:
+                app.logger.warning(f"Could not prime the pool of {engine.url!r}: {str(e)}")
+            finally:
+                opened += len(connections)
+                for connection in connections:
+                    connection.close()
+    return opened
@@ -2,13 +2,13 @@
 Backup and Recovery script for database
 """
 
-from app import create_app, db
+from app import create_cli_context, db
 from app.models import *
 from sqlalchemy import text
 import os
 from datetime import datetime
 
-app = create_app(os.getenv('FLASK_CONFIG', 'development'))
+app = create_cli_context(os.getenv('FLASK_CONFIG', 'development'))
 
 def backup_data():
     """Backup critical data before migration."""
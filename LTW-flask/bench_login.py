@@ -0,0 +1,97 @@
+"""
+Benchmark of the password checks done at login
+Usage: python bench_login.py [--rounds 12] [--workers 2] [--clients 8] [--duration 10]
+
+Runs password checks through app/utils/password_hashing.py for --duration
+seconds from --clients concurrent threads, the way a worker serves a burst
+of logins, and reports logins/s, logins/s per core, the latency and how
+many attempts were refused with HashingBusy (a 429 for the client).
+--workers 0 checks on the calling threads, as Flask-Bcrypt did.
+
+Defaults come from the configuration (FLASK_CONFIG): BCRYPT_LOG_ROUNDS,
+PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING and PASSWORD_HASH_TIMEOUT.
+"""
+
+from app import create_cli_context
+from app.utils.password_hashing import passwords, HashingBusy
+import argparse
+import os
+import threading
+import time
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_benchmark(app, clients, duration):
+    """Check passwords from ``clients`` threads for ``duration`` seconds."""
+    with app.app_context():
+        password_hash = passwords.hash('benchmark password')
+        passwords.start()
+        # Let the hashing processes start before measuring
+        passwords.verify(password_hash, 'benchmark password')
+
+    latencies = []
+    refused = [0]
+    lock = threading.Lock()
+    end = time.monotonic() + duration
+
+    def client():
+        with app.app_context():
+            while time.monotonic() < end:
+                started = time.perf_counter()
+                try:
+                    ok = passwords.verify(password_hash, 'benchmark password')
+                except HashingBusy:
+                    with lock:
+                        refused[0] += 1
+                    # A refused client backs off, as it would after a 429
+                    time.sleep(0.05)
+                    continue
+                assert ok
+                with lock:
+                    latencies.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, refused[0], time.monotonic() - started
+
+
+if __name__ == '__main__':
+    # The app is only built here: hashing processes import this module again
+    app = create_cli_context(os.getenv('FLASK_CONFIG', 'development'))
+
+    parser = argparse.ArgumentParser(description='Measure login password checks per second')
+    parser.add_argument('--rounds', type=int, default=app.config.get('BCRYPT_LOG_ROUNDS', 12), help='bcrypt cost')
+    parser.add_argument('--workers', type=int, default=app.config.get('PASSWORD_HASH_WORKERS', 1),
+                        help='hashing processes, 0 checks on the client threads')
+    parser.add_argument('--max-pending', type=int, default=app.config.get('PASSWORD_HASH_MAX_PENDING', 4))
+    parser.add_argument('--clients', type=int, default=8, help='concurrent logins')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    options = parser.parse_args()
+
+    app.config.update(BCRYPT_LOG_ROUNDS=options.rounds, PASSWORD_HASH_WORKERS=options.workers,
+                      PASSWORD_HASH_MAX_PENDING=options.max_pending)
+    cores = os.cpu_count() or 1
+    busy_cores = min(cores, options.workers) if options.workers else min(cores, options.clients)
+    print(f"bcrypt cost {options.rounds}, hashing processes: {options.workers}, clients: {options.clients}, "
+          f"cores: {cores}")
+
+    try:
+        latencies, refused, elapsed = run_benchmark(app, options.clients, options.duration)
+    finally:
+        passwords.shutdown(wait=True)
+
+    rate = len(latencies) / elapsed
+    print(f"logins/s:          {rate:.1f}")
+    print(f"logins/s per core: {rate / busy_cores:.1f}")
+    print(f"latency p50/p95:   {percentile(latencies, 0.5) * 1000:.0f} / {percentile(latencies, 0.95) * 1000:.0f} ms")
+    print(f"refused (429):     {refused}")
@@ -0,0 +1,168 @@
+"""
+Offline job computing the "related books" shown on book detail pages
+Run it periodically (e.g. nightly from cron); pass --full to rewrite every row
+
+Paid order lines are turned into two sparse basket matrices (books bought in
+the same order, and books bought by the same user). Their item-item
+co-occurrence counts are computed with sparse matrix products, scaled by
+book popularity (cosine similarity) and the top-K neighbours of every book
+are stored in BookRecommendations. A normal run only rewrites the books
+whose baskets received purchases since the previous run: the order lines
+added after the last line seen (the watermark). An order paid later than
+it was placed has lines below the watermark; they change the checksum of
+the paid lines up to the watermark, and the run becomes a full one.
+"""
+
+from app import create_cli_context, db
+from app.models import Book, BookRecommendation, Order, OrderDetail
+from datetime import datetime
+from sqlalchemy import select
+import numpy as np
+from scipy import sparse
+import argparse
+import os
+
+app = create_cli_context(os.getenv('FLASK_CONFIG', 'development'))
+
+TOP_K = 6
+# Books bought by the same user count less than books bought together
+USER_BASKET_WEIGHT = 0.5
+WRITE_BATCH_SIZE = 500
+
+
+def load_order_lines():
+    """Return (order IDs, user IDs, book IDs, order detail IDs) of paid order lines as arrays."""
+    rows = db.session.execute(
+        select(OrderDetail.OrderID, Order.UserID, OrderDetail.BookID, OrderDetail.OrderDetailID)
+        .join(Order, Order.OrderID == OrderDetail.OrderID)
+        .where(Order.PaymentStatus == True)
+    ).all()
+    if not rows:
+        return tuple(np.empty(0, dtype=np.int64) for _ in range(4))
+    return tuple(np.array(column, dtype=np.int64) for column in zip(*rows))
+
+
+def basket_matrix(basket_ids, item_index, item_count):
+    """Binary basket x book matrix (a book bought twice in a basket counts once)."""
+    baskets, basket_index = np.unique(basket_ids, return_inverse=True)
+    matrix = sparse.csr_matrix(
+        (np.ones(len(item_index), dtype=np.float32), (basket_index, item_index)),
+        shape=(len(baskets), item_count)
+    )
+    # Duplicate entries were summed by the conversion
+    matrix.data[:] = 1.0
+    return matrix
+
+
+def cooccurrence(order_ids, user_ids, item_index, item_count):
+    """Item x item similarity matrix with an empty diagonal."""
+    by_order = basket_matrix(order_ids, item_index, item_count)
+    by_user = basket_matrix(user_ids, item_index, item_count)
+    counts = (by_order.T @ by_order) + USER_BASKET_WEIGHT * (by_user.T @ by_user)
+    counts = sparse.csr_matrix(counts)
+    counts.setdiag(0)
+    counts.eliminate_zeros()
+
+    # Cosine scaling, so bestsellers do not become everybody's neighbour
+    popularity = np.sqrt(np.asarray(by_order.sum(axis=0)).ravel() + USER_BASKET_WEIGHT * np.asarray(by_user.sum(axis=0)).ravel())
+    popularity[popularity == 0] = 1.0
+    scale = sparse.diags(1.0 / popularity)
+    return sparse.csr_matrix(scale @ counts @ scale)
+
+
+def top_neighbours(similarity, row):
+    """Indices of the TOP_K highest scores of one row, best first."""
+    start, end = similarity.indptr[row], similarity.indptr[row + 1]
+    columns, scores = similarity.indices[start:end], similarity.data[start:end]
+    if len(scores) > TOP_K:
+        best = np.argpartition(-scores, TOP_K)[:TOP_K]
+        columns, scores = columns[best], scores[best]
+    # Ties are broken by the lower index (older book) to keep results stable
+    order = np.lexsort((columns, -scores))
+    return columns[order]
+
+
+def affected_books(order_ids, user_ids, book_ids, detail_ids, watermark):
+    """Books sharing an order or a user with a purchase made after ``watermark``."""
+    new = detail_ids > watermark
+    if not new.any():
+        return set()
+    touched = np.isin(order_ids, order_ids[new]) | np.isin(user_ids, user_ids[new])
+    return set(book_ids[touched].tolist())
+
+
+def paid_checksum(detail_ids, watermark):
+    """Sum of the IDs of the paid order lines up to ``watermark`` (changes when one of them is paid or refunded)."""
+    return int(detail_ids[detail_ids <= watermark].sum())
+
+
+def build_recommendations(full=False):
+    """Compute the neighbours and write the rows that changed."""
+    with app.app_context():
+        try:
+            print("Loading paid order lines...")
+            order_ids, user_ids, book_ids, detail_ids = load_order_lines()
+            if not len(book_ids):
+                print("No paid orders yet, nothing to do.")
+                return
+
+            books, item_index = np.unique(book_ids, return_inverse=True)
+            print(f"Computing co-occurrence of {len(books)} books over {len(book_ids)} order lines...")
+            similarity = cooccurrence(order_ids, user_ids, item_index, len(books))
+            high_water = int(detail_ids.max())
+            checksum = paid_checksum(detail_ids, high_water)
+
+            stored = {rec.BookID: rec for rec in BookRecommendation.query.all()}
+            latest = max(stored.values(), key=lambda rec: rec.SourceOrderDetailID, default=None)
+            if not full and latest is not None and \
+                    (latest.SourceChecksum or 0) != paid_checksum(detail_ids, latest.SourceOrderDetailID):
+                print("Order lines older than the last run were paid or refunded, recomputing every book...")
+                full = True
+            watermark = 0 if full or latest is None else latest.SourceOrderDetailID
+            targets = set(books.tolist()) if full or not stored else \
+                affected_books(order_ids, user_ids, book_ids, detail_ids, watermark) | (set(books.tolist()) - set(stored))
+
+            existing = set(db.session.execute(select(Book.BookID)).scalars())
+            position = {int(book_id): index for index, book_id in enumerate(books)}
+
+            written = 0
+            for book_id in sorted(targets):
+                if book_id not in existing:
+                    continue
+                related = [int(books[column]) for column in top_neighbours(similarity, position[book_id])]
+                related = [related_id for related_id in related if related_id in existing]
+                value = ','.join(str(related_id) for related_id in related)
+
+                rec = stored.get(book_id)
+                if rec is None:
+                    if not value:
+                        continue
+                    db.session.add(BookRecommendation(BookID=book_id, RelatedBookIDs=value,
+                                                      SourceOrderDetailID=high_water, SourceChecksum=checksum,
+                                                      UpdatedDate=datetime.utcnow()))
+                elif rec.RelatedBookIDs != value:
+                    rec.RelatedBookIDs = value
+                    rec.UpdatedDate = datetime.utcnow()
+                else:
+                    continue
+                written += 1
+                if written % WRITE_BATCH_SIZE == 0:
+                    db.session.commit()
+
+            # Move the watermark forward on every row so the next run starts from here
+            BookRecommendation.query.update({BookRecommendation.SourceOrderDetailID: high_water,
+                                             BookRecommendation.SourceChecksum: checksum},
+                                            synchronize_session=False)
+            db.session.commit()
+            print(f"Updated {written} of {len(targets)} recomputed books. Done!")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error building recommendations: {str(e)}")
+            raise e
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build co-purchase book recommendations')
+    parser.add_argument('--full', action='store_true', help='recompute and rewrite every book')
+    build_recommendations(full=parser.parse_args().full)
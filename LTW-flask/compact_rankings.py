@@ -0,0 +1,40 @@
+"""
+Maintenance job for the bestseller and trending rankings
+Run it periodically (e.g. daily from cron) to move the score epoch forward
+and drop scores that decayed to nothing; pass --rebuild to recompute every
+ranking from the order history (first deployment, or after changing
+RANKING_HALF_LIVES or RANKING_DOWNLOAD_WEIGHT)
+"""
+
+from app import create_cli_context, db
+from app.utils.rankings import compact, rebuild
+import argparse
+import os
+
+app = create_cli_context(os.getenv('FLASK_CONFIG', 'development'))
+
+
+def compact_rankings(full_rebuild=False):
+    """Compact or rebuild the ranking scores."""
+    with app.app_context():
+        try:
+            if full_rebuild:
+                print("Rebuilding rankings from the order history...")
+                written = rebuild()
+                print(f"Wrote {written} ranking scores. Done!")
+            else:
+                print("Compacting rankings...")
+                for ranking, removed in compact().items():
+                    print(f"{ranking}: removed {removed} decayed scores")
+                print("Done!")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error compacting rankings: {str(e)}")
+            raise e
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compact or rebuild the sales rankings')
+    parser.add_argument('--rebuild', action='store_true', help='recompute every ranking from the order history')
+    compact_rankings(full_rebuild=parser.parse_args().rebuild)
@@ -0,0 +1,168 @@
+"""
+Fake Cloudinary API server injecting latency and errors
+Usage: python fake_cloudinary_server.py --port 8900 [--latency 0.5] [--error-rate 0.2]
+
+Point the app at it with CLOUDINARY_UPLOAD_PREFIX=http://127.0.0.1:8900 (and
+any CLOUDINARY_CLOUD_NAME / API key / secret) to see how uploads and
+deletions behave when Cloudinary is slow or failing: deadlines, retries,
+the circuit breaker and the bulkhead show up in /metrics.
+
+It answers the upload API (upload, destroy) and the Admin API deletion of
+resources; uploaded files are only counted, never stored.
+
+Faults can be changed while it runs:
+    POST /_faults  {"latency": 2.0, "error_rate": 0.5, "error_status": 503, "fail_next": 3}
+    GET  /_stats   requests received per operation, and the current faults
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import argparse
+import json
+import random
+import re
+import secrets
+import threading
+import time
+
+API_PATTERN = re.compile(r'^/v1_1/(?P<cloud>[^/]+)/(?:(?P<type>image|raw|video)/(?P<action>upload|destroy)'
+                         r'|resources/(?P<resources_type>image|raw|video)/upload)$')
+
+
+class Faults:
+    """Latency and errors injected into the API responses."""
+
+    def __init__(self, latency=0.0, error_rate=0.0, error_status=500):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.fail_next = 0
+        self.requests = {}
+        self.lock = threading.Lock()
+
+    def update(self, values):
+        with self.lock:
+            for name in ('latency', 'error_rate', 'error_status', 'fail_next'):
+                if name in values:
+                    setattr(self, name, type(getattr(self, name))(values[name]))
+
+    def record(self, operation):
+        """Count a request and decide whether it fails."""
+        with self.lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            if self.fail_next > 0:
+                self.fail_next -= 1
+                return True
+            return random.random() < self.error_rate
+
+    def as_dict(self):
+        with self.lock:
+            return {'latency': self.latency, 'error_rate': self.error_rate, 'error_status': self.error_status,
+                    'fail_next': self.fail_next, 'requests': dict(self.requests)}
+
+
+class FakeCloudinaryHandler(BaseHTTPRequestHandler):
+    faults = Faults()
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return self.rfile.read(length) if length else b''
+
+    def _field(self, body, name):
+        # Good enough for the SDK's multipart and urlencoded forms
+        match = re.search(rb'name="' + re.escape(name.encode()) + rb'"\r\n\r\n(.*?)\r\n', body, re.S)
+        if match:
+            return match.group(1).decode('utf-8')
+        values = parse_qs(body.decode('utf-8', 'replace')).get(name)
+        return values[0] if values else None
+
+    def _api(self, method):
+        url = urlparse(self.path)
+        match = API_PATTERN.match(url.path)
+        body = self._body()
+        if not match:
+            return self._send(404, {'error': {'message': f'Unknown endpoint {url.path}'}})
+
+        operation = match.group('action') or f"{method.lower()}_resources"
+        fail = self.faults.record(operation)
+        if self.faults.latency:
+            time.sleep(self.faults.latency)
+        if fail:
+            return self._send(self.faults.error_status, {'error': {'message': 'Injected failure'}})
+
+        cloud = match.group('cloud')
+        if operation == 'upload':
+            resource_type = match.group('type')
+            public_id = self._field(body, 'public_id')
+            if not public_id:
+                folder = self._field(body, 'folder')
+                stem = f'file_{secrets.token_hex(3)}'
+                public_id = f'{folder}/{stem}' if folder else stem
+            extension = {'image': '.jpg', 'raw': '.pdf'}.get(resource_type, '')
+            return self._send(200, {
+                'public_id': public_id,
+                'version': int(time.time()),
+                'resource_type': resource_type,
+                'bytes': len(body),
+                'secure_url': f'https://res.cloudinary.com/{cloud}/{resource_type}/upload/{public_id}{extension}',
+            })
+        if operation == 'destroy':
+            return self._send(200, {'result': 'ok'})
+        public_ids = parse_qs(url.query).get('public_ids[]', [])
+        return self._send(200, {'deleted': {public_id: 'deleted' for public_id in public_ids}, 'partial': False})
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/_stats':
+            return self._send(200, self.faults.as_dict())
+        self._api('GET')
+
+    def do_POST(self):
+        if urlparse(self.path).path == '/_faults':
+            self.faults.update(json.loads(self._body() or b'{}'))
+            return self._send(200, self.faults.as_dict())
+        self._api('POST')
+
+    def do_DELETE(self):
+        self._api('DELETE')
+
+
+def serve(host='127.0.0.1', port=8900, latency=0.0, error_rate=0.0, error_status=500, verbose=False):
+    """Create the server (call ``serve_forever()`` on it, e.g. in a thread)."""
+    FakeCloudinaryHandler.faults = Faults(latency, error_rate, error_status)
+    server = ThreadingHTTPServer((host, port), FakeCloudinaryHandler)
+    server.daemon_threads = True
+    server.verbose = verbose
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake Cloudinary API with latency and error injection')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API requests that fail (0 to 1)')
+    parser.add_argument('--error-status', type=int, default=500, help='HTTP status of the injected failures')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    options = parser.parse_args()
+
+    server = serve(options.host, options.port, options.latency, options.error_rate, options.error_status,
+                   options.verbose)
+    print(f"Fake Cloudinary listening on http://{options.host}:{options.port}")
+    print(f"Use CLOUDINARY_UPLOAD_PREFIX=http://{options.host}:{options.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopped")
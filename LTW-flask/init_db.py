@@ -1,11 +1,9 @@
-from app import create_app, db
+from app import create_cli_context, db, bcrypt
 from app.models import User, Role, Category
-from flask_bcrypt import Bcrypt
 from datetime import datetime
 import os
 
-app = create_app(os.getenv('FLASK_CONFIG', 'development'))
-bcrypt = Bcrypt(app)
+app = create_cli_context(os.getenv('FLASK_CONFIG', 'development'))
 
 
 def init_db():
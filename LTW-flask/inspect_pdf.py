@@ -0,0 +1,133 @@
+"""
+Inspect PDF files the way the book upload does, and measure its memory use
+Usage: python inspect_pdf.py FILE [FILE ...]
+       python inspect_pdf.py --generate big.pdf --size-mb 150 [--pages 800] [--xref-stream]
+
+Prints the page count, title, author and producer read by
+app.utils.pdf_ingest together with the time taken and the peak Python
+memory allocated, which stays in the same range whatever the file size.
+
+--generate writes a synthetic PDF of about the given size (pages padded with
+incompressible content, a Unicode title, an incremental update) to try it on
+large files without finding one.
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import zlib
+
+from app.utils.pdf_ingest import PdfError, inspect_pdf
+
+PADDING_CHUNK = 1024 * 1024
+
+
+def _text_string(text):
+    return b'<feff' + text.encode('utf-16-be').hex().encode('ascii') + b'>'
+
+
+def generate(path, size_mb, pages, xref_stream=False):
+    """Write a PDF of about ``size_mb`` MB with ``pages`` pages, in constant memory."""
+    offsets = {}
+    padding_size = max(0, size_mb * 1024 * 1024 // max(1, pages))
+
+    with open(path, 'wb') as f:
+        def start_object(number):
+            offsets[number] = f.tell()
+            f.write(b'%d 0 obj\n' % number)
+
+        f.write(b'%PDF-1.5\n%\xe2\xe3\xcf\xd3\n')
+        start_object(1)
+        f.write(b'<< /Type /Catalog /Pages 2 0 R >>\nendobj\n')
+        kids = b' '.join(b'%d 0 R' % (3 + 2 * i) for i in range(pages))
+        start_object(2)
+        f.write(b'<< /Type /Pages /Count %d /Kids [%s] >>\nendobj\n' % (pages, kids))
+        for i in range(pages):
+            page, content = 3 + 2 * i, 4 + 2 * i
+            start_object(page)
+            f.write(b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R >>\nendobj\n' % content)
+            start_object(content)
+            f.write(b'<< /Length %d >>\nstream\n' % padding_size)
+            written = 0
+            while written < padding_size:
+                chunk = os.urandom(min(PADDING_CHUNK, padding_size - written))
+                f.write(chunk)
+                written += len(chunk)
+            f.write(b'\nendstream\nendobj\n')
+        info = 3 + 2 * pages
+        start_object(info)
+        f.write(b'<< /Title (Draft) /Producer (inspect_pdf.py) >>\nendobj\n')
+        size = info + 1
+
+        xref = f.tell()
+        f.write(b'xref\n0 %d\n0000000000 65535 f \n' % size)
+        for number in range(1, size):
+            f.write(b'%010d 00000 n \n' % offsets[number])
+        f.write(b'trailer\n<< /Size %d /Root 1 0 R /Info %d 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (size, info, xref))
+
+        # Incremental update replacing the Info dictionary
+        new_info = size
+        start_object(new_info)
+        f.write(b'<< /Title %s /Author (Nguy\\352n V\\141n \\(A\\)) /Producer (inspect_pdf.py) >>\nendobj\n'
+                % _text_string('Sách mẫu – bản lớn'))
+        size += 1
+        xref_offset = f.tell()
+        if xref_stream:
+            # Cross-reference stream with the PNG "Up" predictor, as most writers produce
+            rows, previous = [], bytes(5)
+            for _, offset in ((new_info, offsets[new_info]), (size, xref_offset)):
+                row = bytes([1]) + offset.to_bytes(4, 'big')
+                rows.append(b'\x02' + bytes((a - b) & 0xFF for a, b in zip(row, previous)))
+                previous = row
+            data = zlib.compress(b''.join(rows))
+            f.write(b'%d 0 obj\n<< /Type /XRef /Size %d /Index [%d 2] /W [1 4 0] /Root 1 0 R /Info %d 0 R /Prev %d'
+                    b' /Filter /FlateDecode /DecodeParms << /Columns 5 /Predictor 12 >> /Length %d >>\nstream\n'
+                    % (size, size + 1, new_info, new_info, xref, len(data)))
+            f.write(data + b'\nendstream\nendobj\n')
+        else:
+            f.write(b'xref\n0 1\n0000000000 65535 f \n%d 1\n%010d 00000 n \n' % (new_info, offsets[new_info]))
+            f.write(b'trailer\n<< /Size %d /Root 1 0 R /Info %d 0 R /Prev %d >>\n' % (size, new_info, xref))
+        f.write(b'startxref\n%d\n%%%%EOF\n' % xref_offset)
+
+
+def inspect(path):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        with open(path, 'rb') as f:
+            info = inspect_pdf(f)
+    except PdfError as e:
+        print(f"{path}: not readable ({e})")
+        return False
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    print(f"{path} ({os.path.getsize(path) / 1024 / 1024:.1f} MB)")
+    for name, value in info.as_dict().items():
+        print(f"  {name:<11} {value}")
+    print(f"  read in {elapsed * 1000:.1f} ms, peak Python memory {peak / 1024:.0f} KB")
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read page count and metadata of PDF files')
+    parser.add_argument('files', nargs='*')
+    parser.add_argument('--generate', metavar='PATH', help='write a synthetic PDF first, then inspect it')
+    parser.add_argument('--size-mb', type=int, default=120)
+    parser.add_argument('--pages', type=int, default=500)
+    parser.add_argument('--xref-stream', action='store_true', help='end the file with a cross-reference stream')
+    options = parser.parse_args()
+
+    files = list(options.files)
+    if options.generate:
+        generate(options.generate, options.size_mb, options.pages, options.xref_stream)
+        files.insert(0, options.generate)
+    if not files:
+        parser.error('no file to inspect')
+
+    results = [inspect(path) for path in files]
+    sys.exit(0 if all(results) else 1)
@@ -3,11 +3,11 @@ Migration script to convert Decimal columns to Float for SQL Server compatibilit
 Run this script after updating the models
 """
 
-from app import create_app, db
+from app import create_cli_context, db
 from sqlalchemy import text
 import os
 
-app = create_app(os.getenv('FLASK_CONFIG', 'development'))
+app = create_cli_context(os.getenv('FLASK_CONFIG', 'development'))
 
 
 def migrate_decimal_to_float():
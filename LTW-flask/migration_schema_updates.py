@@ -0,0 +1,66 @@
+"""
+Migration script for the tables added after the initial schema
+Run this script after updating the models; every step is idempotent
+"""
+
+from app import create_cli_context, db
+from app.models import (Book, User, PaymentTransaction, ReplicaHeartbeat, Asset, BookRecommendation, RankingScore,
+                        RankingEpoch, InvalidationEvent)
+from sqlalchemy import inspect, text
+import os
+
+app = create_cli_context(os.getenv('FLASK_CONFIG', 'development'))
+
+
+def create_tables():
+    """Create the tables that do not exist yet."""
+    for model in (ReplicaHeartbeat, Asset, BookRecommendation, RankingScore, RankingEpoch, InvalidationEvent):
+        print(f"Creating {model.__tablename__} table if missing...")
+        model.__table__.create(db.engine, checkfirst=True)
+
+
+def add_columns():
+    """Add the columns that do not exist yet to existing tables."""
+    columns = [
+        (Book, 'CoverVariants'),
+        (Book, 'CoverPlaceholder'),
+        (User, 'SessionToken'),
+        (BookRecommendation, 'SourceChecksum'),
+    ]
+    inspector = inspect(db.engine)
+    for model, name in columns:
+        table = model.__tablename__
+        existing = {column['name'] for column in inspector.get_columns(table)}
+        if name in existing:
+            continue
+        column_type = model.__table__.c[name].type.compile(dialect=db.engine.dialect)
+        print(f"Adding {table}.{name} column...")
+        with db.engine.begin() as connection:
+            connection.execute(text(f"ALTER TABLE {table} ADD {name} {column_type}"))
+
+
+def create_indexes():
+    """Create the indexes that do not exist yet on existing tables."""
+    for model in (Book, PaymentTransaction):
+        for index in model.__table__.indexes:
+            print(f"Creating index {index.name} if missing...")
+            index.create(db.engine, checkfirst=True)
+
+
+def migrate_schema():
+    """Apply all schema updates."""
+    with app.app_context():
+        try:
+            print("Starting migration: schema updates...")
+            create_tables()
+            add_columns()
+            create_indexes()
+            print("Migration completed successfully!")
+
+        except Exception as e:
+            print(f"Error during migration: {str(e)}")
+            raise e
+
+
+if __name__ == '__main__':
+    migrate_schema()
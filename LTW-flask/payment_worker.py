@@ -0,0 +1,56 @@
+"""
+Worker for payments still pending at the gateway
+Usage: python payment_worker.py [--once] [--interval 60] [--batch-size 500]
+
+Every --interval seconds (PAYMENT_WORKER_INTERVAL), asks the gateway about
+payments pending for PAYMENT_POLL_AFTER seconds, in case their webhook was
+lost, and expires those pending for PAYMENT_EXPIRY seconds, cancelling
+their orders. Run one of them per deployment; --once sweeps a single time
+(e.g. from cron).
+"""
+
+from app import create_cli_context, db
+from app.utils.payments import sweep_pending
+import argparse
+import os
+import signal
+import threading
+
+app = create_cli_context(os.getenv('FLASK_CONFIG', 'development'))
+
+
+def run_worker(once=False, interval=None, batch_size=500):
+    """Sweep pending payments until SIGTERM or Ctrl-C."""
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    with app.app_context():
+        interval = interval or app.config.get('PAYMENT_WORKER_INTERVAL', 60)
+        while True:
+            try:
+                counts = sweep_pending(batch_size=batch_size)
+                if counts['polled']:
+                    print(f"Polled {counts['polled']} pending payments: {counts['applied']} settled, "
+                          f"{counts['expired']} expired")
+            except Exception as e:
+                db.session.rollback()
+                print(f"Error sweeping pending payments: {str(e)}")
+                if once:
+                    raise e
+            finally:
+                db.session.remove()
+
+            if once or stopping.wait(interval):
+                break
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Settle or expire payments still pending at the gateway')
+    parser.add_argument('--once', action='store_true', help='sweep once and exit')
+    parser.add_argument('--interval', type=float, help='seconds between sweeps')
+    parser.add_argument('--batch-size', type=int, default=500, help='pending payments handled per sweep')
+    options = parser.parse_args()
+    try:
+        run_worker(once=options.once, interval=options.interval, batch_size=options.batch_size)
+    except KeyboardInterrupt:
+        pass
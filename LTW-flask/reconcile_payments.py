@@ -0,0 +1,269 @@
+"""
+Reconciliation of PaymentTransactions against a gateway settlement report
+Usage: python reconcile_payments.py SETTLEMENT.csv [--start 2025-01-01 --end 2025-02-01]
+                                    [--report differences.csv] [--apply]
+
+The settlement CSV is read in chunks into NumPy arrays (transaction code,
+amount, settlement date) and the transactions made around the period are
+loaded with a single ranged query on TransactionDate. Both sides are then
+joined on TransactionCode with sorted arrays instead of one query per row,
+so a month of several million payments is matched in seconds. Reported:
+
+- duplicate codes, in the settlement or in PaymentTransactions
+- settled payments without a transaction (missing_transaction)
+- successful transactions of the period absent from the settlement
+  (missing_settlement)
+- settled amounts that differ from the transaction (amount_mismatch)
+- settlement dates more than --date-tolerance days away from the
+  transaction (date_mismatch)
+- settled payments whose transaction is not successful (status_mismatch)
+
+The period defaults to the days covered by the settlement. --apply settles
+the status mismatches through app.utils.payments.apply_result, so they
+follow the payment state machine and row locks like a late webhook would;
+amount mismatches and duplicate codes are left for review.
+"""
+
+from app import create_cli_context, db
+from app.models import PaymentTransaction
+from app.utils import payments
+from datetime import datetime, timedelta
+from itertools import islice
+from operator import itemgetter
+from sqlalchemy import select
+import numpy as np
+import argparse
+import csv
+import os
+import time
+
+app = create_cli_context(os.getenv('FLASK_CONFIG', 'development'))
+
+READ_CHUNK_SIZE = 200000
+AMOUNT_TOLERANCE = 0.005
+EPOCH = datetime(1970, 1, 1)
+ONE_SECOND = timedelta(seconds=1)
+REPORT_FIELDS = ['kind', 'transaction_code', 'transaction_id', 'recorded_amount', 'settled_amount',
+                 'recorded_date', 'settled_date', 'recorded_status']
+
+
+def read_settlement(path, code_column, amount_column, date_column):
+    """Return (codes, amounts, dates) arrays of the rows of a settlement CSV."""
+    codes, amounts, dates = [], [], []
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        try:
+            getter = itemgetter(*(header.index(name) for name in (code_column, amount_column, date_column)))
+        except ValueError:
+            raise ValueError(f"{path} needs the columns {code_column}, {amount_column} and {date_column}")
+
+        while True:
+            rows = list(map(getter, islice(reader, READ_CHUNK_SIZE)))
+            if not rows:
+                break
+            code, amount, date = zip(*rows)
+            codes.append(np.array(code))
+            amounts.append(np.array(amount).astype(np.float64))
+            dates.append(np.array(date, dtype='datetime64[s]'))
+
+    if not codes:
+        return np.empty(0, dtype='U1'), np.empty(0, dtype=np.float64), np.empty(0, dtype='datetime64[s]')
+    return np.concatenate(codes), np.concatenate(amounts), np.concatenate(dates)
+
+
+def load_transactions(start, end):
+    """Return (IDs, codes, amounts, dates, statuses) arrays of the transactions made in [start, end)."""
+    result = db.session.execute(
+        select(PaymentTransaction.TransactionID, PaymentTransaction.TransactionCode, PaymentTransaction.Amount,
+               PaymentTransaction.TransactionDate, PaymentTransaction.Status)
+        .where(PaymentTransaction.TransactionDate >= start, PaymentTransaction.TransactionDate < end,
+               PaymentTransaction.TransactionCode.isnot(None))
+        .execution_options(yield_per=READ_CHUNK_SIZE)
+    )
+    parts = []
+    for rows in result.partitions():
+        ids, codes, amounts, dates, statuses = zip(*rows)
+        parts.append((np.array(ids, dtype=np.int64), np.array(codes), np.array(amounts, dtype=np.float64),
+                      # Much faster than converting datetime objects to datetime64 one by one
+                      np.array([(date - EPOCH) // ONE_SECOND for date in dates], dtype=np.int64).view('datetime64[s]'),
+                      np.array(statuses, dtype=object)))
+    db.session.commit()
+
+    if not parts:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype='U1'), np.empty(0, dtype=np.float64),
+                np.empty(0, dtype='datetime64[s]'), np.empty(0, dtype=object))
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+def first_rows(keys, count):
+    """Row of the first occurrence of every key in ``keys`` (-1 where absent)."""
+    rows = np.full(count, -1, dtype=np.int64)
+    # Assigned in reverse so the first occurrence is written last
+    rows[keys[::-1]] = np.arange(len(keys) - 1, -1, -1)
+    return rows
+
+
+def reconcile(settled, recorded, start, end, date_tolerance):
+    """
+    Match the settlement against the recorded transactions.
+
+    Args:
+        settled: (codes, amounts, dates) arrays of the settlement
+        recorded: (IDs, codes, amounts, dates, statuses) arrays of the transactions
+        start, end: Period the settlement covers
+        date_tolerance: Days allowed between a payment and its settlement
+
+    Returns:
+        dict: Kind of difference -> (settlement rows, transaction rows); -1 where a side is missing
+    """
+    settled_codes, settled_amounts, settled_dates = settled
+    ids, codes, amounts, dates, statuses = recorded
+
+    # Codes are numbered with a single sort; everything below works on these integers
+    labels, keys = np.unique(np.concatenate([settled_codes, codes]), return_inverse=True)
+    keys = keys.ravel()
+    settled_keys, recorded_keys = keys[:len(settled_codes)], keys[len(settled_codes):]
+    settled_counts = np.bincount(settled_keys, minlength=len(labels))
+    recorded_counts = np.bincount(recorded_keys, minlength=len(labels))
+    differences = {}
+
+    missing = np.flatnonzero(recorded_counts[settled_keys] == 0)
+    differences['missing_transaction'] = (missing, np.full(len(missing), -1))
+
+    in_period = (dates >= np.datetime64(start)) & (dates < np.datetime64(end))
+    succeeded = statuses == payments.TRANSACTION_SUCCEEDED
+    unsettled = np.flatnonzero(in_period & succeeded & (settled_counts[recorded_keys] == 0))
+    differences['missing_settlement'] = (np.full(len(unsettled), -1), unsettled)
+
+    # Pairs of the first occurrence of every code present on both sides
+    settled_first = first_rows(settled_keys, len(labels))
+    recorded_first = first_rows(recorded_keys, len(labels))
+    both = (settled_first >= 0) & (recorded_first >= 0)
+    settled_rows, recorded_rows = settled_first[both], recorded_first[both]
+
+    amount_mismatch = np.abs(settled_amounts[settled_rows] - amounts[recorded_rows]) > AMOUNT_TOLERANCE
+    differences['amount_mismatch'] = (settled_rows[amount_mismatch], recorded_rows[amount_mismatch])
+
+    # NaT (missing dates) compares as False and is not reported
+    gap = np.abs(settled_dates[settled_rows] - dates[recorded_rows])
+    date_mismatch = gap > np.timedelta64(date_tolerance, 'D')
+    differences['date_mismatch'] = (settled_rows[date_mismatch], recorded_rows[date_mismatch])
+
+    status_mismatch = ~succeeded[recorded_rows]
+    differences['status_mismatch'] = (settled_rows[status_mismatch], recorded_rows[status_mismatch])
+
+    duplicated = np.flatnonzero(settled_counts[settled_keys] > 1)
+    differences['duplicate_settlement'] = (duplicated, np.full(len(duplicated), -1))
+    duplicated = np.flatnonzero(recorded_counts[recorded_keys] > 1)
+    differences['duplicate_transaction'] = (np.full(len(duplicated), -1), duplicated)
+    return differences
+
+
+def report_rows(differences, settled, recorded):
+    """Yield the rows of the differences report."""
+    settled_codes, settled_amounts, settled_dates = settled
+    ids, codes, amounts, dates, statuses = recorded
+    for kind, (settled_rows, recorded_rows) in differences.items():
+        for settled_row, recorded_row in zip(settled_rows.tolist(), recorded_rows.tolist()):
+            row = {'kind': kind}
+            if settled_row >= 0:
+                row.update(transaction_code=settled_codes[settled_row], settled_amount=settled_amounts[settled_row],
+                           settled_date=settled_dates[settled_row])
+            if recorded_row >= 0:
+                row.update(transaction_code=codes[recorded_row], transaction_id=ids[recorded_row],
+                           recorded_amount=amounts[recorded_row], recorded_date=dates[recorded_row],
+                           recorded_status=statuses[recorded_row])
+            yield row
+
+
+def apply_corrections(differences, settled, recorded):
+    """Settle the transactions the gateway reports as paid; return the counts by result."""
+    settled_codes, settled_amounts, _ = settled
+    codes = recorded[1]
+    settled_rows, recorded_rows = differences['status_mismatch']
+
+    # Only payments whose amount matches and whose code is unambiguous
+    excluded = np.concatenate([differences['amount_mismatch'][1], differences['duplicate_transaction'][1]])
+    keep = np.isin(recorded_rows, excluded, invert=True) & \
+        np.isin(settled_codes[settled_rows], settled_codes[differences['duplicate_settlement'][0]], invert=True)
+
+    results = {}
+    for settled_row, recorded_row in zip(settled_rows[keep].tolist(), recorded_rows[keep].tolist()):
+        result = payments.apply_result(str(codes[recorded_row]), payments.SUCCEEDED,
+                                       amount=float(settled_amounts[settled_row]), source='reconciliation')
+        results[result] = results.get(result, 0) + 1
+    return results
+
+
+def reconcile_payments(path, start=None, end=None, date_tolerance=3, report=None, apply=False,
+                       code_column='transaction_code', amount_column='amount', date_column='settled_at'):
+    """Reconcile a settlement file and print the differences."""
+    with app.app_context():
+        try:
+            started = time.perf_counter()
+            settled = read_settlement(path, code_column, amount_column, date_column)
+            print(f"Read {len(settled[0])} settlement rows in {time.perf_counter() - started:.1f} s")
+            if not len(settled[0]) and not (start and end):
+                print("Empty settlement and no period given, nothing to do.")
+                return
+
+            # The period defaults to the days covered by the settlement
+            if start is None:
+                start = settled[2][~np.isnat(settled[2])].min().astype('datetime64[D]').item()
+            if end is None:
+                end = settled[2][~np.isnat(settled[2])].max().astype('datetime64[D]').item() + timedelta(days=1)
+            start = datetime.combine(start, datetime.min.time())
+            end = datetime.combine(end, datetime.min.time())
+
+            # Payments made shortly before the period may be settled in it
+            started = time.perf_counter()
+            recorded = load_transactions(start - timedelta(days=date_tolerance), end + timedelta(days=date_tolerance))
+            print(f"Loaded {len(recorded[0])} transactions from {start:%Y-%m-%d} to {end:%Y-%m-%d} "
+                  f"(± {date_tolerance} days) in {time.perf_counter() - started:.1f} s")
+
+            started = time.perf_counter()
+            differences = reconcile(settled, recorded, start, end, date_tolerance)
+            print(f"Matched in {time.perf_counter() - started:.1f} s")
+            for kind, (settled_rows, _) in differences.items():
+                print(f"{kind}: {len(settled_rows)}")
+
+            if report:
+                with open(report, 'w', newline='', encoding='utf-8') as f:
+                    writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+                    writer.writeheader()
+                    writer.writerows(report_rows(differences, settled, recorded))
+                print(f"Wrote the differences to {report}")
+
+            if apply:
+                print("Settling the transactions paid at the gateway...")
+                for result, count in sorted(apply_corrections(differences, settled, recorded).items()):
+                    print(f"{result}: {count}")
+            print("Done!")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error reconciling payments: {str(e)}")
+            raise e
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconcile payment transactions against a settlement report')
+    parser.add_argument('settlement', help='settlement CSV from the payment gateway')
+    parser.add_argument('--start', type=parse_date, help='first day of the period (YYYY-MM-DD)')
+    parser.add_argument('--end', type=parse_date, help='day after the period (YYYY-MM-DD)')
+    parser.add_argument('--date-tolerance', type=int, default=3, help='days allowed between payment and settlement')
+    parser.add_argument('--report', help='write every difference to this CSV')
+    parser.add_argument('--apply', action='store_true', help='settle the transactions paid at the gateway')
+    parser.add_argument('--code-column', default='transaction_code')
+    parser.add_argument('--amount-column', default='amount')
+    parser.add_argument('--date-column', default='settled_at')
+    options = parser.parse_args()
+    reconcile_payments(options.settlement, start=options.start, end=options.end,
+                       date_tolerance=options.date_tolerance, report=options.report, apply=options.apply,
+                       code_column=options.code_column, amount_column=options.amount_column,
+                       date_column=options.date_column)
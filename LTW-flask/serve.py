@@ -0,0 +1,256 @@
+"""
+Production server: a master process preloads the app and forks workers
+Usage: python serve.py --bind 0.0.0.0:8000 --workers 4
+
+The master binds the socket, builds create_app('production') (or
+FLASK_CONFIG) once, runs the warm-up (app/utils/warmup.py) and forks the
+workers, which share the preloaded app copy-on-write, open their database
+connections and accept connections from the same socket.
+Every worker handles one request at a time, drops the database connections
+inherited from the master and is replaced once it has served
+--max-requests requests or grown past --max-memory MB. Background jobs
+(app/utils/jobs.py) run in the worker that started them: a worker running
+jobs is not replaced, and a stopping worker waits up to --jobs-timeout
+seconds for them before it exits.
+
+Signals sent to the master:
+    HUP       reload the code: the master re-executes itself (same PID, same
+              socket), starts new workers, then drains the old ones
+    TERM/INT  drain: stop accepting, finish the running requests and exit
+"""
+
+from werkzeug.serving import make_server
+import argparse
+import os
+import random
+import resource
+import signal
+import socket
+import sys
+import time
+
+LISTEN_FD_ENV = 'SERVE_LISTEN_FD'
+OLD_WORKERS_ENV = 'SERVE_OLD_WORKERS'
+
+
+def log(message):
+    print(f"[{os.getpid()}] {message}", file=sys.stderr, flush=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve the bookstore with preforked workers')
+    parser.add_argument('--bind', default=f"0.0.0.0:{os.getenv('PORT', 8000)}", help='host:port to listen on')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('WEB_CONCURRENCY', (os.cpu_count() or 1) * 2)),
+                        help='number of worker processes')
+    parser.add_argument('--max-requests', type=int, default=1000,
+                        help='requests a worker serves before it is replaced (0: never)')
+    parser.add_argument('--max-requests-jitter', type=int, default=100,
+                        help='random extra requests, so workers are not all replaced at once')
+    parser.add_argument('--max-memory', type=int, default=512,
+                        help='peak resident memory in MB above which a worker is replaced (0: no limit)')
+    parser.add_argument('--graceful-timeout', type=float, default=30,
+                        help='seconds a draining worker gets to finish before it is killed')
+    parser.add_argument('--jobs-timeout', type=float, default=600,
+                        help='extra seconds a draining worker gets to finish its background jobs')
+    return parser.parse_args()
+
+
+def listen(bind):
+    """Bind the listening socket, or take over the one of the master that re-executed itself."""
+    fd = os.environ.pop(LISTEN_FD_ENV, None)
+    if fd:
+        sock = socket.socket(fileno=int(fd))
+    else:
+        host, port = bind.rsplit(':', 1)
+        sock = socket.create_server((host, int(port)), backlog=2048)
+    # Kept open across the exec of a reload
+    sock.set_inheritable(True)
+    return sock
+
+
+def dispose_engines(app, db):
+    """Drop pooled connections without closing them (they may belong to another process)."""
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def warm_up(app, db):
+    """Compile the templates and fill the process caches once in the master, workers inherit them."""
+    from app.utils.invalidation import bus
+    from app.utils.warmup import warm_up as run_warm_up
+
+    app.extensions['ready'] = False
+    started = time.monotonic()
+    report = run_warm_up(app)
+    # No threads may run in the master when it forks; workers inherit the position in the event stream
+    bus.stop()
+    dispose_engines(app, db)
+    app.extensions['ready'] = True
+    warmed = ', '.join(f"{entry['step']} {entry['status']}" for entry in report)
+    log(f"Warmed up in {time.monotonic() - started:.2f}s: {warmed}")
+
+
+def run_worker(app, db, sock, options, master_pid):
+    """Accept and serve requests until told to stop or due for replacement."""
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    # Ctrl-C reaches the whole process group, the master decides what to do
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    random.seed()
+    dispose_engines(app, db)
+    # Connections are per process, so every worker opens its own before accepting requests
+    from app.utils.invalidation import bus
+    from app.utils.jobs import running_jobs, wait_for_jobs
+    from app.utils.password_hashing import passwords
+    from app.utils.warmup import prime_pool
+    prime_pool(app)
+    bus.ensure_started()
+    with app.app_context():
+        passwords.start()
+
+    served = [0]
+    wsgi_app = app.wsgi_app
+
+    def counting_app(environ, start_response):
+        served[0] += 1
+        return wsgi_app(environ, start_response)
+
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, counting_app, fd=sock.fileno())
+    # Workers race for each connection; the losers get EAGAIN instead of blocking in accept()
+    server.socket.setblocking(False)
+    server.timeout = 1.0
+
+    limit = options.max_requests + random.randint(0, options.max_requests_jitter) if options.max_requests else None
+    reason = 'stopped'
+    while not stopping:
+        server.handle_request()
+        if os.getppid() != master_pid:
+            reason = 'master gone'
+            break
+        # Leaving would kill the background jobs of this worker: it is replaced once they are done
+        if running_jobs():
+            continue
+        if limit and served[0] >= limit:
+            reason = f'served {served[0]} requests'
+            break
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        if options.max_memory and peak_mb > options.max_memory:
+            reason = f'memory reached {peak_mb:.0f} MB'
+            break
+    server.server_close()
+    # Job threads do not survive os._exit()
+    if running_jobs():
+        log(f"Waiting for {running_jobs()} background jobs...")
+        if not wait_for_jobs(options.jobs_timeout):
+            log(f"{running_jobs()} background jobs still running, abandoned")
+    # The worker leaves with os._exit(), which skips the pool's own clean-up
+    passwords.shutdown(wait=True)
+    log(f"Worker exiting: {reason}")
+
+
+class Master:
+    """Keeps ``options.workers`` workers running and handles the signals."""
+
+    def __init__(self, app, db, sock, options):
+        self.app = app
+        self.db = db
+        self.sock = sock
+        self.options = options
+        self.workers = set()
+        self.old_workers = {int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, '').split(',') if pid}
+        self.stopping = False
+        self.reloading = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                run_worker(self.app, self.db, self.sock, self.options, self.master_pid)
+            except BaseException as e:
+                log(f"Worker crashed: {e!r}")
+                status = 1
+            finally:
+                os._exit(status)
+        self.workers.add(pid)
+
+    def reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.workers and os.waitstatus_to_exitcode(status) != 0:
+                log(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}")
+            self.workers.discard(pid)
+            self.old_workers.discard(pid)
+
+    def signal_workers(self, pids, signum):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def drain(self):
+        log(f"Draining {len(self.workers | self.old_workers)} workers...")
+        self.signal_workers(self.workers | self.old_workers, signal.SIGTERM)
+        # Workers without background jobs leave as soon as their request is done
+        deadline = time.monotonic() + self.options.graceful_timeout + self.options.jobs_timeout
+        while (self.workers or self.old_workers) and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.signal_workers(self.workers | self.old_workers, signal.SIGKILL)
+        self.reap()
+
+    def reexec(self):
+        # Workers survive the exec: the new master adopts and drains them once its own are up
+        log("Reloading...")
+        os.environ[LISTEN_FD_ENV] = str(self.sock.fileno())
+        os.environ[OLD_WORKERS_ENV] = ','.join(str(pid) for pid in self.workers | self.old_workers)
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def run(self):
+        self.master_pid = os.getpid()
+        signal.signal(signal.SIGHUP, lambda signum, frame: setattr(self, 'reloading', True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT, lambda signum, frame: setattr(self, 'stopping', True))
+
+        for _ in range(self.options.workers):
+            self.spawn()
+        if self.old_workers:
+            log(f"Draining {len(self.old_workers)} workers of the previous code")
+            self.signal_workers(self.old_workers, signal.SIGTERM)
+
+        while True:
+            self.reap()
+            if self.stopping:
+                self.drain()
+                log("Stopped")
+                return
+            if self.reloading:
+                self.reexec()
+            while len(self.workers) < self.options.workers:
+                self.spawn()
+            time.sleep(0.2)
+
+
+def main():
+    options = parse_args()
+    sock = listen(options.bind)
+
+    from app import create_app, db
+    app = create_app(os.getenv('FLASK_CONFIG', 'production'))
+    warm_up(app, db)
+
+    log(f"Listening on {options.bind} with {options.workers} workers")
+    Master(app, db, sock, options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+"""
+Maintenance job for the asset registry
+Run it periodically (e.g. daily from cron) to delete the uploaded covers and
+book files that no book references anymore: uploads whose book was never
+saved, and rows registered before uploads took a reference. Only rows older
+than ASSET_ORPHAN_GRACE are removed, so uploads in progress are left alone
+"""
+
+from app import create_cli_context, db
+from app.utils.asset_registry import sweep_unreferenced
+from app.utils.storage import init_storage
+import argparse
+import os
+
+app = create_cli_context(os.getenv('FLASK_CONFIG', 'development'))
+# The files are deleted from storage once the rows are removed
+init_storage(app)
+
+
+def sweep_assets(grace=None):
+    """Remove the unreferenced assets."""
+    with app.app_context():
+        try:
+            print("Sweeping unreferenced assets...")
+            removed = sweep_unreferenced(grace)
+            print(f"Removed {removed} unreferenced assets. Done!")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error sweeping assets: {str(e)}")
+            raise e
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete the uploaded files no book references')
+    parser.add_argument('--grace', type=int, help='seconds an unreferenced upload is kept (default: ASSET_ORPHAN_GRACE)')
+    sweep_assets(grace=parser.parse_args().grace)
@@ -0,0 +1,128 @@
+"""
+Fixtures of the test suite.
+
+The suite runs against a throwaway SQLite database and temporary folders
+(local storage, jobs, sessions, metrics), with the in-process stand-ins of
+the external services: LocalRedis for sessions, LocalBroker for cache
+invalidation and the mock payment gateway. Every test starts from freshly
+created tables holding two users (``admin``/``admin123``, ``bob``/``bob12345``)
+and one category.
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+WORKDIR = tempfile.mkdtemp(prefix='ltw-tests-')
+os.environ.setdefault('TEST_DATABASE_URL', 'sqlite:///' + os.path.join(WORKDIR, 'test.db'))
+
+from config import TestingConfig, config  # noqa: E402  (TEST_DATABASE_URL is read on import)
+
+
+class SuiteConfig(TestingConfig):
+    """Testing configuration writing only below the temporary folder."""
+    WTF_CSRF_ENABLED = False
+    BCRYPT_LOG_ROUNDS = 4
+    STORAGE_BACKEND = 'local'
+    STORAGE_LOCAL_ROOT = os.path.join(WORKDIR, 'files')
+    JOBS_DIR = os.path.join(WORKDIR, 'jobs')
+    METRICS_DIR = os.path.join(WORKDIR, 'metrics')
+    PROFILER_DIR = os.path.join(WORKDIR, 'profiles')
+    SESSION_SQLITE_PATH = os.path.join(WORKDIR, 'sessions.sqlite3')
+    JINJA_BYTECODE_CACHE_DIR = os.path.join(WORKDIR, 'jinja_cache')
+    INVALIDATION_BROKER = 'local'
+    # Every test logs in several times from the same address
+    LOGIN_THROTTLE_IP = (1000, 1)
+    LOGIN_THROTTLE_USERNAME = (1000, 1)
+    REGISTER_THROTTLE_IP = (1000, 1)
+
+
+config['suite'] = SuiteConfig
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+@pytest.fixture(scope='session')
+def app():
+    from app import create_app
+
+    return create_app('suite')
+
+
+@pytest.fixture(autouse=True)
+def database(app):
+    """
+    Fresh tables and caches for every test.
+
+    No application context stays pushed: requests of the test client would
+    share it, and with it ``g`` (the user loaded by Flask-Login).
+    """
+    from app import bcrypt, db
+    from app.models import Category, Role, User
+    from app.utils.invalidation import TAGGED_MODELS, bus, tag
+
+    with app.app_context():
+        db.session.remove()
+        # The default database only: binds of other apps (test_db_routing) are known to db as well
+        db.drop_all(bind_key=None)
+        db.create_all(bind_key=None)
+        # The process caches may still hold rows of the previous test
+        bus.deliver(None, [tag(kind) for kind in TAGGED_MODELS])
+
+        admin_role, user_role = Role(RoleName='Admin'), Role(RoleName='User')
+        db.session.add_all([admin_role, user_role])
+        db.session.flush()
+        db.session.add_all([
+            User(Username='admin', Password=bcrypt.generate_password_hash('admin123').decode('utf-8'),
+                 Email='admin@example.com', RoleID=admin_role.RoleID, Status=True),
+            User(Username='bob', Password=bcrypt.generate_password_hash('bob12345').decode('utf-8'),
+                 Email='bob@example.com', RoleID=user_role.RoleID, Status=True),
+            Category(CategoryName='Lập trình', Status=True),
+        ])
+        db.session.commit()
+        db.session.remove()
+    return db
+
+
+@pytest.fixture
+def category_id(app, database):
+    from app.models import Category
+
+    with app.app_context():
+        return Category.query.filter_by(CategoryName='Lập trình').one().CategoryID
+
+
+@pytest.fixture
+def add_book(app, database, category_id):
+    """Add a book to the catalog: ``add_book(title='...', price=...)`` returns its ID."""
+    from app.models import Book
+
+    def add(title='Sách kiểm tra', price=50000.0, **columns):
+        with app.app_context():
+            book = Book(Title=title, CategoryID=category_id, Price=price,
+                        FilePath=columns.pop('FilePath', 'http://example.com/book.pdf'), Status=True, **columns)
+            database.session.add(book)
+            database.session.commit()
+            return book.BookID
+
+    return add
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def login():
+    """Log ``client`` in: ``login(client, 'bob', 'bob12345', remember=True)``."""
+    def log_in(client, username, password, remember=False):
+        data = {'username': username, 'password': password}
+        if remember:
+            data['remember'] = 'y'
+        return client.post('/login', data=data)
+
+    return log_in
@@ -0,0 +1,143 @@
+"""Content-addressed asset registry: hashing of uploads and reference counting."""
+import hashlib
+import io
+
+import pytest
+from flask import request
+from sqlalchemy import insert, select, update
+from werkzeug.datastructures import FileStorage
+
+from app import db
+from app.models import Asset, Book
+from app.utils import asset_registry
+from app.utils.asset_registry import hash_upload, store_book_file
+from app.utils.storage import get_storage
+
+
+def upload(app, content, filename='book.pdf'):
+    """A request context with ``content`` posted as the ``file`` field."""
+    return app.test_request_context('/', method='POST', data={'file': (io.BytesIO(content), filename)})
+
+
+@pytest.mark.parametrize('size', [1000, 2 * 1024 * 1024])
+def test_uploads_are_hashed_while_received(app, monkeypatch, size):
+    content = b'%PDF-1.4\n' + bytes(range(256)) * (size // 256)
+    with upload(app, content):
+        file = request.files['file']
+
+        def read(*args):
+            raise AssertionError("the upload was read a second time")
+
+        monkeypatch.setattr(file.stream, 'read', read)
+        assert hash_upload(file) == (hashlib.sha256(content).hexdigest(), len(content))
+
+
+def test_modified_upload_is_hashed_again(app):
+    with upload(app, b'%PDF-1.4\noriginal'):
+        file = request.files['file']
+        file.stream.seek(0, io.SEEK_END)
+        file.stream.write(b' appended')
+        content = b'%PDF-1.4\noriginal appended'
+        assert hash_upload(file) == (hashlib.sha256(content).hexdigest(), len(content))
+        assert file.stream.read() == content
+
+
+def test_files_not_uploaded_are_read(app):
+    content = b'\xff\xd8\xff preview'
+    assert hash_upload(io.BytesIO(content)) == (hashlib.sha256(content).hexdigest(), len(content))
+
+
+def pdf(content):
+    return FileStorage(io.BytesIO(content), filename='book.pdf', content_type='application/pdf')
+
+
+def test_concurrent_upload_of_the_same_file(app, monkeypatch):
+    content = b'%PDF-1.4\nsame content'
+    upload_file = asset_registry.upload_file
+    uploads = []
+
+    def racing_upload(file):
+        # Another worker registers the same content while ours is uploaded
+        other = upload_file(pdf(content))
+        with db.engine.begin() as connection:
+            connection.execute(insert(Asset).values(
+                ContentHash=hashlib.sha256(content).hexdigest(), ResourceType='raw', Size=len(content),
+                URL=other['secure_url'], PublicID=other['public_id'], RefCount=1))
+        uploads.append(upload_file(file))
+        return uploads[-1]
+
+    with app.app_context():
+        monkeypatch.setattr(asset_registry, 'upload_file', racing_upload)
+        url = store_book_file(pdf(content))
+        db.session.commit()
+
+        asset = Asset.query.one()
+        assert url == asset.URL != uploads[0]['secure_url']
+        # The reference taken on upload is given back, the other worker's remains
+        assert asset.RefCount == 1
+        # Our copy was deleted at once
+        storage = get_storage()
+        assert storage.stat(uploads[0]['public_id']) is None
+        assert storage.stat(asset.PublicID) is not None
+
+
+def refcounts():
+    with db.engine.connect() as connection:
+        return dict(connection.execute(select(Asset.URL, Asset.RefCount)).all())
+
+
+def test_no_registry_row_is_locked_during_uploads(app, monkeypatch, category_id):
+    with app.app_context():
+        reused = store_book_file(pdf(b'%PDF-1.4\nreused'))
+        db.session.add(Book(Title='Sách', CategoryID=category_id, Price=1.0, FilePath=reused))
+        db.session.commit()
+        upload_file = asset_registry.upload_file
+
+        def upload_meanwhile(file):
+            # Another worker deletes a book using the asset while this one uploads
+            with db.engine.begin() as connection:
+                connection.execute(update(Asset).where(Asset.URL == reused).values(RefCount=Asset.RefCount - 1))
+            return upload_file(file)
+
+        monkeypatch.setattr(asset_registry, 'upload_file', upload_meanwhile)
+        # A reference to an existing file is taken, then a new one is uploaded
+        db.session.add(Book(Title='Sách khác', CategoryID=category_id, Price=1.0,
+                            FilePath=store_book_file(pdf(b'%PDF-1.4\nreused'))))
+        new = store_book_file(pdf(b'%PDF-1.4\nnew'))
+        db.session.add(Book(Title='Sách mới', CategoryID=category_id, Price=1.0, FilePath=new))
+        db.session.commit()
+        assert refcounts() == {reused: 1, new: 1}
+
+
+def test_references_are_given_back_on_rollback(app, category_id):
+    with app.app_context():
+        kept = store_book_file(pdf(b'%PDF-1.4\nkept'))
+        db.session.add(Book(Title='Sách', CategoryID=category_id, Price=1.0, FilePath=kept))
+        db.session.commit()
+
+        # Reused, and claimed by a book that is never committed
+        assert store_book_file(pdf(b'%PDF-1.4\nkept')) == kept
+        dropped = store_book_file(pdf(b'%PDF-1.4\ndropped'))
+        assert refcounts() == {kept: 2, dropped: 1}
+        db.session.add(Book(Title='Sách khác', CategoryID=category_id, Price=1.0, FilePath=kept))
+        db.session.flush()
+        db.session.rollback()
+
+        assert refcounts() == {kept: 1}
+        storage = get_storage()
+        assert storage.stat(*storage.locate(dropped)) is None
+        assert storage.stat(*storage.locate(kept)) is not None
+
+
+def test_reference_of_a_file_never_used_is_given_back(app):
+    with app.app_context():
+        url = store_book_file(pdf(b'%PDF-1.4\nunused'))
+        db.session.rollback()
+        assert refcounts() == {}
+
+        url = store_book_file(pdf(b'%PDF-1.4\nunused'))
+    # The end of the application context closes the session
+    with app.app_context():
+        assert refcounts() == {}
+        storage = get_storage()
+        assert storage.stat(*storage.locate(url)) is None
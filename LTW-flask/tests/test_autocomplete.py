@@ -0,0 +1,46 @@
+"""Search-box suggestions served from the in-memory prefix index."""
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from app.utils import autocomplete as autocomplete_module
+from app.utils.autocomplete import Autocomplete
+
+
+def wait_for_index(suggestions, timeout=10):
+    deadline = time.monotonic() + timeout
+    while suggestions._index is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return suggestions._index
+
+
+def test_suggestions_match_words_without_diacritics(app, add_book):
+    book_id = add_book(title='Nhà giả kim')
+    with app.app_context():
+        suggestions = Autocomplete()
+        assert ('book', book_id, 'Nhà giả kim') in suggestions.suggest('gia k')
+        assert suggestions.suggest('nha gia') == suggestions.suggest('Nhà giả')
+
+
+def test_failed_first_build_is_left_to_the_background(app, add_book, monkeypatch):
+    add_book(title='Nhà giả kim')
+    build_entries = autocomplete_module.build_entries
+    calls = []
+
+    def unavailable():
+        calls.append(1)
+        raise OperationalError('SELECT', {}, Exception('database unavailable'))
+
+    monkeypatch.setattr(autocomplete_module, 'build_entries', unavailable)
+    with app.test_request_context():
+        suggestions = Autocomplete()
+        assert suggestions.suggest('gia') == []
+        # Later lookups neither wait for nor retry the build before the delay
+        assert suggestions.suggest('gia') == []
+        assert len(calls) == 1
+
+        monkeypatch.setattr(autocomplete_module, 'build_entries', build_entries)
+        suggestions._retry_at = 0.0
+        assert suggestions.suggest('gia') == []
+        assert wait_for_index(suggestions) is not None
+        assert [label for _, _, label in suggestions.suggest('gia')] == ['Nhà giả kim']
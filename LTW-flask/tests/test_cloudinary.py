@@ -0,0 +1,67 @@
+"""Cloudinary backend against fake_cloudinary_server.py: errors, retries, what reaches the API."""
+import io
+import threading
+
+import pytest
+
+import fake_cloudinary_server
+from app.utils.resilience import Guard
+from app.utils.storage import CloudinaryError, CloudinaryStorage
+
+
+@pytest.fixture
+def faults():
+    """Faults of a fake Cloudinary running in a thread for the test."""
+    server = fake_cloudinary_server.serve(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    faults = fake_cloudinary_server.FakeCloudinaryHandler.faults
+    faults.prefix = 'http://127.0.0.1:%d' % server.server_address[1]
+    yield faults
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def storage(faults):
+    guard = Guard.from_config('cloudinary', {'EXTERNAL_RETRY_BASE_DELAY': 0.01},
+                              retryable=CloudinaryStorage.retryable)
+    return CloudinaryStorage('demo', 'key', 'secret', upload_prefix=faults.prefix, guard=guard)
+
+
+def requests(faults, operation):
+    return faults.as_dict()['requests'].get(operation, 0)
+
+
+def test_upload_and_destroy(storage, faults):
+    stored = storage.put(io.BytesIO(b'\x89PNG'), public_id='book_covers/a', image_format='png')
+    assert stored['public_id'] == 'book_covers/a'
+    assert storage.locate(stored['secure_url']) == ('book_covers/a', 'image')
+    assert storage.delete('book_covers/a') == {'result': 'ok'}
+    assert (requests(faults, 'upload'), requests(faults, 'destroy')) == (1, 1)
+
+
+def test_refusal_is_final(storage, faults):
+    faults.update({'fail_next': 1, 'error_status': 400})
+    with pytest.raises(CloudinaryError) as error:
+        storage.delete('book_files/a')
+    assert error.value.code == 400
+    assert requests(faults, 'destroy') == 1
+
+
+def test_server_error_is_retried(storage, faults):
+    faults.update({'fail_next': 1, 'error_status': 503})
+    assert storage.delete('book_files/a') == {'result': 'ok'}
+    assert requests(faults, 'destroy') == 2
+    # The upload sends the whole file again
+    faults.update({'fail_next': 1})
+    stored = storage.put(io.BytesIO(b'%PDF-1.4\n' + b'x' * 1000), public_id='book_files/b', resource_type='raw')
+    assert stored['bytes'] > 1000
+    assert requests(faults, 'upload') == 2
+
+
+def test_upload_without_public_id_is_not_repeated(storage, faults):
+    faults.update({'fail_next': 1, 'error_status': 503})
+    with pytest.raises(CloudinaryError) as error:
+        storage.put(io.BytesIO(b'%PDF-1.4\n'), folder='book_files', resource_type='raw')
+    assert error.value.code == 503
+    assert requests(faults, 'upload') == 1
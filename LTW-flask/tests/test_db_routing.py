@@ -0,0 +1,127 @@
+"""Read/write splitting, with a second SQLite file standing in for the replica."""
+from datetime import datetime, timedelta
+
+import pytest
+from flask import jsonify
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app import create_cli_context, db
+from app.models import Book, ReplicaHeartbeat
+from app.utils.db_routing import read_only
+from app.utils.invalidation import bus
+from config import config
+
+HEARTBEATS = ReplicaHeartbeat.__table__
+
+
+@pytest.fixture
+def routed(tmp_path, monkeypatch):
+    """An app whose ``replica_0`` bind is another SQLite file, replicated by hand with ``replicate()``."""
+    class ReplicatedConfig(config['suite']):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmp_path / 'primary.db')
+        SQLALCHEMY_REPLICA_URIS = ['sqlite:///' + str(tmp_path / 'replica.db')]
+        REPLICA_LAG_CHECK_INTERVAL = 0
+        REPLICA_MAX_LAG = 5
+
+    monkeypatch.setitem(config, 'replicated', ReplicatedConfig)
+    # The bus is rebound to the new app: restored for the other tests
+    for attribute in ('app', 'broker', '_pid'):
+        monkeypatch.setattr(bus, attribute, getattr(bus, attribute))
+    app = create_cli_context('replicated')
+
+    @app.route('/read')
+    @read_only
+    def read():
+        return jsonify(sorted(db.session.execute(select(Book.Title)).scalars()))
+
+    @app.route('/write', methods=['POST'])
+    def write():
+        db.session.add(Book(Title='Mới', Price=1.0, FilePath='x'))
+        db.session.commit()
+        return 'ok'
+
+    @app.route('/write-then-read', methods=['POST'])
+    @read_only
+    def write_then_read():
+        db.session.add(Book(Title='Mới', Price=1.0, FilePath='x'))
+        db.session.flush()
+        try:
+            with db.session.begin_nested():
+                db.session.add(Book(Title='Không có giá', Price=None, FilePath='x'))
+        except IntegrityError:
+            pass
+        titles = sorted(db.session.execute(select(Book.Title)).scalars())
+        db.session.commit()
+        return jsonify(titles)
+
+    with app.app_context():
+        primary, replica = db.engines[None], db.engines['replica_0']
+        for engine, title in ((primary, 'primary'), (replica, 'replica')):
+            db.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.execute(insert(Book.__table__).values(Title=title, Price=1.0, FilePath='x'))
+
+    def replicate(beat=None):
+        """Copy the heartbeat of the primary to the replica (or store ``beat`` on both)."""
+        with primary.begin() as connection:
+            if beat is not None:
+                connection.execute(update(HEARTBEATS).values(BeatDate=beat))
+            beat = connection.execute(select(HEARTBEATS.c.BeatDate)).scalar()
+        with replica.begin() as connection:
+            connection.execute(HEARTBEATS.delete())
+            connection.execute(insert(HEARTBEATS).values(HeartbeatID=1, BeatDate=beat))
+
+    yield app, replicate
+    with app.app_context():
+        db.engines[None].dispose()
+        db.engines['replica_0'].dispose()
+
+
+def test_reads_go_to_a_replica_that_caught_up(routed):
+    app, replicate = routed
+    client = app.test_client()
+    # No heartbeat received yet: the replica is not used
+    assert client.get('/read').json == ['primary']
+    replicate()
+    assert client.get('/read').json == ['replica']
+
+
+def test_idle_time_is_not_lag(routed):
+    app, replicate = routed
+    client = app.test_client()
+    client.get('/read')
+    # Nothing measured for an hour, the replica has the last beat
+    replicate(beat=datetime.utcnow() - timedelta(hours=1))
+    assert client.get('/read').json == ['replica']
+
+
+def test_lagging_replica_is_skipped(routed):
+    app, replicate = routed
+    client = app.test_client()
+    client.get('/read')
+    replicate(beat=datetime.utcnow() - timedelta(hours=1))
+    # The replica misses the beat written a minute ago
+    with app.app_context():
+        with db.engines[None].begin() as connection:
+            connection.execute(update(HEARTBEATS).values(BeatDate=datetime.utcnow() - timedelta(minutes=1)))
+    assert client.get('/read').json == ['primary']
+
+
+def test_reads_follow_own_writes(routed):
+    app, replicate = routed
+    client = app.test_client()
+    client.get('/read')
+    replicate()
+    client.post('/write')
+    assert client.get('/read').json == ['Mới', 'primary']
+
+
+def test_savepoint_rollback_keeps_the_session_on_the_primary(routed):
+    app, replicate = routed
+    client = app.test_client()
+    client.get('/read')
+    replicate()
+    assert client.post('/write-then-read').json == ['Mới', 'primary']
+    # The commit counts as a write of the browser session
+    assert client.get('/read').json == ['Mới', 'primary']
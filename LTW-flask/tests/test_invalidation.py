@@ -0,0 +1,113 @@
+"""Invalidation bus: ordering of messages, publication after commit, cache freshness."""
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from app.models import Book
+from app.utils import entity_cache
+from app.utils.invalidation import InvalidationBus, LocalBroker, bus, invalidate_on_commit, tag
+
+
+@pytest.fixture
+def local_bus():
+    """A bus of its own on a LocalBroker, recording what reaches its callbacks."""
+    received = []
+    test_bus = InvalidationBus(LocalBroker())
+    test_bus.subscribe('book', received.extend)
+    test_bus.broker.start(test_bus, None)
+    return test_bus, received
+
+
+@pytest.fixture
+def published(monkeypatch):
+    """Tags published by the commits of the test."""
+    tags = []
+    publish = bus.publish
+
+    def record(published_tags):
+        tags.extend(published_tags)
+        publish(published_tags)
+
+    monkeypatch.setattr(bus, 'publish', record)
+    return tags
+
+
+def test_late_message_is_ignored(local_bus):
+    test_bus, received = local_bus
+    test_bus.deliver(5, [tag('book', 1)])
+    test_bus.deliver(4, [tag('book', 1)])
+    test_bus.deliver(5, [tag('book', 1)])
+    assert received == [tag('book', 1)]
+
+
+def test_whole_kind_covers_older_row_messages(local_bus):
+    test_bus, received = local_bus
+    test_bus.deliver(7, [tag('book')])
+    test_bus.deliver(6, [tag('book', 3)])
+    assert received == [tag('book')]
+    test_bus.deliver(8, [tag('book', 3)])
+    assert received == [tag('book'), tag('book', 3)]
+
+
+def test_local_broker_versions_grow(local_bus):
+    test_bus, received = local_bus
+    test_bus.publish([tag('book', 1)])
+    test_bus.publish([tag('book', 1)])
+    assert received == [tag('book', 1), tag('book', 1)]
+
+
+def test_changed_since(local_bus):
+    test_bus, _ = local_bus
+    since = test_bus.sequence()
+    assert not test_bus.changed_since([tag('book', 1)], since)
+    test_bus.deliver(None, [tag('book', 2)])
+    assert not test_bus.changed_since([tag('book', 1)], since)
+    assert test_bus.changed_since([tag('book', 2)], since)
+    test_bus.deliver(None, [tag('book')])
+    assert test_bus.changed_since([tag('book', 1)], since)
+
+
+def test_changes_are_published_after_commit(app, add_book, published):
+    with app.app_context():
+        book_id = add_book()
+        published.clear()
+        db.session.get(Book, book_id).Title = 'Tên mới'
+        db.session.flush()
+        assert published == []
+        db.session.commit()
+        assert published == [tag('book', book_id)]
+
+
+def test_rollback_publishes_nothing(app, add_book, published):
+    with app.app_context():
+        book_id = add_book()
+        published.clear()
+        db.session.get(Book, book_id).Title = 'Tên mới'
+        invalidate_on_commit(db.session, tag('category'))
+        db.session.flush()
+        db.session.rollback()
+        db.session.commit()
+        assert published == []
+
+
+def test_cache_is_evicted_on_commit(app, add_book):
+    with app.app_context():
+        book_id = add_book(title='Tên cũ')
+        assert entity_cache.books.get(book_id).Title == 'Tên cũ'
+        db.session.get(Book, book_id).Title = 'Tên mới'
+        db.session.commit()
+        assert entity_cache.books.get(book_id).Title == 'Tên mới'
+
+
+def test_savepoint_rollback_keeps_outer_changes(app, add_book, published):
+    with app.app_context():
+        book_id = add_book()
+        published.clear()
+        db.session.get(Book, book_id).Title = 'Tên mới'
+        db.session.flush()
+        # A savepoint rolled back, e.g. an insert racing another worker
+        with pytest.raises(IntegrityError):
+            with db.session.begin_nested():
+                db.session.add(Book(Title='Không có giá', Price=None, FilePath='x'))
+        db.session.commit()
+        assert tag('book', book_id) in published
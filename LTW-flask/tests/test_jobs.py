@@ -0,0 +1,89 @@
+"""Background jobs: a bulk delete runs to the end outside a request."""
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from werkzeug.datastructures import FileStorage
+
+from app import db
+from app.models import Book
+from app.utils.asset_registry import store_book_file
+from app.utils.bulk_operations import BookSelection, delete_books
+from app.utils.jobs import DONE, FAILED, PENDING, RUNNING, get_job, running_jobs, submit_job, wait_for_jobs
+from app.utils.storage import get_storage
+
+
+def wait_for(job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    job = get_job(job_id)
+    while job['status'] not in (DONE, FAILED) and time.monotonic() < deadline:
+        time.sleep(0.05)
+        job = get_job(job_id)
+    return job
+
+
+def test_bulk_delete_removes_books_and_files(app, category_id):
+    # Jobs run with an application context only: storage URLs and the
+    # asset registry must work without a request
+    with app.app_context():
+        for i in range(5):
+            upload = FileStorage(io.BytesIO(b'%PDF-1.4\n% test ' + str(i).encode()),
+                                 filename=f'test-{i}.pdf', content_type='application/pdf')
+            db.session.add(Book(Title=f'Sách kiểm tra {i}', CategoryID=category_id, Price=1000.0,
+                                FilePath=store_book_file(upload)))
+        db.session.commit()
+        books = Book.query.all()
+        book_ids = [book.BookID for book in books]
+        file_urls = [book.FilePath for book in books]
+
+        job = wait_for(submit_job('bulk_delete_books', delete_books, BookSelection(ids=book_ids),
+                                  total=len(book_ids)))
+        assert job['status'] == DONE, job['message']
+
+        db.session.expire_all()
+        assert Book.query.count() == 0
+        storage = get_storage()
+        assert [url for url in file_urls if storage.stat(*storage.locate(url)) is not None] == []
+
+
+def test_server_can_wait_for_running_jobs(app):
+    release = threading.Event()
+
+    def blocked(job):
+        release.wait(10)
+        return 'ok'
+
+    with app.app_context():
+        job_id = submit_job('blocked', blocked)
+        assert running_jobs() == 1
+        assert not wait_for_jobs(timeout=0.1)
+        assert get_job(job_id)['status'] in (PENDING, RUNNING)
+        release.set()
+        assert wait_for_jobs(timeout=10)
+        assert running_jobs() == 0
+        assert get_job(job_id)['status'] == DONE
+
+
+def test_job_of_an_exited_process_is_failed(app):
+    with app.app_context():
+        job_id = submit_job('quick', lambda job: None)
+        wait_for_jobs(timeout=10)
+        path = os.path.join(app.config['JOBS_DIR'], f'{job_id}.json')
+        with open(path, encoding='utf-8') as f:
+            job = json.load(f)
+
+        # Left running by a worker that exited
+        exited = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                                capture_output=True, text=True, check=True)
+        job.update(status=RUNNING, pid=int(exited.stdout), finished=None)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(job, f)
+
+        assert get_job(job_id)['status'] == FAILED
+        # Recorded, not only reported
+        with open(path, encoding='utf-8') as f:
+            assert json.load(f)['status'] == FAILED
@@ -0,0 +1,195 @@
+"""Payment state machine: checkout, webhooks, polling and expiry."""
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.models import Order, PaymentTransaction
+from app.utils import payments
+
+
+@pytest.fixture
+def buyer(client, login):
+    login(client, 'bob', 'bob12345')
+    return client
+
+
+def checkout(buyer, book_id):
+    """Buy ``book_id``, return the pending transaction code and its order ID."""
+    response = buyer.post(f'/book/{book_id}/buy', data={'payment_method': 'momo'})
+    assert response.status_code == 302
+    code = response.headers['Location'].rsplit('/', 1)[1]
+    return code, PaymentTransaction.query.filter_by(TransactionCode=code).one().OrderID
+
+
+def states(code):
+    db.session.expire_all()
+    transaction = PaymentTransaction.query.filter_by(TransactionCode=code).one()
+    order = db.session.get(Order, transaction.OrderID)
+    return transaction.Status, order.OrderStatus, order.PaymentStatus
+
+
+def send_webhook(client, code, outcome):
+    transaction = PaymentTransaction.query.filter_by(TransactionCode=code).one()
+    body, signature = payments.get_gateway().webhook(transaction, outcome)
+    return client.post('/payments/webhook', data=body, headers={payments.SIGNATURE_HEADER: signature})
+
+
+def test_checkout_waits_for_the_gateway(app, buyer, add_book):
+    with app.app_context():
+        book_id = add_book()
+        code, _ = checkout(buyer, book_id)
+        assert states(code) == (payments.TRANSACTION_PENDING, payments.ORDER_AWAITING_PAYMENT, False)
+        # Buying again resumes the same payment
+        assert checkout(buyer, book_id)[0] == code
+
+
+def test_mock_checkout_pays_the_order(app, buyer, add_book):
+    with app.app_context():
+        code, _ = checkout(buyer, add_book())
+        assert buyer.post(f'/payments/mock/{code}', data={'action': 'pay'}).status_code == 302
+        assert states(code) == (payments.TRANSACTION_SUCCEEDED, payments.ORDER_COMPLETED, True)
+
+
+def test_webhooks_are_idempotent(app, buyer, client, add_book):
+    with app.app_context():
+        code, _ = checkout(buyer, add_book())
+        assert send_webhook(client, code, payments.SUCCEEDED).json['result'] == 'applied'
+        assert send_webhook(client, code, payments.SUCCEEDED).json['result'] == 'duplicate'
+        # A failure delivered after the success changes nothing
+        assert send_webhook(client, code, payments.FAILED).json['result'] == 'ignored'
+        assert states(code) == (payments.TRANSACTION_SUCCEEDED, payments.ORDER_COMPLETED, True)
+
+
+def test_webhook_signature_is_checked(app, buyer, client, add_book):
+    with app.app_context():
+        code, _ = checkout(buyer, add_book())
+        transaction = PaymentTransaction.query.filter_by(TransactionCode=code).one()
+        body, signature = payments.get_gateway().webhook(transaction, payments.SUCCEEDED)
+        forged = signature.replace('v1=', 'v1=0')
+        assert client.post('/payments/webhook', data=body,
+                           headers={payments.SIGNATURE_HEADER: forged}).status_code == 400
+        assert client.post('/payments/webhook', data=body).status_code == 400
+        assert states(code)[0] == payments.TRANSACTION_PENDING
+
+
+@pytest.mark.parametrize('body', [b'{"transaction_code": "X", "status": ["succeeded"]}',
+                                  b'{"transaction_code": "X", "status": "succeeded", "amount": "1e999"}',
+                                  b'{"transaction_code": "X", "status": "succeeded", "amount": true}',
+                                  b'not json'])
+def test_malformed_webhook_is_refused(app, client, body):
+    with app.app_context():
+        signature = payments.sign(body, app.config['PAYMENT_WEBHOOK_SECRET'])
+    response = client.post('/payments/webhook', data=body, headers={payments.SIGNATURE_HEADER: signature})
+    assert response.status_code == 400
+
+
+def test_amount_mismatch_is_not_applied(app, buyer, add_book):
+    with app.app_context():
+        code, _ = checkout(buyer, add_book(price=50000.0))
+        assert payments.apply_result(code, payments.SUCCEEDED, amount=1.0) == 'amount_mismatch'
+        assert states(code)[0] == payments.TRANSACTION_PENDING
+
+
+def test_declined_payment_can_be_retried(app, buyer, add_book):
+    with app.app_context():
+        code, order_id = checkout(buyer, add_book())
+        buyer.post(f'/payments/mock/{code}', data={'action': 'decline'})
+        assert states(code) == (payments.TRANSACTION_FAILED, payments.ORDER_AWAITING_PAYMENT, False)
+
+        response = buyer.post(f'/order/{order_id}/pay')
+        retry = response.headers['Location'].rsplit('/', 1)[1]
+        assert retry != code
+        assert states(retry)[0] == payments.TRANSACTION_PENDING
+
+
+def test_stale_payment_expires_and_cancels_the_order(app, buyer, add_book):
+    with app.app_context():
+        code, order_id = checkout(buyer, add_book())
+        assert payments.sweep_pending()['expired'] == 0
+        counts = payments.sweep_pending(now=datetime.utcnow() + timedelta(hours=1))
+        assert counts['expired'] == 1
+        assert states(code) == (payments.TRANSACTION_EXPIRED, payments.ORDER_CANCELLED, False)
+        # Nothing left to pay
+        buyer.post(f'/order/{order_id}/pay')
+        assert PaymentTransaction.query.filter_by(OrderID=order_id).count() == 1
+
+
+def test_success_after_expiry_completes_the_order(app, buyer, add_book):
+    with app.app_context():
+        code, _ = checkout(buyer, add_book())
+        assert payments.expire(code)
+        assert payments.apply_result(code, payments.SUCCEEDED) == 'applied'
+        assert states(code) == (payments.TRANSACTION_SUCCEEDED, payments.ORDER_COMPLETED, True)
+        # The outcome arrived first: nothing left to expire
+        assert not payments.expire(code)
+
+
+def run_together(app, monkeypatch, *calls):
+    """Run ``calls`` in threads that all read the transaction before any of them changes it."""
+    barrier = threading.Barrier(len(calls))
+    read = payments._read_transaction
+    first_reads = []
+
+    def read_then_wait(transaction_code):
+        transaction = read(transaction_code)
+        # Only the first read of every call meets the others, the retries go on alone
+        if len(first_reads) < len(calls):
+            first_reads.append(transaction_code)
+            barrier.wait(timeout=10)
+        return transaction
+
+    monkeypatch.setattr(payments, '_read_transaction', read_then_wait)
+    results = [None] * len(calls)
+
+    def run(index, call):
+        with app.app_context():
+            results[index] = call()
+
+    threads = [threading.Thread(target=run, args=(index, call)) for index, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=30)
+    return results
+
+
+@pytest.fixture
+def purchases(monkeypatch):
+    """Orders whose purchase was recorded (rankings, metrics)."""
+    recorded = []
+    monkeypatch.setattr(payments, '_record_purchase', recorded.append)
+    return recorded
+
+
+def test_concurrent_duplicates_apply_once(app, buyer, add_book, monkeypatch, purchases):
+    with app.app_context():
+        code, order_id = checkout(buyer, add_book())
+    results = run_together(app, monkeypatch, lambda: payments.apply_result(code, payments.SUCCEEDED),
+                           lambda: payments.apply_result(code, payments.SUCCEEDED))
+    assert sorted(results) == ['applied', 'duplicate']
+    assert purchases == [order_id]
+    with app.app_context():
+        assert states(code) == (payments.TRANSACTION_SUCCEEDED, payments.ORDER_COMPLETED, True)
+
+
+def test_expiry_racing_success_keeps_the_payment(app, buyer, add_book, monkeypatch, purchases):
+    with app.app_context():
+        code, order_id = checkout(buyer, add_book())
+    results = run_together(app, monkeypatch, lambda: payments.expire(code),
+                           lambda: payments.apply_result(code, payments.SUCCEEDED))
+    # Whichever came first, the success is applied exactly once and completes the order
+    assert results[1] == 'applied'
+    assert purchases == [order_id]
+    with app.app_context():
+        assert states(code) == (payments.TRANSACTION_SUCCEEDED, payments.ORDER_COMPLETED, True)
+
+
+def test_gateways_must_provide_a_checkout_page():
+    class Incomplete(payments.PaymentGateway):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+    assert payments.MockGateway().query('X') is None
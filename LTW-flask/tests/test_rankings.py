@@ -0,0 +1,50 @@
+"""Time-decayed rankings: events, compaction and the cached lists."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from app import db
+from app.models import Book, RankingEpoch, RankingScore
+from app.utils import rankings
+
+
+def scores(entity_type='book'):
+    db.session.expire_all()
+    return {(row.Ranking, row.EntityID): row.Score for row in RankingScore.query.filter_by(EntityType=entity_type)}
+
+
+def test_events_add_to_book_and_category(app, add_book, category_id):
+    with app.app_context():
+        book = db.session.get(Book, add_book())
+        rankings.record_event(book, rankings.PURCHASE)
+        rankings.record_event(book, rankings.DOWNLOAD)
+        weight = app.config['RANKING_DOWNLOAD_WEIGHT']
+        for ranking in rankings.rankings():
+            assert scores()[ranking, book.BookID] == pytest.approx(1 + weight, rel=1e-3)
+            assert scores('category')[ranking, category_id] == pytest.approx(1 + weight, rel=1e-3)
+
+
+def test_compaction_moves_the_epoch_and_keeps_the_order(app, add_book):
+    with app.app_context():
+        start = datetime.utcnow()
+        popular, other = (db.session.get(Book, add_book(title=title)) for title in ('Phổ biến', 'Khác'))
+        for _ in range(3):
+            rankings.record_event(popular, rankings.PURCHASE, when=start)
+        rankings.record_event(other, rankings.PURCHASE, when=start)
+        before = scores()
+
+        later = start + timedelta(days=1)
+        rankings.compact(later)
+        after = scores()
+        # An event after the compaction uses the new epoch
+        rankings.record_event(other, rankings.PURCHASE, when=later)
+        final = scores()
+        for ranking in rankings.rankings():
+            assert db.session.get(RankingEpoch, ranking).Epoch == later
+            decay = 2 ** (-86400 / app.config['RANKING_HALF_LIVES'][ranking])
+            assert after[ranking, popular.BookID] == pytest.approx(before[ranking, popular.BookID] * decay, rel=1e-6)
+            assert final[ranking, other.BookID] == pytest.approx(after[ranking, other.BookID] + 1, rel=1e-6)
+
+        rankings.leaderboard.invalidate()
+        assert [entity_id for entity_id, _ in rankings.leaderboard.top(rankings.rankings()[0])] == \
+            [popular.BookID, other.BookID]
@@ -0,0 +1,63 @@
+"""Offline "related books" job (build_recommendations.py), run as cron would."""
+import os
+import subprocess
+import sys
+from datetime import datetime
+
+from app import db
+from app.models import BookRecommendation, Order, OrderDetail, User
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def build(app, *args):
+    env = dict(os.environ, FLASK_CONFIG='testing', TEST_DATABASE_URL=app.config['SQLALCHEMY_DATABASE_URI'])
+    result = subprocess.run([sys.executable, 'build_recommendations.py', *args], cwd=ROOT, env=env,
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    return result.stdout
+
+
+def add_order(book_ids, paid):
+    user_id = User.query.filter_by(Username='bob').one().UserID
+    order = Order(UserID=user_id, OrderDate=datetime.utcnow(), TotalAmount=1000.0 * len(book_ids),
+                  PaymentMethod='momo', PaymentStatus=paid, OrderStatus='Hoàn thành' if paid else 'Chờ thanh toán')
+    db.session.add(order)
+    db.session.flush()
+    db.session.add_all(OrderDetail(OrderID=order.OrderID, BookID=book_id, Price=1000.0) for book_id in book_ids)
+    db.session.commit()
+    return order.OrderID
+
+
+def related(book_id):
+    db.session.expire_all()
+    recommendation = db.session.get(BookRecommendation, book_id)
+    return recommendation.related_ids if recommendation else []
+
+
+def test_incremental_run_picks_up_new_purchases(app, add_book):
+    first, second, third = (add_book(title=f'Sách {i}') for i in range(3))
+    with app.app_context():
+        add_order([first, second], paid=True)
+        build(app)
+        assert related(first) == [second]
+
+        add_order([first, third], paid=True)
+        build(app)
+        assert set(related(first)) == {second, third}
+
+
+def test_order_paid_after_a_run_is_counted(app, add_book):
+    first, second, third = (add_book(title=f'Sách {i}') for i in range(3))
+    with app.app_context():
+        # Placed first, paid only after the next run: its lines are below the watermark
+        late = add_order([first, third], paid=False)
+        add_order([first, second], paid=True)
+        build(app)
+        assert related(first) == [second]
+
+        order = db.session.get(Order, late)
+        order.PaymentStatus = True
+        db.session.commit()
+        assert 'recomputing every book' in build(app)
+        assert set(related(first)) == {second, third}
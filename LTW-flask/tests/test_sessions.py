@@ -0,0 +1,79 @@
+"""Server-side sessions: the LocalRedis store and the revocation of a banned user's sessions."""
+import time
+
+import pytest
+
+from app.models import User
+from app.utils.session_store import LocalRedis
+
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalRedis(str(tmp_path / 'sessions.sqlite3'), sweep_interval=0)
+
+
+def test_values_expire(store, monkeypatch):
+    store.set('a', 'value', ex=10)
+    store.setex('b', 10, b'other')
+    assert store.get('a') == b'value'
+    assert store.get('b') == b'other'
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert store.get('a') is None
+    assert store.get('b') is None
+
+
+def test_sets_keep_their_expiry(store, monkeypatch):
+    assert store.sadd('s', 1, 2) == 2
+    assert store.expire('s', 10)
+    store.sadd('s', 3)
+    assert store.srem('s', 2) == 1
+    assert store.smembers('s') == {b'1', b'3'}
+
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 11)
+    assert store.smembers('s') == set()
+
+
+def test_store_is_shared_between_instances(store):
+    store.set('shared', 'yes')
+    assert LocalRedis(store.path).get('shared') == b'yes'
+
+
+def _cookie(client, name):
+    return next((cookie.value for cookie in client.cookie_jar if cookie.name == name), None)
+
+
+def test_ban_revokes_sessions_and_remember_cookies(app, login):
+    device = app.test_client()
+    login(device, 'bob', 'bob12345', remember=True)
+    assert device.get('/profile').status_code == 200
+    remember = _cookie(device, app.config.get('REMEMBER_COOKIE_NAME', 'remember_token'))
+    assert remember
+
+    admin = app.test_client()
+    login(admin, 'admin', 'admin123')
+    with app.app_context():
+        bob_id = User.query.filter_by(Username='bob').one().UserID
+    admin.post(f'/admin/users/ban/{bob_id}')
+
+    # The session itself is gone
+    assert device.get('/profile').status_code == 302
+    # And the remember cookie does not log the user in again
+    other_device = app.test_client()
+    other_device.set_cookie('localhost', app.config.get('REMEMBER_COOKIE_NAME', 'remember_token'), remember)
+    assert other_device.get('/profile').status_code == 302
+
+
+def test_unbanned_user_logs_in_again(app, login):
+    admin = app.test_client()
+    login(admin, 'admin', 'admin123')
+    with app.app_context():
+        bob_id = User.query.filter_by(Username='bob').one().UserID
+    admin.post(f'/admin/users/ban/{bob_id}')
+    admin.post(f'/admin/users/ban/{bob_id}')
+
+    device = app.test_client()
+    login(device, 'bob', 'bob12345')
+    assert device.get('/profile').status_code == 200
@@ -0,0 +1,88 @@
+"""
+Startup budgets of the web app and the maintenance scripts.
+
+Every case starts in fresh interpreters and the median wall time is compared
+with its budget. Modules that must stay out of a case (heavy SDKs imported on
+first use) are checked as well. On failure, the slowest imports of the case
+are listed to show where the time goes.
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = int(os.environ.get('STARTUP_BUDGET_RUNS', 3))
+
+CASES = {
+    # Maintenance scripts: config, database and models only
+    'cli': {
+        'code': "from app import create_cli_context; import app.models; "
+                "create_cli_context(os.getenv('FLASK_CONFIG', 'development'))",
+        'budget': 0.8,
+        'forbidden': ('flask_migrate', 'alembic', 'cloudinary', 'slugify', 'PIL', 'numpy',
+                      'flask_session', 'app.routes.admin_routes'),
+    },
+    # Web workers: the full application
+    'web': {
+        'code': "from app import create_app; create_app(os.getenv('FLASK_CONFIG', 'development'))",
+        'budget': 1.5,
+        'forbidden': ('flask_migrate', 'alembic', 'cloudinary', 'slugify', 'numpy'),
+    },
+}
+
+PROBE = """
+import os, sys, time
+started = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - started
+print(repr((elapsed, sorted(sys.modules))))
+"""
+
+
+def _environment(tmp_path):
+    env = dict(os.environ, FLASK_CONFIG='testing', TEST_DATABASE_URL='sqlite:///' + str(tmp_path / 'startup.db'))
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    return env
+
+
+def run_case(code, env):
+    """Run ``code`` in a fresh interpreter, return (seconds, loaded modules)."""
+    result = subprocess.run([sys.executable, '-c', PROBE.format(code=code)], capture_output=True, text=True,
+                            cwd=ROOT, env=env)
+    assert result.returncode == 0, result.stderr
+    return eval(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(code, env, count=8):
+    """The ``count`` top-level imports with the highest cumulative time, as report lines."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', PROBE.format(code=code)],
+                            capture_output=True, text=True, cwd=ROOT, env=env)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only direct imports of the probe, nested ones are part of their cumulative time
+        if len(name) - len(name.lstrip()) <= 1:
+            imports.append((int(cumulative) / 1000, name.strip()))
+    return [f'{milliseconds:8.1f} ms  {module}' for milliseconds, module in sorted(imports, reverse=True)[:count]]
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_startup_budget(name, tmp_path):
+    case = CASES[name]
+    env = _environment(tmp_path)
+    samples = [run_case(case['code'], env) for _ in range(RUNS)]
+
+    loaded = set(samples[0][1])
+    unexpected = [module for module in case['forbidden'] if module in loaded]
+    assert not unexpected, f"{name} imports {', '.join(unexpected)} eagerly"
+
+    median = statistics.median(seconds for seconds, _ in samples)
+    assert median <= case['budget'], (
+        f"{name}: {median * 1000:.0f} ms (budget {case['budget'] * 1000:.0f} ms)\n"
+        + '\n'.join(slowest_imports(case['code'], env))
+    )